@@ -0,0 +1,373 @@
+from abc import ABC, abstractmethod
+from bson import ObjectId
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, DESCENDING
+from pymongo.asynchronous.database import AsyncDatabase
+from pymongo.errors import DuplicateKeyError
+from starlette.concurrency import run_in_threadpool
+from typing import List, Optional, Tuple
+from urllib.parse import quote
+import asyncio
+import gzip
+import json
+import logging
+import os
+import secrets
+import threading
+import dotenv
+from utils import naive_utc
+
+# Load environment variables from .env file
+dotenv.load_dotenv()
+
+# Constants
+# "gcs" archives to a bucket shared by every replica; "local" only suits a single
+# instance with a persistent disk, since the chunk manifests are shared in Mongo.
+# Archiving is off by default
+LOG_ARCHIVE_BACKEND = os.getenv("LOG_ARCHIVE_BACKEND", "none").lower()
+LOG_ARCHIVE_ROOT = os.getenv("LOG_ARCHIVE_ROOT", "./log-archive")
+LOG_ARCHIVE_BUCKET = os.getenv("LOG_ARCHIVE_BUCKET", os.getenv("GCP_BUCKET_NAME"))
+LOG_ARCHIVE_PREFIX = os.getenv("LOG_ARCHIVE_PREFIX", "log-archive")
+# Entries are archived this long before their TTL expiry, so an archiver outage
+# shorter than the lead time loses nothing
+LOG_ARCHIVE_LEAD_HOURS = int(os.getenv("LOG_ARCHIVE_LEAD_HOURS", "24"))
+LOG_ARCHIVE_INTERVAL_S = int(os.getenv("LOG_ARCHIVE_INTERVAL_S", "3600"))
+LOG_ARCHIVE_CHUNK_SIZE = int(os.getenv("LOG_ARCHIVE_CHUNK_SIZE", "10000"))
+LOG_ARCHIVE_CACHE_CHUNKS = int(os.getenv("LOG_ARCHIVE_CACHE_CHUNKS", "16"))
+ARCHIVE_LEASE_ID = "log_archiver"
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class ArchiveStore(ABC):
+    """Where compacted archive chunks are kept"""
+
+    @abstractmethod
+    def put(self, path: str, data: bytes):
+        """Store a chunk under `path`"""
+
+    @abstractmethod
+    def get(self, path: str) -> bytes:
+        """Read back a chunk written by `put`"""
+
+
+class LocalArchiveStore(ArchiveStore):
+    """Archive chunks as files under a root directory"""
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+
+    def full_path(self, path: str) -> str:
+        full_path = os.path.abspath(os.path.join(self.root, path))
+        if not full_path.startswith(self.root + os.sep):
+            raise ValueError(f"Invalid archive path: {path}")
+        return full_path
+
+    def put(self, path: str, data: bytes):
+        full_path = self.full_path(path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        temp_path = f"{full_path}.{secrets.token_hex(4)}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        # Readers never see a partially written chunk
+        os.replace(temp_path, full_path)
+
+    def get(self, path: str) -> bytes:
+        with open(self.full_path(path), "rb") as f:
+            return f.read()
+
+
+class GCSArchiveStore(ArchiveStore):
+    """Archive chunks as objects in a GCS bucket; the client is created on first use"""
+
+    def __init__(self, bucket_name: str, prefix: str):
+        self.bucket_name = bucket_name
+        self.prefix = prefix.strip("/")
+        self._bucket = None
+        self._lock = threading.Lock()
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            with self._lock:
+                if self._bucket is None:
+                    from google.cloud import storage
+
+                    self._bucket = storage.Client().bucket(self.bucket_name)
+        return self._bucket
+
+    def put(self, path: str, data: bytes):
+        blob = self.bucket.blob(f"{self.prefix}/{path}")
+        blob.upload_from_string(data, content_type="application/gzip")
+
+    def get(self, path: str) -> bytes:
+        return self.bucket.blob(f"{self.prefix}/{path}").download_as_bytes()
+
+
+def create_archive_store() -> Optional[ArchiveStore]:
+    """Create the archive store selected by LOG_ARCHIVE_BACKEND; None disables archiving"""
+    if LOG_ARCHIVE_BACKEND == "none":
+        return None
+    if LOG_ARCHIVE_BACKEND == "local":
+        return LocalArchiveStore(LOG_ARCHIVE_ROOT)
+    if LOG_ARCHIVE_BACKEND == "gcs":
+        return GCSArchiveStore(LOG_ARCHIVE_BUCKET, LOG_ARCHIVE_PREFIX)
+    raise ValueError(f"Unknown LOG_ARCHIVE_BACKEND: {LOG_ARCHIVE_BACKEND}")
+
+
+def encode_chunk(documents: List[dict]) -> bytes:
+    """Serialize log documents as gzipped NDJSON"""
+    lines = []
+    for document in documents:
+        entry = {
+            key: value
+            for key, value in document.items()
+            if key not in ("expire_at", "archived")
+        }
+        entry["_id"] = str(entry["_id"])
+        entry["timestamp"] = entry["timestamp"].isoformat()
+        lines.append(json.dumps(entry))
+    return gzip.compress(("\n".join(lines) + "\n").encode())
+
+
+def decode_chunk(data: bytes) -> List[dict]:
+    """Inverse of `encode_chunk`"""
+    documents = []
+    for line in gzip.decompress(data).splitlines():
+        if line.strip():
+            document = json.loads(line)
+            document["_id"] = ObjectId(document["_id"])
+            document["timestamp"] = datetime.fromisoformat(document["timestamp"])
+            documents.append(document)
+    return documents
+
+
+def matches(
+    document: dict,
+    service_name: Optional[str],
+    log_level: Optional[str],
+    start_time: Optional[datetime],
+    end_time: Optional[datetime],
+    search: Optional[str],
+    before: Optional[Tuple[datetime, ObjectId]],
+) -> bool:
+    """Apply the `build_log_query` filters to an archived document in memory"""
+    if service_name and document.get("service_name") != service_name:
+        return False
+    if log_level and document.get("log_level") != log_level:
+        return False
+    timestamp = document["timestamp"]
+    if start_time and timestamp < start_time:
+        return False
+    if end_time and timestamp >= end_time:
+        return False
+    if before and (timestamp, document["_id"]) >= before:
+        return False
+    if search:
+        # Archives have no text index; every search term must appear in the message
+        message = document.get("message", "").lower()
+        return all(term in message for term in search.lower().split())
+    return True
+
+
+class LogArchive:
+    """
+    Compacts soon-to-expire log entries into compressed chunks and reads them back.
+
+    Each chunk holds one user's entries in timestamp order and is described by a
+    `log_archives` manifest document, so a query only fetches the chunks whose time
+    span overlaps the range it asks for.
+    """
+
+    def __init__(self, store: ArchiveStore):
+        self.store = store
+        self.owner = secrets.token_hex(8)
+        self.task = None
+        self.cache = OrderedDict()  # Chunks are immutable, so decoded ones are reused
+
+    async def ensure_indexes(self, db: AsyncDatabase):
+        await db.log_archives.create_index(
+            [("username", ASCENDING), ("end_time", DESCENDING)]
+        )
+
+    def start(self, db: AsyncDatabase):
+        """Start the background compaction task"""
+        if self.task is None:
+            self.task = asyncio.create_task(self.run(db))
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def run(self, db: AsyncDatabase):
+        while True:
+            try:
+                archived = await self.archive_expiring(db)
+                if archived:
+                    logger.info(f"Archived {archived} log entries")
+            except Exception as e:
+                logger.error(f"Error archiving logs: {str(e)}")
+            await asyncio.sleep(LOG_ARCHIVE_INTERVAL_S)
+
+    async def acquire_lease(self, db: AsyncDatabase) -> bool:
+        """Take or renew the lease that lets only one replica archive at a time"""
+        now = datetime.utcnow()
+        try:
+            await db.locks.find_one_and_update(
+                {
+                    "_id": ARCHIVE_LEASE_ID,
+                    "$or": [{"expires_at": {"$lt": now}}, {"owner": self.owner}],
+                },
+                {
+                    "$set": {
+                        "owner": self.owner,
+                        "expires_at": now + timedelta(seconds=LOG_ARCHIVE_INTERVAL_S),
+                    }
+                },
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # Another replica holds an unexpired lease
+            return False
+        return True
+
+    async def archive_expiring(self, db: AsyncDatabase) -> int:
+        """Archive every entry due to expire within LOG_ARCHIVE_LEAD_HOURS"""
+        if not await self.acquire_lease(db):
+            return 0
+        cutoff = datetime.utcnow() + timedelta(hours=LOG_ARCHIVE_LEAD_HOURS)
+        query = {"expire_at": {"$lt": cutoff}, "archived": {"$ne": True}}
+        archived = 0
+        for username in await db.logs.distinct("username", query):
+            chunk = []
+            cursor = (
+                db.logs.find({**query, "username": username})
+                .sort([("timestamp", 1), ("_id", 1)])
+                .batch_size(LOG_ARCHIVE_CHUNK_SIZE)
+            )
+            async for document in cursor:
+                chunk.append(document)
+                if len(chunk) >= LOG_ARCHIVE_CHUNK_SIZE:
+                    archived += await self.write_chunk(db, username, chunk)
+                    chunk = []
+                    if not await self.acquire_lease(db):
+                        return archived
+            if chunk:
+                archived += await self.write_chunk(db, username, chunk)
+        return archived
+
+    async def write_chunk(self, db: AsyncDatabase, username: str, chunk: List[dict]):
+        """Store one chunk, record its manifest, then mark its entries archived"""
+        start_time = chunk[0]["timestamp"]
+        path = (
+            f"{quote(username, safe='')}/{start_time:%Y/%m/%d}/{ObjectId()}.ndjson.gz"
+        )
+        await run_in_threadpool(self.store.put, path, encode_chunk(chunk))
+        await db.log_archives.insert_one(
+            {
+                "username": username,
+                "path": path,
+                "start_time": start_time,
+                "end_time": chunk[-1]["timestamp"],
+                "count": len(chunk),
+                "service_names": sorted({doc["service_name"] for doc in chunk}),
+                "log_levels": sorted({doc["log_level"] for doc in chunk}),
+                "created_at": datetime.utcnow(),
+            }
+        )
+        # Marked entries are skipped by hot queries until the TTL monitor removes them
+        await db.logs.update_many(
+            {"_id": {"$in": [doc["_id"] for doc in chunk]}},
+            {"$set": {"archived": True}},
+        )
+        return len(chunk)
+
+    async def load_chunk(self, path: str) -> List[dict]:
+        if path in self.cache:
+            self.cache.move_to_end(path)
+            return self.cache[path]
+        documents = decode_chunk(await run_in_threadpool(self.store.get, path))
+        self.cache[path] = documents
+        if len(self.cache) > LOG_ARCHIVE_CACHE_CHUNKS:
+            self.cache.popitem(last=False)
+        return documents
+
+    async def find(
+        self,
+        db: AsyncDatabase,
+        username: str,
+        limit: int,
+        service_name: Optional[str] = None,
+        log_level: Optional[str] = None,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        search: Optional[str] = None,
+        before: Optional[Tuple[datetime, ObjectId]] = None,
+        newer_than: Optional[datetime] = None,
+    ) -> List[dict]:
+        """
+        Return up to `limit` archived entries newest first, with `/logs/` semantics.
+
+        `newer_than` skips chunks that end before it, e.g. the oldest entry of a full
+        page of hot results, since nothing in them could make the page.
+        """
+        # Archived timestamps are naive UTC, and comparing them in Python with
+        # aware bounds would raise
+        start_time, end_time = naive_utc(start_time), naive_utc(end_time)
+        manifest_query = {"username": username}
+        lower = max(filter(None, (start_time, newer_than)), default=None)
+        if lower:
+            manifest_query["end_time"] = {"$gte": lower}
+        upper = min(filter(None, (end_time, before and before[0])), default=None)
+        if upper:
+            manifest_query["start_time"] = {"$lte": upper}
+        if service_name:
+            manifest_query["service_names"] = service_name
+        if log_level:
+            manifest_query["log_levels"] = log_level
+
+        manifests = await (
+            db.log_archives.find(manifest_query, {"path": 1, "end_time": 1})
+            .sort("end_time", DESCENDING)
+            .to_list()
+        )
+        found = {}
+        for index, manifest in enumerate(manifests):
+            for document in await self.load_chunk(manifest["path"]):
+                if matches(
+                    document,
+                    service_name,
+                    log_level,
+                    start_time,
+                    end_time,
+                    search,
+                    before,
+                ):
+                    # Keyed by _id so an entry archived twice is returned once
+                    found[document["_id"]] = document
+            if len(found) >= limit and index + 1 < len(manifests):
+                newest = sorted(found.values(), key=sort_key, reverse=True)
+                if newest[limit - 1]["timestamp"] > manifests[index + 1]["end_time"]:
+                    # Later chunks end before the page is full, so they cannot change it
+                    break
+        newest = sorted(found.values(), key=sort_key, reverse=True)[:limit]
+        # Copies, so callers can reshape entries without touching the chunk cache
+        return [dict(document) for document in newest]
+
+
+def sort_key(document: dict) -> Tuple[datetime, ObjectId]:
+    return document["timestamp"], document["_id"]
+
+
+# Shared archive; None when LOG_ARCHIVE_BACKEND is "none"
+store = create_archive_store()
+log_archive = LogArchive(store) if store else None
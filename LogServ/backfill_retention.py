@@ -0,0 +1,66 @@
+"""
+One-shot backfill of `expire_at` for log entries written before retention tiers.
+
+Run from the LogServ directory with the usual MongoDB environment variables:
+
+    python backfill_retention.py
+
+Entries already past their retention period expire on the TTL monitor's next pass,
+so make sure the archiver (LOG_ARCHIVE_BACKEND) has run first if they should be
+kept in the archive. Entries that already have an `expire_at` are left alone.
+"""
+
+import asyncio
+from connection import get_database
+from retention import LOG_DEFAULT_RETENTION_DAYS, RETENTION_POLICY
+from utils import ensure_indexes
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+def retention_days_expression() -> dict:
+    """The `retention_days` rule lookup as an aggregation expression"""
+    level = {"$toUpper": "$log_level"}
+    branches = []
+    # Same precedence as retention_days: service and level, service, then level
+    for (service_name, log_level), days in sorted(
+        RETENTION_POLICY.items(),
+        key=lambda rule: (rule[0][0] == "*", rule[0][1] == "*"),
+    ):
+        conditions = []
+        if service_name != "*":
+            conditions.append({"$eq": ["$service_name", service_name]})
+        if log_level != "*":
+            conditions.append({"$eq": [level, log_level]})
+        if conditions:
+            branches.append({"case": {"$and": conditions}, "then": days})
+    default = RETENTION_POLICY.get(("*", "*"), LOG_DEFAULT_RETENTION_DAYS)
+    if not branches:
+        return {"$literal": default}
+    return {"$switch": {"branches": branches, "default": default}}
+
+
+async def backfill(db):
+    await ensure_indexes(db)
+    days = retention_days_expression()
+    result = await db.logs.update_many(
+        {"expire_at": {"$exists": False}},
+        [
+            {
+                "$set": {
+                    "expire_at": {
+                        "$cond": [
+                            {"$gt": [days, 0]},
+                            {"$add": ["$timestamp", {"$multiply": [days, DAY_MS]}]},
+                            "$$REMOVE",
+                        ]
+                    }
+                }
+            }
+        ],
+    )
+    print(f"Set expire_at on {result.modified_count} log entries")
+
+
+if __name__ == "__main__":
+    asyncio.run(backfill(get_database()))
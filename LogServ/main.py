@@ -1,14 +1,53 @@
-from fastapi import FastAPI, HTTPException, Depends, Request
-from fastapi.responses import JSONResponse
-from connection import get_db
-from models import LogResponse, LogEntry
+from fastapi import FastAPI, HTTPException, Depends, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from contextlib import asynccontextmanager
+from connection import close_database, get_database, get_db
+from models import BatchLogResponse, LogResponse, LogEntry
+from datetime import datetime
 from typing import Optional
-from auth import get_current_user
-from pymongo.collection import Collection
+from utils import (
+    EXPORT_CURSOR_BATCH_SIZE,
+    LOG_WRITE_COALESCING,
+    LOGS_PAGE_SIZE,
+    MAX_LOGS_PAGE_SIZE,
+    build_log_query,
+    build_projection,
+    decode_cursor,
+    encode_cursor,
+    ensure_indexes,
+    export_logs,
+    insert_entries,
+    iter_ndjson_batches,
+    validate_entries,
+    write_buffer,
+)
+from auth import ADMIN_USERNAMES, get_current_user
+from rollups import GRANULARITIES, query_rollups, record_rollups
+from retention import apply_retention
+from archive import log_archive, sort_key
+from pymongo import ASCENDING, DESCENDING
+from pymongo.asynchronous.database import AsyncDatabase
 import logging
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create indexes once at startup rather than on the request path
+    db = get_database()
+    await ensure_indexes(db)
+    if log_archive:
+        await log_archive.ensure_indexes(db)
+        log_archive.start(db)
+    yield
+    if log_archive:
+        await log_archive.stop()
+    # Write out anything still waiting in the coalescing buffer
+    await write_buffer.drain()
+    await close_database()
+
+
 # App Initialization
-app = FastAPI(title="Logging Service")
+app = FastAPI(title="Logging Service", lifespan=lifespan)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -17,44 +56,197 @@ logger = logging.getLogger(__name__)
 
 # Routes
 @app.post("/log/", response_model=LogResponse)
-async def log_entry(entry: LogEntry, db: Collection = Depends(get_db)):
-    entry_dict = entry.dict()
+async def log_entry(entry: LogEntry, db: AsyncDatabase = Depends(get_db)):
+    entry_dict = apply_retention(entry.dict())
     logs_collection = db.logs
     username = entry_dict.get("username")
     try:
-        result = logs_collection.insert_one(entry_dict)
+        if LOG_WRITE_COALESCING:
+            await write_buffer.write(db, entry_dict)
+        else:
+            await logs_collection.insert_one(entry_dict)
+            await record_rollups(db.log_rollups, [entry_dict])
         return LogResponse(message="Log entry created successfully")
     except Exception as e:
         logger.error(f"Error creating log entry for user {username}: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
 
+@app.post("/logs/batch", response_model=BatchLogResponse)
+async def log_batch(request: Request, db: AsyncDatabase = Depends(get_db)):
+    """Ingest a JSON array of log entries, or NDJSON streamed as the request body"""
+    accepted = rejected = 0
+
+    async def ingest(items):
+        nonlocal accepted, rejected
+        documents, invalid = validate_entries(items)
+        inserted = await insert_entries(db, documents)
+        accepted += inserted
+        rejected += invalid + len(documents) - inserted
+
+    try:
+        if "ndjson" in request.headers.get("content-type", ""):
+            # Insert as lines arrive so the body is never fully buffered
+            async for batch in iter_ndjson_batches(request.stream()):
+                await ingest(batch)
+        else:
+            try:
+                body = await request.json()
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid JSON body")
+            if not isinstance(body, list):
+                raise HTTPException(
+                    status_code=400, detail="Expected a JSON array of log entries"
+                )
+            await ingest(body)
+        return BatchLogResponse(accepted=accepted, rejected=rejected)
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        logger.error(f"Error ingesting log batch: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+
+
 @app.get("/logs/")
 async def get_logs(
     service_name: Optional[str] = None,
     log_level: Optional[str] = None,
-    db: Collection = Depends(get_db),
+    start_time: Optional[datetime] = None,
+    end_time: Optional[datetime] = None,
+    q: Optional[str] = Query(None, description="Free-text search over messages"),
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return"),
+    limit: int = Query(LOGS_PAGE_SIZE, ge=1, le=MAX_LOGS_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    db: AsyncDatabase = Depends(get_db),
     user: dict = Depends(get_current_user),
 ):
+    """Query a user's logs newest first; pass `next_cursor` back to get the next page"""
     username = user.get("username")
-    query = {}
-    if service_name:
-        query["service_name"] = service_name
-    if log_level:
-        query["log_level"] = log_level
+    try:
+        query = build_log_query(
+            username, service_name, log_level, start_time, end_time, q, cursor
+        )
+        projection = build_projection(fields)
+        before = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if log_archive:
+        # Archived entries are read from their chunks below, not from hot storage
+        query["archived"] = {"$ne": True}
 
-    query["username"] = username
     logs_collection = db.logs
     try:
-        logs = await logs_collection.find(query).to_list(
-            20
-        )  # Limit to 20 logs per request
-        return {"logs": logs}
+        logs = await (
+            logs_collection.find(query, projection)
+            .sort([("timestamp", DESCENDING), ("_id", DESCENDING)])
+            .limit(limit)
+            .to_list()
+        )
+        if log_archive:
+            archived = await log_archive.find(
+                db,
+                username,
+                limit,
+                service_name,
+                log_level,
+                start_time,
+                end_time,
+                q,
+                before,
+                # A full page of hot entries only needs archives that reach into it
+                newer_than=logs[-1]["timestamp"] if len(logs) == limit else None,
+            )
+            if archived:
+                logs = sorted(logs + archived, key=sort_key, reverse=True)[:limit]
+                if fields:
+                    logs = [
+                        {key: value for key, value in log.items() if key in projection}
+                        for log in logs
+                    ]
+        next_cursor = encode_cursor(logs[-1]) if len(logs) == limit else None
+        for log in logs:
+            log.pop("_id", None)
+        return {"logs": logs, "next_cursor": next_cursor}
     except Exception as e:
         logger.error(f"Error retrieving logs for user {username}: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
 
+@app.get("/logs/export")
+async def export_log_history(
+    export_format: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$"),
+    compress: bool = Query(True, description="gzip the response while streaming"),
+    service_name: Optional[str] = None,
+    log_level: Optional[str] = None,
+    start_time: Optional[datetime] = None,
+    end_time: Optional[datetime] = None,
+    q: Optional[str] = None,
+    username: Optional[str] = Query(None, description="Admins only: another user"),
+    all_users: bool = Query(False, description="Admins only: every user's logs"),
+    db: AsyncDatabase = Depends(get_db),
+    user: dict = Depends(get_current_user),
+):
+    """Stream the full matching log history, oldest first, straight from the cursor"""
+    current_username = user.get("username")
+    if (username or all_users) and current_username not in ADMIN_USERNAMES:
+        raise HTTPException(status_code=403, detail="Administrator access required")
+    export_username = None if all_users else username or current_username
+    if q and export_username is None:
+        raise HTTPException(
+            status_code=400, detail="Text search requires a single username"
+        )
+
+    query = build_log_query(
+        export_username, service_name, log_level, start_time, end_time, q
+    )
+    documents = (
+        db.logs.find(query, build_projection(None))
+        .sort([("timestamp", ASCENDING), ("_id", ASCENDING)])
+        .batch_size(EXPORT_CURSOR_BATCH_SIZE)
+    )
+    media_type = "text/csv" if export_format == "csv" else "application/x-ndjson"
+    headers = {"Content-Disposition": f'attachment; filename="logs.{export_format}"'}
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    logger.info(f"User {current_username} exporting logs as {export_format}")
+    return StreamingResponse(
+        export_logs(documents, export_format, compress),
+        media_type=media_type,
+        headers=headers,
+    )
+
+
+@app.get("/logs/rollups")
+async def get_log_rollups(
+    start_time: datetime,
+    end_time: Optional[datetime] = None,
+    granularity: str = Query("hour", pattern=f"^({'|'.join(GRANULARITIES)})$"),
+    service_name: Optional[str] = None,
+    log_level: Optional[str] = None,
+    all_users: bool = Query(False, description="Admins only: every user's counts"),
+    db: AsyncDatabase = Depends(get_db),
+    user: dict = Depends(get_current_user),
+):
+    """Log counts per time bucket, service and level, read from the rollup counters"""
+    username = user.get("username")
+    if all_users and username not in ADMIN_USERNAMES:
+        raise HTTPException(status_code=403, detail="Administrator access required")
+    try:
+        series = await query_rollups(
+            db.log_rollups,
+            granularity,
+            start_time,
+            end_time or datetime.utcnow(),
+            None if all_users else username,
+            service_name,
+            log_level,
+        )
+        return {"granularity": granularity, "series": series}
+    except Exception as e:
+        logger.error(f"Error retrieving log rollups for user {username}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+
+
 # Custom exception handler for general exceptions
 @app.exception_handler(Exception)
 async def general_exception_handler(request: Request, exc: Exception):
@@ -16,3 +16,8 @@ class LogEntry(Log):
 
 class LogResponse(BaseModel):
     message: str
+
+
+class BatchLogResponse(BaseModel):
+    accepted: int
+    rejected: int
@@ -0,0 +1,53 @@
+from pymongo.asynchronous.database import AsyncDatabase
+from datetime import datetime, timedelta
+from typing import Dict, Tuple
+import os
+import dotenv
+
+# Load environment variables from .env file
+dotenv.load_dotenv()
+
+# Comma-separated `[service_name:]LOG_LEVEL=days` rules; `*` matches anything and
+# 0 days keeps matching entries forever
+LOG_RETENTION_POLICY = os.getenv(
+    "LOG_RETENTION_POLICY", "DEBUG=3,INFO=30,WARNING=30,ERROR=90,CRITICAL=90"
+)
+LOG_DEFAULT_RETENTION_DAYS = int(os.getenv("LOG_DEFAULT_RETENTION_DAYS", "30"))
+
+
+def parse_retention_policy(spec: str) -> Dict[Tuple[str, str], int]:
+    """Parse retention rules into {(service_name, log_level): days}"""
+    policy = {}
+    for rule in filter(None, (rule.strip() for rule in spec.split(","))):
+        target, _, days = rule.partition("=")
+        service_name, _, log_level = target.rpartition(":")
+        key = (service_name.strip() or "*", log_level.strip().upper() or "*")
+        policy[key] = int(days)
+    return policy
+
+
+RETENTION_POLICY = parse_retention_policy(LOG_RETENTION_POLICY)
+
+
+def retention_days(service_name: str, log_level: str) -> int:
+    """Days an entry stays in hot storage; the most specific matching rule wins"""
+    log_level = (log_level or "").upper()
+    for key in ((service_name, log_level), (service_name, "*"), ("*", log_level)):
+        if key in RETENTION_POLICY:
+            return RETENTION_POLICY[key]
+    return RETENTION_POLICY.get(("*", "*"), LOG_DEFAULT_RETENTION_DAYS)
+
+
+def apply_retention(document: dict) -> dict:
+    """Stamp a log document with the `expire_at` its TTL index deletes it at"""
+    days = retention_days(document.get("service_name"), document.get("log_level"))
+    if days > 0:
+        timestamp = document.get("timestamp") or datetime.utcnow()
+        document["expire_at"] = timestamp + timedelta(days=days)
+    return document
+
+
+async def ensure_retention_indexes(db: AsyncDatabase):
+    """Create the TTL index that removes log entries once they pass `expire_at`"""
+    # The per-entry expiry lets one TTL index enforce every retention tier
+    await db.logs.create_index("expire_at", expireAfterSeconds=0)
@@ -0,0 +1,167 @@
+from pymongo import ASCENDING, UpdateOne
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.asynchronous.database import AsyncDatabase
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional
+import logging
+import os
+import dotenv
+
+# Load environment variables from .env file
+dotenv.load_dotenv()
+
+# Constants
+GRANULARITIES = ("minute", "hour")
+# Days each granularity's counters are kept before the TTL index removes them;
+# 0 keeps them forever
+ROLLUP_RETENTION_DAYS = {
+    "minute": int(os.getenv("LOG_ROLLUP_MINUTE_RETENTION_DAYS", "7")),
+    "hour": int(os.getenv("LOG_ROLLUP_HOUR_RETENTION_DAYS", "365")),
+}
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def truncate(timestamp: datetime, granularity: str) -> datetime:
+    """Round a timestamp down to the start of its minute or hour bucket"""
+    if granularity == "hour":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(second=0, microsecond=0)
+
+
+async def ensure_rollup_indexes(db: AsyncDatabase):
+    """Create the indexes that rollup upserts and time-series queries rely on"""
+    # One counter document per (user, service, level, granularity, bucket)
+    await db.log_rollups.create_index(
+        [
+            ("username", ASCENDING),
+            ("granularity", ASCENDING),
+            ("service_name", ASCENDING),
+            ("log_level", ASCENDING),
+            ("bucket", ASCENDING),
+        ],
+        unique=True,
+    )
+    # Service-wide dashboards that span every user
+    await db.log_rollups.create_index(
+        [
+            ("granularity", ASCENDING),
+            ("service_name", ASCENDING),
+            ("log_level", ASCENDING),
+            ("bucket", ASCENDING),
+        ]
+    )
+    # Each counter carries its own expiry, so one TTL index covers both tiers
+    await db.log_rollups.create_index("expire_at", expireAfterSeconds=0)
+    for granularity, days in ROLLUP_RETENTION_DAYS.items():
+        if days <= 0:
+            continue
+        # Counters written before expiry was stamped would otherwise live forever
+        await db.log_rollups.update_many(
+            {"granularity": granularity, "expire_at": {"$exists": False}},
+            [
+                {
+                    "$set": {
+                        "expire_at": {"$add": ["$bucket", days * 24 * 60 * 60 * 1000]}
+                    }
+                }
+            ],
+        )
+
+
+async def record_rollups(collection: AsyncCollection, documents: Iterable[dict]):
+    """
+    Increment the per-minute and per-hour counters for newly ingested log entries.
+
+    Entries are counted in memory first, so a batch costs one bulk_write with one
+    upsert per distinct counter rather than one write per entry.
+    """
+    counts = Counter()
+    for document in documents:
+        timestamp = document.get("timestamp") or datetime.utcnow()
+        for granularity in GRANULARITIES:
+            key = (
+                document["username"],
+                granularity,
+                document["service_name"],
+                document["log_level"],
+                truncate(timestamp, granularity),
+            )
+            counts[key] += 1
+    if not counts:
+        return
+    operations = []
+    for key, count in counts.items():
+        username, granularity, service_name, log_level, bucket = key
+        update = {"$inc": {"count": count}}
+        days = ROLLUP_RETENTION_DAYS[granularity]
+        if days > 0:
+            update["$setOnInsert"] = {"expire_at": bucket + timedelta(days=days)}
+        operations.append(
+            UpdateOne(
+                {
+                    "username": username,
+                    "granularity": granularity,
+                    "service_name": service_name,
+                    "log_level": log_level,
+                    "bucket": bucket,
+                },
+                update,
+                upsert=True,
+            )
+        )
+    try:
+        await collection.bulk_write(operations, ordered=False)
+    except Exception as e:
+        # Rollups are derived data; a failure must not fail log ingestion
+        logger.error(f"Error updating log rollups: {str(e)}")
+
+
+async def query_rollups(
+    collection: AsyncCollection,
+    granularity: str,
+    start_time: datetime,
+    end_time: datetime,
+    username: Optional[str] = None,
+    service_name: Optional[str] = None,
+    log_level: Optional[str] = None,
+) -> List[dict]:
+    """Sum rollup counters into a time series of (bucket, service, level) counts"""
+    match = {
+        "granularity": granularity,
+        "bucket": {"$gte": truncate(start_time, granularity), "$lt": end_time},
+    }
+    if username:
+        match["username"] = username
+    if service_name:
+        match["service_name"] = service_name
+    if log_level:
+        match["log_level"] = log_level
+    pipeline = [
+        {"$match": match},
+        {
+            "$group": {
+                "_id": {
+                    "bucket": "$bucket",
+                    "service_name": "$service_name",
+                    "log_level": "$log_level",
+                },
+                "count": {"$sum": "$count"},
+            }
+        },
+        {"$sort": {"_id.bucket": 1, "_id.service_name": 1, "_id.log_level": 1}},
+        {
+            "$project": {
+                "_id": 0,
+                "bucket": "$_id.bucket",
+                "service_name": "$_id.service_name",
+                "log_level": "$_id.log_level",
+                "count": 1,
+            }
+        },
+    ]
+    cursor = await collection.aggregate(pipeline)
+    return await cursor.to_list()
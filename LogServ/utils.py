@@ -0,0 +1,327 @@
+from pymongo import ASCENDING, DESCENDING, TEXT
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.asynchronous.database import AsyncDatabase
+from pymongo.errors import BulkWriteError
+from pydantic import ValidationError
+from bson import ObjectId
+from bson.errors import InvalidId
+from datetime import datetime, timezone
+from typing import AsyncIterator, Iterable, List, Optional, Tuple
+from models import LogEntry
+from rollups import ensure_rollup_indexes, record_rollups
+from retention import apply_retention, ensure_retention_indexes
+import asyncio
+import base64
+import csv
+import io
+import json
+import zlib
+import logging
+import os
+import dotenv
+
+# Load environment variables from .env file
+dotenv.load_dotenv()
+
+# Constants
+INSERT_BATCH_SIZE = 1000  # Documents per insert_many call
+LOG_WRITE_COALESCING = os.getenv("LOG_WRITE_COALESCING", "false").lower() == "true"
+LOG_COALESCE_MAX_BATCH = int(os.getenv("LOG_COALESCE_MAX_BATCH", "500"))
+LOG_COALESCE_MAX_DELAY_MS = int(os.getenv("LOG_COALESCE_MAX_DELAY_MS", "5"))
+LOGS_PAGE_SIZE = 20  # Default number of logs returned per query page
+MAX_LOGS_PAGE_SIZE = 500
+LOG_FIELDS = set(LogEntry.model_fields)  # Fields that may be requested in a projection
+INTERNAL_FIELDS = {"expire_at": 0, "archived": 0}  # Storage-only fields never returned
+EXPORT_FIELDS = list(LogEntry.model_fields)  # Column order for CSV exports
+EXPORT_CHUNK_SIZE = 64 * 1024  # Bytes buffered before each write to the response
+EXPORT_CURSOR_BATCH_SIZE = 1000  # Documents fetched per cursor round trip
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def ensure_indexes(db: AsyncDatabase):
+    """Create the indexes that log queries rely on"""
+    # _id is the keyset tie-breaker, so it is part of every sort index
+    await db.logs.create_index(
+        [("username", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)]
+    )
+    await db.logs.create_index(
+        [
+            ("username", ASCENDING),
+            ("service_name", ASCENDING),
+            ("log_level", ASCENDING),
+            ("timestamp", DESCENDING),
+            ("_id", DESCENDING),
+        ]
+    )
+    # Service-wide exports that are not scoped to one user
+    await db.logs.create_index([("service_name", ASCENDING), ("timestamp", DESCENDING)])
+    # Text search is always scoped to one user, so username prefixes the text index
+    await db.logs.create_index([("username", ASCENDING), ("message", TEXT)])
+    await ensure_rollup_indexes(db)
+    await ensure_retention_indexes(db)
+
+
+def encode_cursor(document: dict) -> str:
+    """Encode the sort key of the last returned log as an opaque cursor"""
+    key = {"t": document["timestamp"].isoformat(), "id": str(document["_id"])}
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, ObjectId]:
+    """Decode a cursor from `encode_cursor`; raises ValueError if it is malformed"""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(key["t"]), ObjectId(key["id"])
+    except (KeyError, TypeError, ValueError, InvalidId) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+
+
+def naive_utc(moment: Optional[datetime]) -> Optional[datetime]:
+    """
+    Convert a query bound to the naive UTC that stored timestamps use; query
+    parameters such as `...Z` parse as timezone-aware.
+    """
+    if moment is None or moment.tzinfo is None:
+        return moment
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def build_log_query(
+    username: Optional[str],
+    service_name: Optional[str] = None,
+    log_level: Optional[str] = None,
+    start_time: Optional[datetime] = None,
+    end_time: Optional[datetime] = None,
+    search: Optional[str] = None,
+    cursor: Optional[str] = None,
+) -> dict:
+    """Build a logs filter that matches the compound indexes, newest first"""
+    start_time, end_time = naive_utc(start_time), naive_utc(end_time)
+    query = {"username": username} if username else {}
+    if service_name:
+        query["service_name"] = service_name
+    if log_level:
+        query["log_level"] = log_level
+    if start_time or end_time:
+        query["timestamp"] = {}
+        if start_time:
+            query["timestamp"]["$gte"] = start_time
+        if end_time:
+            query["timestamp"]["$lt"] = end_time
+    if search:
+        query["$text"] = {"$search": search}
+    if cursor:
+        timestamp, last_id = decode_cursor(cursor)
+        # Resume strictly after the last (timestamp, _id) returned
+        query["$or"] = [
+            {"timestamp": {"$lt": timestamp}},
+            {"timestamp": timestamp, "_id": {"$lt": last_id}},
+        ]
+    return query
+
+
+def build_projection(fields: Optional[str]) -> Optional[dict]:
+    """Turn a comma-separated field list into a projection; None returns every log field"""
+    if not fields:
+        return INTERNAL_FIELDS
+    requested = {field.strip() for field in fields.split(",") if field.strip()}
+    unknown = requested - LOG_FIELDS
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    # The sort key is always returned so the next cursor can be built
+    return {field: 1 for field in requested | {"timestamp", "_id"}}
+
+
+async def export_logs(
+    documents: AsyncIterator[dict], export_format: str, compress: bool
+) -> AsyncIterator[bytes]:
+    """
+    Serialize a cursor of log documents to NDJSON or CSV, optionally gzipped.
+
+    Output is produced in EXPORT_CHUNK_SIZE pieces as documents arrive, so memory
+    use stays constant however many documents match.
+    """
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+    text = io.StringIO()
+    writer = None
+    if export_format == "csv":
+        writer = csv.DictWriter(text, fieldnames=EXPORT_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+
+    def drain(final: bool = False) -> bytes:
+        data = text.getvalue().encode()
+        text.seek(0)
+        text.truncate()
+        if compressor is None:
+            return data
+        data = compressor.compress(data)
+        return data + compressor.flush() if final else data
+
+    async for document in documents:
+        document.pop("_id", None)
+        if isinstance(document.get("timestamp"), datetime):
+            document["timestamp"] = document["timestamp"].isoformat()
+        if writer:
+            writer.writerow(document)
+        else:
+            text.write(json.dumps(document))
+            text.write("\n")
+        if text.tell() >= EXPORT_CHUNK_SIZE:
+            chunk = drain()
+            if chunk:
+                yield chunk
+    chunk = drain(final=True)
+    if chunk:
+        yield chunk
+
+
+def validate_entries(items: Iterable) -> Tuple[List[dict], int]:
+    """Validate raw log items, returning the valid documents and a rejected count"""
+    documents = []
+    rejected = 0
+    for item in items:
+        try:
+            documents.append(apply_retention(LogEntry(**item).dict()))
+        except (ValidationError, TypeError):
+            rejected += 1
+    return documents, rejected
+
+
+async def iter_ndjson_batches(
+    chunks: AsyncIterator[bytes], batch_size: int = INSERT_BATCH_SIZE
+) -> AsyncIterator[list]:
+    """Split a streamed NDJSON body into batches of decoded items (None if invalid)"""
+    buffer = b""
+    batch = []
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                batch.append(decode_json_line(line))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if buffer.strip():
+        batch.append(decode_json_line(buffer))
+    if batch:
+        yield batch
+
+
+def decode_json_line(line: bytes):
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+async def insert_entries(db: AsyncDatabase, documents: List[dict]) -> int:
+    """Insert documents with unordered insert_many; returns how many were written"""
+    inserted = 0
+    for i in range(0, len(documents), INSERT_BATCH_SIZE):
+        batch = documents[i : i + INSERT_BATCH_SIZE]
+        failed = set()
+        try:
+            await db.logs.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Unordered inserts keep going past individual failures
+            failed = {error["index"] for error in e.details.get("writeErrors", [])}
+        written = [doc for index, doc in enumerate(batch) if index not in failed]
+        await record_rollups(db.log_rollups, written)
+        inserted += len(written)
+    return inserted
+
+
+class LogWriteBuffer:
+    """
+    Coalesces concurrent single-entry writes into one insert_many (group commit).
+
+    Each caller still waits until its entry is written, but a burst of /log/ calls
+    arriving within LOG_COALESCE_MAX_DELAY_MS shares a single round trip.
+    """
+
+    def __init__(self, max_batch: int, max_delay_ms: int):
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.pending = []
+        self.db = None
+        self.timer = None
+        self.flush_scheduled = False
+        self.tasks = set()  # Flushes in flight, kept so they are not collected
+
+    async def write(self, db: AsyncDatabase, document: dict):
+        """Queue a document for the next batch and wait until it has been written"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.db = db
+        self.pending.append((document, future))
+        if len(self.pending) >= self.max_batch:
+            self.schedule_flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_delay, self.schedule_flush)
+        await future
+
+    def schedule_flush(self):
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            task = asyncio.get_running_loop().create_task(self.flush())
+            self.tasks.add(task)
+            task.add_done_callback(self.flush_done)
+
+    def flush_done(self, task: asyncio.Task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Error flushing log writes: {str(task.exception())}")
+
+    async def flush(self):
+        """Write up to max_batch pending documents in one unordered insert_many"""
+        self.flush_scheduled = False
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch = self.pending[: self.max_batch]
+        self.pending = self.pending[self.max_batch :]
+        if self.pending:
+            # More than one batch is waiting; write the rest right after this one
+            self.schedule_flush()
+        if not batch:
+            return
+        failed = {}
+        try:
+            await self.db.logs.insert_many(
+                [document for document, _ in batch], ordered=False
+            )
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                failed[error["index"]] = Exception(error.get("errmsg"))
+        except Exception as e:
+            failed = {index: e for index in range(len(batch))}
+        try:
+            await record_rollups(
+                self.db.log_rollups,
+                [doc for index, (doc, _) in enumerate(batch) if index not in failed],
+            )
+        except Exception as e:
+            # The entries are stored; a missed rollup must not fail their writers
+            logger.error(f"Error recording rollups: {str(e)}")
+        for index, (_, future) in enumerate(batch):
+            if future.done():
+                continue
+            if index in failed:
+                future.set_exception(failed[index])
+            else:
+                future.set_result(None)
+
+    async def drain(self):
+        """Flush everything still pending, e.g. at shutdown"""
+        while self.pending:
+            await self.flush()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+# Shared coalescing buffer, used by /log/ when LOG_WRITE_COALESCING is enabled
+write_buffer = LogWriteBuffer(LOG_COALESCE_MAX_BATCH, LOG_COALESCE_MAX_DELAY_MS)
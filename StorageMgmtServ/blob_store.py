@@ -0,0 +1,346 @@
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from io import BytesIO
+from typing import Dict, Iterator, Optional
+import hashlib
+import mimetypes
+import os
+import secrets
+import threading
+import dotenv
+import requests
+from models import BlobInfo
+
+# Load environment variables from .env file
+dotenv.load_dotenv()
+
+# Constants
+STREAM_CHUNK_SIZE = 1024 * 1024  # Size of each ranged read when serving a blob
+GCS_REQUEST_TIMEOUT_S = 60
+
+
+class BlobStore(ABC):
+    """Interface for the object storage that holds uploaded files"""
+
+    @abstractmethod
+    def open_writer(self, path: str, content_type: str):
+        """Open a writer with write(bytes), close() and terminate() for a new blob"""
+
+    @abstractmethod
+    def stat(self, path: str) -> Optional[BlobInfo]:
+        """Return blob metadata, or None if the blob does not exist"""
+
+    @abstractmethod
+    def iter_range(self, info: BlobInfo, start: int, end: int) -> Iterator[bytes]:
+        """Yield an inclusive byte span of a blob in chunks"""
+
+    @abstractmethod
+    def delete(self, path: str):
+        """Delete a blob, ignoring blobs that do not exist"""
+
+    def local_path(self, info: BlobInfo) -> Optional[str]:
+        """The blob's file on this machine, if it has one, so it can be sent directly"""
+        return None
+
+
+class StorageConfig:
+    def __init__(self):
+        self.credentials_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+        self.project_id = os.getenv("GCP_PROJECT_ID")
+        self.bucket_name = os.getenv("GCP_BUCKET_NAME")
+
+    def initialize_storage_client(self):
+        """Initialize Google Cloud Storage client with credentials"""
+        from google.cloud import storage
+        from google.oauth2 import service_account
+
+        try:
+            # If credentials path is provided, use it
+            if self.credentials_path:
+                credentials = service_account.Credentials.from_service_account_file(
+                    self.credentials_path,
+                    scopes=["https://www.googleapis.com/auth/cloud-platform"],
+                )
+                return storage.Client(credentials=credentials, project=self.project_id)
+            # Fall back to application default credentials
+            return storage.Client()
+
+        except Exception as e:
+            raise Exception(f"Failed to initialize storage client: {str(e)}")
+
+
+class GCSBlobWriter:
+    """
+    Resumable GCS upload; only one chunk is buffered in memory at a time.
+
+    Chunks are PUT to the upload session URL following GCS's documented
+    resumable upload protocol, so an abandoned upload can be cancelled with a
+    DELETE on the same URL and never creates an object.
+    """
+
+    def __init__(self, blob, content_type: str):
+        self.session_url = blob.create_resumable_upload_session(
+            content_type=content_type, timeout=GCS_REQUEST_TIMEOUT_S
+        )
+        # The session URL authorizes the upload, so no credentials are needed
+        self.http = requests.Session()
+        self.buffer = bytearray()
+        self.offset = 0  # Bytes GCS has persisted so far
+
+    def write(self, data: bytes):
+        self.buffer += data
+        # Non-final chunks must be a multiple of 256KiB
+        while len(self.buffer) >= STREAM_CHUNK_SIZE:
+            self.send(STREAM_CHUNK_SIZE, final=False)
+        return len(data)
+
+    def send(self, size: int, final: bool):
+        """
+        PUT the first `size` buffered bytes. Bytes GCS did not persist stay
+        buffered; they lead the next chunk, or are resent when finalizing.
+        """
+        target = self.offset + size
+        while True:
+            chunk = bytes(self.buffer[: target - self.offset])
+            span = f"{self.offset}-{self.offset + len(chunk) - 1}" if chunk else "*"
+            total = str(target) if final else "*"
+            response = self.http.put(
+                self.session_url,
+                data=chunk,
+                headers={"Content-Range": f"bytes {span}/{total}"},
+                timeout=GCS_REQUEST_TIMEOUT_S,
+            )
+            if final and response.status_code in (200, 201):
+                return
+            if response.status_code != 308:
+                raise Exception(
+                    f"GCS upload failed with status {response.status_code}: "
+                    f"{response.text}"
+                )
+            # 308 means more data is expected; Range says how much was kept
+            persisted = 0
+            if "Range" in response.headers:
+                persisted = int(response.headers["Range"].split("-")[1]) + 1
+            if persisted <= self.offset:
+                raise Exception("GCS upload made no progress")
+            del self.buffer[: persisted - self.offset]
+            self.offset = persisted
+            if not final:
+                return
+
+    def close(self):
+        try:
+            self.send(len(self.buffer), final=True)
+        finally:
+            self.http.close()
+
+    def terminate(self):
+        """Cancel the upload session so no partial object is ever finalized"""
+        try:
+            self.http.delete(self.session_url, timeout=GCS_REQUEST_TIMEOUT_S)
+        except requests.RequestException:
+            # An unfinished session expires on its own after a week
+            pass
+        finally:
+            self.http.close()
+
+
+class GCSBlobStore(BlobStore):
+    """Google Cloud Storage bucket; the client is created on first use"""
+
+    def __init__(self, config: StorageConfig = None):
+        self.config = config or StorageConfig()
+        self._bucket = None
+        self._lock = threading.Lock()
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            with self._lock:
+                if self._bucket is None:
+                    client = self.config.initialize_storage_client()
+                    self._bucket = client.bucket(self.config.bucket_name)
+        return self._bucket
+
+    def open_writer(self, path: str, content_type: str):
+        return GCSBlobWriter(self.bucket.blob(path), content_type)
+
+    def stat(self, path: str) -> Optional[BlobInfo]:
+        from google.cloud.exceptions import NotFound
+
+        blob = self.bucket.blob(path)
+        try:
+            blob.reload()
+        except NotFound:
+            return None
+        return BlobInfo(
+            path=path,
+            size=blob.size,
+            etag=blob.etag,
+            updated=blob.updated,
+            content_type=blob.content_type,
+            generation=blob.generation,
+        )
+
+    def iter_range(self, info: BlobInfo, start: int, end: int) -> Iterator[bytes]:
+        blob = self.bucket.blob(info.path)
+        position = start
+        while position <= end:
+            chunk_end = min(position + STREAM_CHUNK_SIZE - 1, end)
+            # Pin the generation so every chunk comes from the same object version
+            chunk = blob.download_as_bytes(
+                start=position, end=chunk_end, if_generation_match=info.generation
+            )
+            if not chunk:
+                break
+            position += len(chunk)
+            yield chunk
+
+    def delete(self, path: str):
+        from google.cloud.exceptions import NotFound
+
+        try:
+            self.bucket.blob(path).delete()
+        except NotFound:
+            pass
+
+
+class LocalFileWriter:
+    """Writes to a temporary file that is atomically renamed into place on close"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.temp_path = f"{path}.{secrets.token_hex(8)}.part"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(self.temp_path, "wb")
+
+    def write(self, data: bytes):
+        return self.file.write(data)
+
+    def close(self):
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+
+    def terminate(self):
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+
+class LocalBlobStore(BlobStore):
+    """Blobs stored as files under a root directory, e.g. a local SSD"""
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _resolve(self, path: str) -> str:
+        full_path = os.path.abspath(os.path.join(self.root, path))
+        if os.path.commonpath([self.root, full_path]) != self.root:
+            raise ValueError(f"Blob path escapes storage root: {path}")
+        return full_path
+
+    def open_writer(self, path: str, content_type: str):
+        return LocalFileWriter(self._resolve(path))
+
+    def stat(self, path: str) -> Optional[BlobInfo]:
+        try:
+            st = os.stat(self._resolve(path))
+        except FileNotFoundError:
+            return None
+        return BlobInfo(
+            path=path,
+            size=st.st_size,
+            etag=f"{st.st_size:x}-{st.st_mtime_ns:x}",
+            updated=datetime.fromtimestamp(st.st_mtime, tz=timezone.utc),
+            content_type=mimetypes.guess_type(path)[0],
+        )
+
+    def iter_range(self, info: BlobInfo, start: int, end: int) -> Iterator[bytes]:
+        with open(self._resolve(info.path), "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(STREAM_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def local_path(self, info: BlobInfo) -> Optional[str]:
+        return self._resolve(info.path)
+
+    def delete(self, path: str):
+        try:
+            os.remove(self._resolve(path))
+        except FileNotFoundError:
+            pass
+
+
+class MemoryFileWriter:
+    """Buffers a blob in memory and publishes it to the store on close"""
+
+    def __init__(self, store, path: str, content_type: str):
+        self.store = store
+        self.path = path
+        self.content_type = content_type
+        self.buffer = BytesIO()
+
+    def write(self, data: bytes):
+        return self.buffer.write(data)
+
+    def close(self):
+        data = self.buffer.getvalue()
+        self.buffer.close()
+        self.store.blobs[self.path] = (
+            BlobInfo(
+                path=self.path,
+                size=len(data),
+                etag=hashlib.md5(data).hexdigest(),
+                updated=datetime.now(timezone.utc),
+                content_type=self.content_type,
+            ),
+            data,
+        )
+
+    def terminate(self):
+        self.buffer.close()
+
+
+class MemoryBlobStore(BlobStore):
+    """Process-local blob store for tests and offline load testing"""
+
+    def __init__(self):
+        self.blobs: Dict[str, tuple] = {}
+
+    def open_writer(self, path: str, content_type: str):
+        return MemoryFileWriter(self, path, content_type)
+
+    def stat(self, path: str) -> Optional[BlobInfo]:
+        entry = self.blobs.get(path)
+        return entry[0] if entry else None
+
+    def iter_range(self, info: BlobInfo, start: int, end: int) -> Iterator[bytes]:
+        entry = self.blobs.get(info.path)
+        if entry is None:
+            return
+        view = memoryview(entry[1])
+        for position in range(start, min(end, len(view) - 1) + 1, STREAM_CHUNK_SIZE):
+            yield bytes(view[position : min(position + STREAM_CHUNK_SIZE, end + 1)])
+
+    def delete(self, path: str):
+        self.blobs.pop(path, None)
+
+
+def create_blob_store() -> BlobStore:
+    """Create the blob store selected by the STORAGE_BACKEND environment variable"""
+    backend = os.getenv("STORAGE_BACKEND", "gcs").lower()
+    if backend == "gcs":
+        return GCSBlobStore()
+    if backend == "local":
+        return LocalBlobStore(os.getenv("LOCAL_STORAGE_ROOT", "./blob-data"))
+    if backend == "memory":
+        return MemoryBlobStore()
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
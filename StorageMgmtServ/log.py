@@ -1,3 +1,6 @@
+from datetime import datetime
+from service_client import service_client
+import asyncio
 import httpx
 import dotenv
 import os
@@ -7,6 +10,127 @@ dotenv.load_dotenv()
 
 url = os.getenv("LOG_URL")
 
+# Shipping configuration
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "100"))
+LOG_FLUSH_INTERVAL_MS = int(os.getenv("LOG_FLUSH_INTERVAL_MS", "1000"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_MAX_RETRIES = int(os.getenv("LOG_MAX_RETRIES", "3"))
+LOG_RETRY_BACKOFF_MS = int(os.getenv("LOG_RETRY_BACKOFF_MS", "200"))
+LOG_SHUTDOWN_TIMEOUT_S = float(os.getenv("LOG_SHUTDOWN_TIMEOUT_S", "5"))
+LOG_TIMEOUT_S = float(os.getenv("LOG_TIMEOUT_S", "5"))
+# When the queue is full: "drop_oldest" evicts the oldest entry, "drop_newest"
+# discards the incoming one
+LOG_OVERFLOW_POLICY = os.getenv("LOG_OVERFLOW_POLICY", "drop_oldest")
+
+
+class LogShipper:
+    """Queues log entries in-process and ships them to LogServ in background batches"""
+
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+        # Retries with backoff and jitter are left to the shared client
+        self.target = service_client.target(
+            "log",
+            url,
+            timeout_s=LOG_TIMEOUT_S,
+            max_retries=LOG_MAX_RETRIES,
+            retry_backoff_ms=LOG_RETRY_BACKOFF_MS,
+        )
+        self.task = None
+        self.stats = {"enqueued": 0, "sent": 0, "dropped": 0, "failed": 0}
+
+    def start(self):
+        """Start the background flush task"""
+        if self.task is not None:
+            return
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Drain queued entries, then stop the flush task"""
+        if self.task is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), LOG_SHUTDOWN_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            print(f"Log shipper shutdown timed out with {self.queue.qsize()} queued")
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    def enqueue(self, log_entry: dict):
+        """Queue an entry without blocking; applies the overflow policy when full"""
+        if self.task is None:
+            try:
+                # Started lazily when used outside of an app lifespan
+                self.start()
+            except RuntimeError:
+                # No running event loop, so nothing could ever ship this entry
+                self.stats["dropped"] += 1
+                return
+        try:
+            self.queue.put_nowait(log_entry)
+        except asyncio.QueueFull:
+            if LOG_OVERFLOW_POLICY != "drop_oldest":
+                self.stats["dropped"] += 1
+                return
+            self.queue.get_nowait()
+            self.queue.task_done()
+            self.queue.put_nowait(log_entry)
+            self.stats["dropped"] += 1
+        self.stats["enqueued"] += 1
+
+    async def run(self):
+        """Collect entries into batches, flushing on batch size or flush interval"""
+        flush_interval = LOG_FLUSH_INTERVAL_MS / 1000
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + flush_interval
+            while len(batch) < LOG_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self.ship(batch)
+            except Exception as e:
+                self.stats["failed"] += len(batch)
+                print(f"Failed to send log batch: {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def ship(self, batch: list):
+        """Send a batch; the shared client retries it only on connection errors"""
+        sent = await self.post(batch)
+        self.stats["sent"] += sent
+        if sent < len(batch):
+            self.stats["failed"] += len(batch) - sent
+            print(f"Failed to send {len(batch) - sent} log entries")
+
+    async def post(self, batch: list) -> int:
+        """POST the batch to LogServ in one request; returns the entries it accepted"""
+        try:
+            # Not idempotent: after a read timeout or 5xx LogServ may already have
+            # stored the batch, and resending it would store every entry twice
+            response = await self.target.request("POST", "/logs/batch", json=batch)
+        except httpx.HTTPError:
+            return 0
+        # A 4xx means the batch itself was refused; resending it would not help
+        if response.status_code >= 400:
+            return 0
+        # Entries LogServ rejected during validation are not retried
+        return len(batch) - response.json().get("rejected", 0)
+
+
+log_shipper = LogShipper()
+
 
 def send_log(username, service_name, log_level, message):
     log_entry = {
@@ -14,8 +138,10 @@ def send_log(username, service_name, log_level, message):
         "service_name": service_name,
         "log_level": log_level,
         "message": message,
+        # Stamped here since the entry may reach LogServ a flush interval later
+        "timestamp": datetime.utcnow().isoformat(),
     }
     try:
-        httpx.post(f"{url}/log/", json=log_entry)
+        log_shipper.enqueue(log_entry)
     except Exception as e:
         print(f"Failed to send log: {e}")
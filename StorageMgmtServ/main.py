@@ -1,18 +1,88 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Depends, Header
+from fastapi import (
+    FastAPI,
+    HTTPException,
+    UploadFile,
+    File,
+    Depends,
+    Header,
+    Query,
+    Response,
+)
 from fastapi.middleware.cors import CORSMiddleware
-from pymongo.collection import Collection
+from fastapi.responses import RedirectResponse
+from pymongo.asynchronous.database import AsyncDatabase
+from contextlib import asynccontextmanager
 from datetime import datetime
-from connection import get_db
+from connection import close_database, get_database, get_db
 from auth import get_current_user
-from log import send_log
-from fastapi.responses import StreamingResponse
-from io import BytesIO
-from models import FileMetadata, StorageStatus
-from utils import storage_manager, BYTES_PER_MB, STORAGE_LIMIT_MB, check_bandwidth
+from log import log_shipper, send_log
+from email.utils import format_datetime
+from starlette.concurrency import run_in_threadpool
+from typing import Literal, Optional
+from urllib.parse import quote
+from models import FileMetadata, FilePage, StorageStatus
+from ranges import if_range_matches, parse_range_header, range_response, served_bytes
+from utils import (
+    storage_manager,
+    BYTES_PER_MB,
+    FILES_PAGE_SIZE,
+    MAX_FILES_PAGE_SIZE,
+    content_path,
+    storage_percentage,
+    upload_rate_limits,
+)
+from quotas import quota_policies
+from usage_client import usage_client
+from service_client import service_client
+from thumbnails import (
+    PREVIEW_CONTENT_TYPE,
+    SPRITE_COLUMNS,
+    SPRITE_ROWS,
+    preview_path,
+    thumbnail_worker,
+)
+from transcoding import (
+    DASH_MANIFEST,
+    HLS_MANIFEST,
+    asset_content_type,
+    get_package,
+    has_asset,
+    package_prefix,
+    package_version,
+    packaging_worker,
+)
+
+# Responses whose URL names the content version never change
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+# Unversioned URLs can be reused for new content after a delete and re-upload
+THUMBNAIL_REVALIDATE_CACHE_CONTROL = "private, max-age=300"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create indexes once at startup rather than on the request path
+    db = get_database()
+    await storage_manager.ensure_indexes(db)
+    # Policies are cached so quota checks never wait on the database
+    await quota_policies.load(db)
+    quota_policies.start(db)
+    service_client.start()
+    log_shipper.start()
+    thumbnail_worker.start(storage_manager.blob_store)
+    packaging_worker.start(db, storage_manager.blob_store)
+    yield
+    await packaging_worker.stop()
+    await thumbnail_worker.stop()
+    await quota_policies.stop()
+    # Drain queued log entries before shutting down
+    await log_shipper.stop()
+    # Closed last since everything above may still call other services
+    await service_client.stop()
+    await close_database()
 
 
 # Initialize FastAPI app
-app = FastAPI(title="Storage Management Service")
+app = FastAPI(title="Storage Management Service", lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -26,13 +96,16 @@ app.add_middleware(
 
 @app.get("/storage/status/", response_model=StorageStatus)
 async def get_storage_status(
-    db: Collection = Depends(get_db), user: dict = Depends(get_current_user)
+    db: AsyncDatabase = Depends(get_db), user: dict = Depends(get_current_user)
 ):
     username = user.get("username")
     """Get storage status for a user"""
     try:
+        policy = quota_policies.get(username)
         user_storage = await storage_manager.get_user_storage(db.userstorage, username)
-        should_alert = await storage_manager.should_alert(db.userstorage, username)
+        # Only the first page of files is embedded; next_cursor continues the
+        # listing through /storage/files/
+        files, next_cursor = await storage_manager.list_files(db.files, username)
 
         send_log(
             username, "StorageMgmtServ", "INFO", "Storage status retrieved successfully"
@@ -40,11 +113,12 @@ async def get_storage_status(
         return StorageStatus(
             username=username,
             current_usage_mb=user_storage.current_usage_mb,
-            storage_limit_mb=STORAGE_LIMIT_MB,
-            available_space_mb=STORAGE_LIMIT_MB - user_storage.current_usage_mb,
-            usage_percentage=(user_storage.current_usage_mb / STORAGE_LIMIT_MB) * 100,
-            should_alert=should_alert,
-            files=user_storage.files,
+            storage_limit_mb=policy.storage_limit_mb,
+            available_space_mb=policy.storage_limit_mb - user_storage.current_usage_mb,
+            usage_percentage=storage_percentage(user_storage, policy),
+            should_alert=storage_manager.should_alert(user_storage, policy),
+            files=files,
+            next_cursor=next_cursor,
         )
     except Exception as e:
         send_log(
@@ -59,62 +133,118 @@ async def get_storage_status(
 @app.post("/storage/upload/")
 async def upload_file(
     file: UploadFile = File(...),
-    db: Collection = Depends(get_db),
+    db: AsyncDatabase = Depends(get_db),
     user: dict = Depends(get_current_user),
     authorization: str = Header(None),
 ):
     username = user.get("username")  # Get username from token
     """Upload a file to user's storage"""
     try:
-        # Read file into memory to get size
-        contents = await file.read()
-        file_size_mb = len(contents) / BYTES_PER_MB
+        # The multipart parser spools the upload and records its size, so the
+        # declared size can be checked before any bytes are sent to the blob store
+        declared_size_mb = (file.size or 0) / BYTES_PER_MB
+        policy = quota_policies.get(username)
+
+        if policy.upload_rate_per_minute and not upload_rate_limits.allow(
+            username, policy.upload_rate_per_minute, policy.upload_burst
+        ):
+            send_log(username, "StorageMgmtServ", "ERROR", "Upload rate limit exceeded")
+            raise HTTPException(
+                status_code=429,
+                detail="Too many uploads. Please try again later.",
+                headers={
+                    "Retry-After": str(int(60 / policy.upload_rate_per_minute) + 1)
+                },
+            )
 
         # Validate file
-        mime_type = storage_manager.validate_file(file, file_size_mb)
+        mime_type = storage_manager.validate_file(
+            file, declared_size_mb, policy.max_file_size_mb
+        )
 
-        await check_bandwidth(
-            username, file_size_mb, operation_type="upload", token=authorization
+        if await storage_manager.get_file(db.files, username, file.filename):
+            send_log(username, "StorageMgmtServ", "ERROR", "File already exists")
+            raise HTTPException(status_code=409, detail="File already exists")
+
+        # Hold storage and bandwidth for the declared size before sending any bytes
+        storage_reservation = await storage_manager.reserve_storage(
+            db.userstorage, username, declared_size_mb, policy
         )
-        # Check if user can upload
-        if not await storage_manager.can_upload(db.userstorage, username, file_size_mb):
+        if storage_reservation is None:
             send_log(username, "StorageMgmtServ", "ERROR", "Storage limit exceeded")
             raise HTTPException(
                 status_code=400,
                 detail="Storage limit exceeded. Please free up space before uploading.",
             )
+        bandwidth_reservation = None
+        claimed_digest = None  # Set while this upload holds a blob reference
+        try:
+            bandwidth_reservation = await usage_client.reserve(
+                authorization, declared_size_mb, "upload"
+            )
 
-        # Upload to Google Cloud Storage
-        blob_name = f"users/{username}/{datetime.utcnow().timestamp()}_{file.filename}"
-        blob = storage_manager.bucket.blob(blob_name)
-        blob.upload_from_string(contents, content_type=mime_type)
-
-        # Update MongoDB
-        file_metadata = FileMetadata(
-            filename=file.filename,
-            size_mb=file_size_mb,
-            uploaded_at=datetime.utcnow(),
-            mime_type=mime_type,
-            file_path=blob_name,
-        )
-        collection = db.userstorage
-        collection.update_one(
-            {"username": username},
-            {
-                "$push": {"files": file_metadata.dict()},
-                "$inc": {"current_usage_mb": file_size_mb},
-                "$set": {"last_updated": datetime.utcnow()},
-            },
-        )
+            # Hash the spooled upload first; content already stored is not re-sent
+            digest, file_size_mb = await storage_manager.hash_upload(
+                file, declared_size_mb, policy.max_file_size_mb
+            )
+            blob_name = content_path(digest)
+            must_write = await storage_manager.claim_blob(db, digest)
+            claimed_digest = digest
+            if must_write:
+                await storage_manager.upload_stream(file, blob_name, mime_type)
+                await storage_manager.mark_blob_ready(db, digest)
+
+            # Charge the file and settle the storage reservation in one update
+            file_metadata = FileMetadata(
+                filename=file.filename,
+                size_mb=file_size_mb,
+                uploaded_at=datetime.utcnow(),
+                mime_type=mime_type,
+                file_path=blob_name,
+                sha256=digest,
+            )
+            user_storage = await storage_manager.add_file(
+                db, username, file_metadata, storage_reservation
+            )
+            if user_storage is None:
+                # Lost a race with a concurrent upload of the same filename
+                send_log(username, "StorageMgmtServ", "ERROR", "File already exists")
+                raise HTTPException(status_code=409, detail="File already exists")
+        except Exception:
+            # Nothing was stored, so neither reservation should be charged
+            await storage_manager.release_storage(
+                db.userstorage, username, storage_reservation
+            )
+            await usage_client.release(authorization, bandwidth_reservation)
+            # Drop the blob reference too; content written for this upload is deleted
+            if claimed_digest is not None:
+                await storage_manager.release_blob(db, claimed_digest)
+            raise
+        await usage_client.commit(authorization, bandwidth_reservation, file_size_mb)
+        # Previews are rendered in the background; content seen before already has them.
+        # The upload is stored and charged by now, so a failure to queue must not
+        # fail the request; both are requested again when the video is viewed
+        try:
+            thumbnail_worker.enqueue(blob_name)
+            await packaging_worker.enqueue(db, blob_name)
+        except Exception as e:
+            send_log(
+                username,
+                "StorageMgmtServ",
+                "ERROR",
+                f"Error queueing previews and packaging: {str(e)}",
+            )
 
-        should_alert = await storage_manager.should_alert(db.userstorage, username)
         send_log(username, "StorageMgmtServ", "INFO", "File uploaded successfully")
         return {
             "message": "File uploaded successfully",
-            "should_alert": should_alert,
+            "should_alert": storage_manager.should_alert(user_storage, policy),
             "file_metadata": file_metadata,
         }
 
+    except HTTPException as e:
+        send_log(username, "StorageMgmtServ", "ERROR", f"Upload error: {e.detail}")
+        raise e
     except Exception as e:
         send_log(username, "StorageMgmtServ", "ERROR", f"Upload error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -123,60 +253,47 @@ async def upload_file(
 @app.delete("/storage/files/{filename}")
 async def delete_file(
     filename: str,
-    db: Collection = Depends(get_db),
+    db: AsyncDatabase = Depends(get_db),
     user: dict = Depends(get_current_user),
 ):
     username = user.get("username")
     """Delete a file from user's storage"""
     try:
-        # Get user storage record
-        user_storage = await storage_manager.get_user_storage(db.userstorage, username)
-
-        # Find file metadata
-        file_to_delete = None
-        for file in user_storage.files:
-            if file.filename == filename:
-                file_to_delete = file
-                break
-
+        # Remove the metadata and release its storage in MongoDB
+        file_to_delete = await storage_manager.remove_file(db, username, filename)
         if not file_to_delete:
             send_log(username, "StorageMgmtServ", "ERROR", "File not found")
             raise HTTPException(status_code=404, detail="File not found")
 
-        # Delete from Google Cloud Storage
-        blob = storage_manager.bucket.blob(file_to_delete.file_path)
-        if blob.exists():
-            blob.delete()
-
-        # Update MongoDB
-        collection = db.userstorage
-        result = collection.update_one(
-            {"username": username},
-            {
-                "$pull": {"files": {"filename": filename}},
-                "$inc": {"current_usage_mb": -file_to_delete.size_mb},
-                "$set": {"last_updated": datetime.utcnow()},
-            },
-        )
+        # The blob itself goes only when no other file shares its content
+        await storage_manager.release_file_blob(db, file_to_delete)
 
         send_log(username, "StorageMgmtServ", "INFO", "File deleted successfully")
         return {"message": "File deleted successfully"}
 
+    except HTTPException as e:
+        send_log(username, "StorageMgmtServ", "ERROR", f"Delete error: {e.detail}")
+        raise e
     except Exception as e:
         send_log(username, "StorageMgmtServ", "ERROR", f"Delete error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/storage/files/")
+@app.get("/storage/files/", response_model=FilePage)
 async def list_files(
-    db: Collection = Depends(get_db), user: dict = Depends(get_current_user)
+    db: AsyncDatabase = Depends(get_db),
+    user: dict = Depends(get_current_user),
+    limit: int = Query(FILES_PAGE_SIZE, ge=1, le=MAX_FILES_PAGE_SIZE),
+    cursor: Optional[str] = None,
 ):
     username = user.get("username")
-    """List all files in user's storage"""
+    """List a page of files in user's storage; pass `next_cursor` back to continue"""
     try:
-        user_storage = await storage_manager.get_user_storage(db.userstorage, username)
+        files, next_cursor = await storage_manager.list_files(
+            db.files, username, limit, cursor
+        )
         send_log(username, "StorageMgmtServ", "INFO", "Files listed successfully")
-        return {"files": user_storage.files}
+        return FilePage(files=files, next_cursor=next_cursor)
     except Exception as e:
         send_log(username, "StorageMgmtServ", "ERROR", f"Error listing files: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -192,60 +309,83 @@ async def general_exception_handler(request, exc):
     }
 
 
+async def serve_blob(
+    username: str,
+    blob_path: str,
+    media_type: str,
+    range_header: Optional[str],
+    if_range: Optional[str],
+    authorization: str,
+    headers: dict,
+):
+    """Serve a stored file, honouring Range/If-Range and charging only the bytes sent"""
+    info = await run_in_threadpool(storage_manager.get_blob, blob_path)
+    if info is None:
+        send_log(username, "StorageMgmtServ", "ERROR", "File not found in storage")
+        raise HTTPException(status_code=404, detail="File not found in storage")
+
+    etag = f'"{info.etag}"'
+    last_modified = format_datetime(info.updated, usegmt=True) if info.updated else None
+
+    # A stale If-Range validator means the client gets the full, current object
+    ranges = None
+    if if_range_matches(if_range, etag, last_modified):
+        ranges = parse_range_header(range_header, info.size)
+
+    # Check bandwidth allowance for the bytes actually being served
+    await usage_client.record(
+        authorization, served_bytes(ranges, info.size) / BYTES_PER_MB, "download"
+    )
+
+    headers = {**headers, "ETag": etag}
+    if last_modified:
+        headers["Last-Modified"] = last_modified
+    return range_response(
+        lambda start, end: storage_manager.iter_blob_range(info, start, end),
+        ranges,
+        info.size,
+        media_type,
+        headers,
+        storage_manager.blob_file_path(info),
+    )
+
+
 @app.get("/storage/download/{filename}")
 async def download_file(
     filename: str,
-    db: Collection = Depends(get_db),
+    db: AsyncDatabase = Depends(get_db),
     user: dict = Depends(get_current_user),
     authorization: str = Header(None),
+    range_header: Optional[str] = Header(None, alias="range"),
+    if_range: Optional[str] = Header(None),
 ):
     """Download a file from user's storage"""
     username = user.get("username")
     try:
-        # Get user storage record
-        user_storage = await storage_manager.get_user_storage(db.userstorage, username)
-
         # Find file metadata
-        file_to_download = None
-        for file in user_storage.files:
-            if file.filename == filename:
-                file_to_download = file
-                break
+        file_to_download = await storage_manager.get_file(db.files, username, filename)
 
         if not file_to_download:
             send_log(username, "StorageMgmtServ", "ERROR", "File not found")
             raise HTTPException(status_code=404, detail="File not found")
 
-        # Get the file from Google Cloud Storage
-        blob = storage_manager.bucket.blob(file_to_download.file_path)
-        if not blob.exists():
-            send_log(username, "StorageMgmtServ", "ERROR", "File not found in storage")
-            raise HTTPException(status_code=404, detail="File not found in storage")
-
-        # Check bandwidth allowance
-        await check_bandwidth(
+        # Only the requested byte spans are fetched from the blob store
+        response = await serve_blob(
             username,
-            file_to_download.size_mb,
-            operation_type="download",
-            token=authorization,
+            file_to_download.file_path,
+            file_to_download.mime_type,
+            range_header,
+            if_range,
+            authorization,
+            {"Content-Disposition": f'attachment; filename="{filename}"'},
         )
 
-        # Download file to memory
-        file_content = BytesIO()
-        blob.download_to_file(file_content)
-        file_content.seek(0)
-
-        # Create response headers
-        headers = {
-            "Content-Disposition": f'attachment; filename="{filename}"',
-            "Content-Type": file_to_download.mime_type,
-        }
-
         send_log(username, "StorageMgmtServ", "INFO", "File downloaded successfully")
-        return StreamingResponse(
-            file_content, headers=headers, media_type=file_to_download.mime_type
-        )
+        return response
 
+    except HTTPException as e:
+        send_log(username, "StorageMgmtServ", "ERROR", f"Download error: {e.detail}")
+        raise e
     except Exception as e:
         send_log(username, "StorageMgmtServ", "ERROR", f"Download error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -254,53 +394,192 @@ async def download_file(
 @app.get("/storage/stream/{filename}")
 async def stream_video(
     filename: str,
-    db: Collection = Depends(get_db),
+    stream_format: Literal["auto", "hls", "dash", "raw"] = Query(
+        "auto", alias="format"
+    ),
+    db: AsyncDatabase = Depends(get_db),
     user: dict = Depends(get_current_user),
     authorization: str = Header(None),
+    range_header: Optional[str] = Header(None, alias="range"),
+    if_range: Optional[str] = Header(None),
 ):
-    """Stream a video file from user's storage"""
+    """
+    Stream a video file from user's storage.
+
+    Once the adaptive-bitrate package is ready, requests without a Range header
+    are redirected to its HLS manifest (or the DASH one with format=dash).
+    Range requests and format=raw get the uploaded file itself.
+    """
     username = user.get("username")
     try:
-        # Get user storage record
-        user_storage = await storage_manager.get_user_storage(db.userstorage, username)
-
         # Find file metadata
-        file_to_stream = None
-        for file in user_storage.files:
-            if file.filename == filename:
-                file_to_stream = file
-                break
+        file_to_stream = await storage_manager.get_file(db.files, username, filename)
 
         if not file_to_stream:
             send_log(username, "StorageMgmtServ", "ERROR", "File not found")
             raise HTTPException(status_code=404, detail="File not found")
 
-        # Get the file from Google Cloud Storage
-        blob = storage_manager.bucket.blob(file_to_stream.file_path)
-        if not blob.exists():
-            send_log(username, "StorageMgmtServ", "ERROR", "File not found in storage")
-            raise HTTPException(status_code=404, detail="File not found in storage")
-
-        # Check bandwidth allowance
-        await check_bandwidth(
+        if stream_format != "raw" and not range_header:
+            if await get_package(db, file_to_stream.file_path):
+                manifest = DASH_MANIFEST if stream_format == "dash" else HLS_MANIFEST
+                version = package_version(file_to_stream.file_path)
+                return RedirectResponse(
+                    f"/storage/stream/{quote(filename)}/{version}/{manifest}",
+                    status_code=307,
+                )
+            # Covers uploads from before packaging existed
+            job = await packaging_worker.enqueue(db, file_to_stream.file_path)
+            if stream_format != "auto":
+                # Only a job still in progress is worth polling for
+                if not packaging_worker.enabled:
+                    raise HTTPException(
+                        status_code=501, detail="Stream packaging is disabled"
+                    )
+                if job is not None and job["status"] == "failed":
+                    raise HTTPException(
+                        status_code=422, detail="Stream packaging failed"
+                    )
+                raise HTTPException(
+                    status_code=404,
+                    detail="Stream not ready",
+                    headers={"Retry-After": "30"},
+                )
+
+        # Seeking in the player only fetches (and charges for) the requested span
+        response = await serve_blob(
             username,
-            file_to_stream.size_mb,
-            # operation_type="stream",
-            operation_type="download",
-            token=authorization,
+            file_to_stream.file_path,
+            file_to_stream.mime_type,
+            range_header,
+            if_range,
+            authorization,
+            {},
         )
 
-        # Stream the file
-        def iterfile():
-            with blob.open("rb") as f:
-                yield from f
-
         send_log(username, "StorageMgmtServ", "INFO", "File streamed successfully")
-        return StreamingResponse(iterfile(), media_type=file_to_stream.mime_type)
+        return response
 
+    except HTTPException as e:
+        send_log(username, "StorageMgmtServ", "ERROR", f"Stream error: {e.detail}")
+        raise e
     except Exception as e:
         send_log(username, "StorageMgmtServ", "ERROR", f"Stream error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/storage/stream/{filename}/{version}/{asset}")
+async def stream_asset(
+    filename: str,
+    version: str,
+    asset: str,
+    db: AsyncDatabase = Depends(get_db),
+    user: dict = Depends(get_current_user),
+    authorization: str = Header(None),
+    range_header: Optional[str] = Header(None, alias="range"),
+    if_range: Optional[str] = Header(None),
+):
+    """
+    Serve a manifest or segment of a video's adaptive-bitrate package.
 
+    Each one is charged to the bandwidth quota as it is fetched, so a viewer
+    pays for the renditions and the part of the video actually played.
+    """
+    username = user.get("username")
+    try:
+        file_to_stream = await storage_manager.get_file(db.files, username, filename)
+        # The version changes with the content, so a stale player gets a 404
+        # instead of segments from a different upload under the same name
+        if (
+            not file_to_stream
+            or version != package_version(file_to_stream.file_path)
+            or not await has_asset(db, file_to_stream.file_path, asset)
+        ):
+            send_log(username, "StorageMgmtServ", "ERROR", "Stream asset not found")
+            raise HTTPException(status_code=404, detail="Stream asset not found")
+
+        return await serve_blob(
+            username,
+            f"{package_prefix(file_to_stream.file_path)}/{asset}",
+            asset_content_type(asset),
+            range_header,
+            if_range,
+            authorization,
+            {"Cache-Control": IMMUTABLE_CACHE_CONTROL},
+        )
+
+    except HTTPException as e:
+        if e.status_code != 404:
+            send_log(username, "StorageMgmtServ", "ERROR", f"Stream error: {e.detail}")
+        raise e
+    except Exception as e:
+        send_log(username, "StorageMgmtServ", "ERROR", f"Stream error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/storage/thumbnail/{filename}")
+async def get_thumbnail(
+    filename: str,
+    kind: Literal["poster", "sprite"] = "poster",
+    v: Optional[str] = None,
+    db: AsyncDatabase = Depends(get_db),
+    user: dict = Depends(get_current_user),
+    if_none_match: Optional[str] = Header(None),
+):
+    """
+    Get a video's poster frame or its sprite sheet of preview tiles.
+
+    Pass the file's sha256 as `v` to get a response that is cached for a year.
+    """
+    username = user.get("username")
+    try:
+        file_metadata = await storage_manager.get_file(db.files, username, filename)
+        if not file_metadata:
+            send_log(username, "StorageMgmtServ", "ERROR", "File not found")
+            raise HTTPException(status_code=404, detail="File not found")
+
+        info = await run_in_threadpool(
+            storage_manager.get_blob, preview_path(file_metadata.file_path, kind)
+        )
+        if info is None:
+            # Covers uploads from before previews existed and jobs that were dropped
+            if not thumbnail_worker.enabled:
+                raise HTTPException(status_code=404, detail="Thumbnails are disabled")
+            thumbnail_worker.enqueue(file_metadata.file_path)
+            raise HTTPException(
+                status_code=404,
+                detail="Thumbnail not ready",
+                headers={"Retry-After": "5"},
+            )
+
+        etag = f'"{info.etag}"'
+        versioned = v is not None and v == file_metadata.sha256
+        headers = {
+            "ETag": etag,
+            "Cache-Control": (
+                IMMUTABLE_CACHE_CONTROL
+                if versioned
+                else THUMBNAIL_REVALIDATE_CACHE_CONTROL
+            ),
+        }
+        if kind == "sprite":
+            headers["X-Sprite-Grid"] = f"{SPRITE_COLUMNS}x{SPRITE_ROWS}"
+        if if_none_match == etag:
+            return Response(status_code=304, headers=headers)
+        return range_response(
+            lambda start, end: storage_manager.iter_blob_range(info, start, end),
+            None,
+            info.size,
+            PREVIEW_CONTENT_TYPE,
+            headers,
+            storage_manager.blob_file_path(info),
+        )
+
+    except HTTPException as e:
+        if e.status_code != 404:
+            send_log(
+                username, "StorageMgmtServ", "ERROR", f"Thumbnail error: {e.detail}"
+            )
+        raise e
+    except Exception as e:
+        send_log(username, "StorageMgmtServ", "ERROR", f"Thumbnail error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
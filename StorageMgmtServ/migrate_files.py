@@ -0,0 +1,85 @@
+"""
+One-shot migration of embedded `userstorage.files` arrays into the `files` collection.
+
+Run from the StorageMgmtServ directory with the usual MongoDB environment variables:
+
+    python migrate_files.py
+
+The migration is idempotent: already-migrated users have no `files` array left, and
+files moved by an interrupted run are recognised by their blob path. Duplicate
+filenames within one user's array, or names already used in the files collection,
+are kept under a suffixed name and reported, so no stored blob is orphaned.
+"""
+
+import asyncio
+import os
+from typing import List, Tuple
+from pymongo import UpdateOne
+from connection import get_database
+from utils import storage_manager
+
+
+def unique_filename(filename: str, taken: set) -> str:
+    """Return `filename`, or `name (n).ext` if it is already taken"""
+    if filename not in taken:
+        return filename
+    stem, ext = os.path.splitext(filename)
+    n = 1
+    while f"{stem} ({n}){ext}" in taken:
+        n += 1
+    return f"{stem} ({n}){ext}"
+
+
+async def migrate_user(db, user_storage: dict) -> Tuple[int, List[tuple]]:
+    """
+    Move one user's embedded files into the files collection; returns the
+    number moved and the (old, new) names of files that had to be renamed.
+    """
+    username = user_storage["username"]
+    # Files uploaded since the new collection went live keep their names, so
+    # an embedded file with the same name is moved under a suffixed name
+    existing = await db.files.find(
+        {"username": username}, {"filename": 1, "file_path": 1}
+    ).to_list()
+    taken = {file["filename"] for file in existing}
+    migrated_paths = {file.get("file_path") for file in existing}
+    operations = []
+    renamed = []
+    for file in user_storage.get("files") or []:
+        if file.get("file_path") in migrated_paths:
+            # Moved by an earlier run that stopped before clearing the array
+            continue
+        filename = unique_filename(file["filename"], taken)
+        taken.add(filename)
+        if filename != file["filename"]:
+            renamed.append((file["filename"], filename))
+        document = {**file, "username": username, "filename": filename}
+        operations.append(
+            UpdateOne(
+                {"username": username, "filename": filename},
+                {"$setOnInsert": document},
+                upsert=True,
+            )
+        )
+    if operations:
+        await db.files.bulk_write(operations, ordered=False)
+    await db.userstorage.update_one(
+        {"_id": user_storage["_id"]}, {"$unset": {"files": ""}}
+    )
+    return len(operations), renamed
+
+
+async def migrate(db):
+    await storage_manager.ensure_indexes(db)
+    users = files = 0
+    async for user_storage in db.userstorage.find({"files": {"$exists": True}}):
+        moved, renamed = await migrate_user(db, user_storage)
+        for old_name, new_name in renamed:
+            print(f"Renamed {user_storage['username']}/{old_name} to {new_name}")
+        files += moved
+        users += 1
+    print(f"Migrated {files} files for {users} users")
+
+
+if __name__ == "__main__":
+    asyncio.run(migrate(get_database()))
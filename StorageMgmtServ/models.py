@@ -1,6 +1,6 @@
 from pydantic import BaseModel, Field
 from datetime import datetime
-from typing import List, Optional
+from typing import List, Literal, Optional
 
 
 class FileMetadata(BaseModel):
@@ -9,6 +9,7 @@ class FileMetadata(BaseModel):
     uploaded_at: datetime
     mime_type: str
     file_path: str
+    sha256: Optional[str] = None  # Content hash; None for files stored before dedup
 
     class Config:
         arbitrary_types_allowed = True
@@ -17,7 +18,6 @@ class FileMetadata(BaseModel):
 class UserStorage(BaseModel):
     username: str
     current_usage_mb: float = 0
-    files: List[FileMetadata] = []
     last_updated: datetime = Field(default_factory=datetime.utcnow)
 
     class Config:
@@ -32,3 +32,33 @@ class StorageStatus(BaseModel):
     usage_percentage: float
     should_alert: bool
     files: List[FileMetadata]
+    next_cursor: Optional[str] = None  # Set when more files follow; see FilePage
+
+
+class FilePage(BaseModel):
+    files: List[FileMetadata]
+    next_cursor: Optional[str] = None
+
+
+class BlobInfo(BaseModel):
+    path: str
+    size: int
+    etag: Optional[str] = None
+    updated: Optional[datetime] = None
+    content_type: Optional[str] = None
+    generation: Optional[int] = None
+
+
+class QuotaPolicy(BaseModel):
+    """A user's limits, resolved from their plan and any per-user override"""
+
+    plan: str = "free"
+    storage_limit_mb: float = Field(default=50, ge=0)
+    max_file_size_mb: float = Field(default=25, ge=0)  # Maximum size for a single file
+    storage_alert_threshold: float = Field(default=0.8, ge=0, le=1)  # 80%
+    bandwidth_limit_mb: float = Field(default=100, ge=0)
+    # "calendar_day" resets at midnight; "rolling_24h" counts the last 24 hours
+    bandwidth_window: Literal["calendar_day", "rolling_24h"] = "calendar_day"
+    # Token bucket for uploads; None means no rate limit
+    upload_rate_per_minute: Optional[float] = Field(default=None, gt=0)
+    upload_burst: Optional[int] = Field(default=None, ge=1)
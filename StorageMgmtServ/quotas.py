@@ -0,0 +1,124 @@
+from pymongo.asynchronous.database import AsyncDatabase
+from typing import Dict, Tuple
+from pydantic import ValidationError
+from models import QuotaPolicy
+import asyncio
+import logging
+import os
+import time
+import dotenv
+
+# Load environment variables from .env file
+dotenv.load_dotenv()
+
+# Plans and overrides are re-read this often; edits elsewhere apply within the TTL
+QUOTA_CACHE_TTL_S = float(os.getenv("QUOTA_CACHE_TTL_S", "60"))
+DEFAULT_QUOTA_PLAN = os.getenv("DEFAULT_QUOTA_PLAN", "free")
+MAX_TOKEN_BUCKETS = 100_000
+TOKEN_BUCKET_IDLE_S = 3600
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class QuotaPolicies:
+    """
+    In-memory cache of quota plans (`quota_plans`) and per-user overrides
+    (`quota_overrides`).
+
+    Both collections are loaded whole and reloaded every QUOTA_CACHE_TTL_S in the
+    background, so resolving a user's policy never touches the database. A plan
+    missing from the database uses the QuotaPolicy defaults.
+    """
+
+    def __init__(self):
+        self.plans: Dict[str, dict] = {}
+        self.overrides: Dict[str, dict] = {}
+        self.resolved: Dict[str, QuotaPolicy] = {}
+        self.task = None
+
+    async def load(self, db: AsyncDatabase):
+        """Replace the cached plans and overrides with the stored ones"""
+        plans = {}
+        async for plan in db.quota_plans.find():
+            name = plan.pop("_id")
+            if self.is_valid(plan, f"plan {name}"):
+                plans[name] = plan
+        overrides = {}
+        async for override in db.quota_overrides.find({}, {"_id": 0}):
+            username = override.pop("username")
+            if self.is_valid(override, f"override for {username}"):
+                overrides[username] = override
+        # Swapped in together so a lookup never sees half of a reload
+        self.plans, self.overrides, self.resolved = plans, overrides, {}
+
+    def is_valid(self, fields: dict, description: str) -> bool:
+        # Checked at load time so a bad document cannot fail lookups later
+        try:
+            QuotaPolicy(**fields)
+            return True
+        except ValidationError as e:
+            logger.error(f"Ignoring invalid quota {description}: {str(e)}")
+            return False
+
+    def get(self, username: str) -> QuotaPolicy:
+        """The effective policy for a user: their plan with their override applied"""
+        policy = self.resolved.get(username)
+        if policy is None:
+            override = self.overrides.get(username, {})
+            plan = override.get("plan") or DEFAULT_QUOTA_PLAN
+            fields = {**self.plans.get(plan, {}), **override, "plan": plan}
+            policy = self.resolved[username] = QuotaPolicy(**fields)
+        return policy
+
+    def start(self, db: AsyncDatabase):
+        """Start the background reload task; call after the initial `load`"""
+        if self.task is None:
+            self.task = asyncio.create_task(self.run(db))
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def run(self, db: AsyncDatabase):
+        while True:
+            await asyncio.sleep(QUOTA_CACHE_TTL_S)
+            try:
+                await self.load(db)
+            except Exception as e:
+                # Keep serving the last loaded policies until the next attempt
+                logger.error(f"Error loading quota policies: {str(e)}")
+
+
+class TokenBuckets:
+    """Per-user token buckets for rate limits; state is local to this process"""
+
+    def __init__(self):
+        self.buckets: Dict[str, Tuple[float, float]] = {}  # username -> (tokens, time)
+
+    def allow(self, username: str, rate_per_minute: float, burst: int = None) -> bool:
+        """Take one token from the user's bucket; False if it is empty"""
+        capacity = burst or max(rate_per_minute, 1)
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(username, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate_per_minute / 60)
+        allowed = tokens >= 1
+        self.buckets[username] = (tokens - 1 if allowed else tokens, now)
+        if len(self.buckets) > MAX_TOKEN_BUCKETS:
+            # Idle buckets are dropped, which is the same as treating them as full
+            self.buckets = {
+                name: bucket
+                for name, bucket in self.buckets.items()
+                if now - bucket[1] < TOKEN_BUCKET_IDLE_S
+            }
+        return allowed
+
+
+quota_policies = QuotaPolicies()
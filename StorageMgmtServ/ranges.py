@@ -0,0 +1,242 @@
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+from typing import Callable, Iterator, List, Optional, Tuple, Union
+import secrets
+import anyio
+
+# Requests asking for more spans than this are served as a single full response
+MAX_RANGES = 16
+
+ByteRange = Tuple[int, int]  # Inclusive (start, end) byte offsets
+# ASGI server extension that sends a span straight from a file descriptor
+ZERO_COPY_EXTENSION = "http.response.zerocopysend"
+
+
+def parse_range_header(
+    range_header: Optional[str], size: int
+) -> Optional[List[ByteRange]]:
+    """
+    Parse a `Range: bytes=...` header into sorted, coalesced byte spans.
+
+    Args:
+        range_header (str): The raw Range header value, if any.
+        size (int): The total size of the object in bytes.
+
+    Returns:
+        list: Inclusive (start, end) spans, or None if the whole object should be served.
+
+    Raises:
+        HTTPException: 416 if none of the requested spans can be satisfied.
+    """
+    if not range_header:
+        return None
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None  # Unknown range units are ignored
+
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition("-")
+        if not sep:
+            return None  # Malformed headers are ignored
+        try:
+            if first == "":
+                # Suffix range: the last N bytes
+                length = int(last)
+                if length <= 0:
+                    continue
+                start, end = max(size - length, 0), size - 1
+            else:
+                start = int(first)
+                end = int(last) if last else start
+                if start < 0 or end < start:
+                    return None
+                if start >= size:
+                    continue
+                end = min(end, size - 1) if last else size - 1
+        except ValueError:
+            return None
+        ranges.append((start, end))
+
+    if not ranges:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+
+    # Merge overlapping or adjacent spans so no byte is sent (or charged) twice
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+
+def if_range_matches(
+    if_range: Optional[str], etag: Optional[str], last_modified: Optional[str]
+) -> bool:
+    """Check an If-Range precondition against the current ETag or Last-Modified value"""
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        # Only strong validators may be used with If-Range
+        return not if_range.startswith("W/") and if_range == etag
+    return if_range == last_modified
+
+
+def served_bytes(ranges: Optional[List[ByteRange]], size: int) -> int:
+    """Number of object bytes a response will carry"""
+    if ranges is None:
+        return size
+    return sum(end - start + 1 for start, end in ranges)
+
+
+class FileRangeResponse(StreamingResponse):
+    """
+    Serves a response body made of literal bytes and spans of a local file.
+
+    When the server offers the ASGI zero-copy extension, each span is handed to
+    it as a file offset and sent with sendfile, without passing through Python.
+    Otherwise the spans are read in chunks by `read_range` like any other blob.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        parts: List[Union[bytes, ByteRange]],
+        read_range: Callable[[int, int], Iterator[bytes]],
+        status_code: int,
+        headers: dict,
+        media_type: str,
+    ):
+        super().__init__(
+            iter_parts(parts, read_range),
+            status_code=status_code,
+            headers=headers,
+            media_type=media_type,
+        )
+        self.path = path
+        self.parts = parts
+        self.zero_copy = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        self.zero_copy = ZERO_COPY_EXTENSION in (scope.get("extensions") or {})
+        await super().__call__(scope, receive, send)
+
+    async def stream_response(self, send: Send):
+        if not self.zero_copy:
+            return await super().stream_response(send)
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        file = await anyio.to_thread.run_sync(open, self.path, "rb")
+        try:
+            for part in self.parts:
+                if isinstance(part, bytes):
+                    message = {"type": "http.response.body", "body": part}
+                else:
+                    start, end = part
+                    message = {
+                        "type": ZERO_COPY_EXTENSION,
+                        "file": file,
+                        "offset": start,
+                        "count": end - start + 1,
+                    }
+                await send({**message, "more_body": True})
+        finally:
+            await anyio.to_thread.run_sync(file.close)
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+def iter_parts(
+    parts: List[Union[bytes, ByteRange]],
+    read_range: Callable[[int, int], Iterator[bytes]],
+) -> Iterator[bytes]:
+    """Yield a response body of literal bytes and (start, end) spans read on demand"""
+    for part in parts:
+        if isinstance(part, bytes):
+            yield part
+        else:
+            yield from read_range(*part)
+
+
+def range_response(
+    read_range: Callable[[int, int], Iterator[bytes]],
+    ranges: Optional[List[ByteRange]],
+    size: int,
+    media_type: str,
+    headers: dict,
+    file_path: Optional[str] = None,
+) -> StreamingResponse:
+    """
+    Build a 200, single-part 206 or multipart/byteranges 206 streaming response.
+
+    Args:
+        read_range (Callable): Yields the object's bytes for an inclusive (start, end) span.
+        ranges (list): The spans returned by `parse_range_header`, or None for the full body.
+        size (int): The total size of the object in bytes.
+        media_type (str): The object's content type.
+        headers (dict): Extra headers such as ETag and Content-Disposition.
+        file_path (str): The object's local file, if it has one, for zero-copy sends.
+
+    Returns:
+        StreamingResponse: A response that only reads the requested spans.
+    """
+    headers = {**headers, "Accept-Ranges": "bytes"}
+    status_code = 206
+
+    if ranges is None:
+        headers["Content-Length"] = str(size)
+        status_code = 200
+        parts = [(0, size - 1)] if size else []
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        parts = [ranges[0]]
+    else:
+        boundary = secrets.token_hex(16)
+        parts = []
+        for start, end in ranges:
+            parts.append(
+                (
+                    f"\r\n--{boundary}\r\n"
+                    f"Content-Type: {media_type}\r\n"
+                    f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+                ).encode()
+            )
+            parts.append((start, end))
+        parts.append(f"\r\n--{boundary}--\r\n".encode())
+        headers["Content-Length"] = str(
+            sum(len(part) for part in parts if isinstance(part, bytes))
+            + served_bytes(ranges, size)
+        )
+        media_type = f"multipart/byteranges; boundary={boundary}"
+
+    if file_path is not None:
+        return FileRangeResponse(
+            file_path, parts, read_range, status_code, headers, media_type
+        )
+    return StreamingResponse(
+        iter_parts(parts, read_range),
+        status_code=status_code,
+        headers=headers,
+        media_type=media_type,
+    )
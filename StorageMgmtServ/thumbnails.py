@@ -0,0 +1,230 @@
+from concurrent.futures import ProcessPoolExecutor
+from starlette.concurrency import run_in_threadpool
+from collections import OrderedDict
+from typing import Dict, Optional
+import asyncio
+import importlib.util
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import dotenv
+from blob_store import STREAM_CHUNK_SIZE, BlobStore
+
+# Load environment variables from .env file
+dotenv.load_dotenv()
+
+# ffmpeg processes running at once; each one is a separate worker process
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", "2"))
+THUMBNAIL_QUEUE_SIZE = int(os.getenv("THUMBNAIL_QUEUE_SIZE", "1000"))
+# An ffmpeg run taking longer than this is killed and the job fails
+THUMBNAIL_TIMEOUT_S = float(os.getenv("THUMBNAIL_TIMEOUT_S", "120"))
+# A failed video is not retried for this long
+THUMBNAIL_RETRY_AFTER_S = float(os.getenv("THUMBNAIL_RETRY_AFTER_S", "600"))
+POSTER_WIDTH = int(os.getenv("POSTER_WIDTH", "640"))
+POSTER_MAX_OFFSET_S = 5  # Poster frame is taken 10% in, but no later than this
+SPRITE_COLUMNS = 5
+SPRITE_ROWS = 5
+SPRITE_TILE_WIDTH = 160
+MAX_FAILED_JOBS = 10_000
+PREVIEW_KINDS = ("poster", "sprite")
+PREVIEW_CONTENT_TYPE = "image/jpeg"
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def preview_path(blob_path: str, kind: str) -> str:
+    """Blob path of a preview image, stored next to the video it was made from"""
+    return f"{blob_path}.{kind}.jpg"
+
+
+def run_ffmpeg(stream, timeout_s: float):
+    """Run an ffmpeg-python stream, killing ffmpeg if it overruns timeout_s"""
+    import ffmpeg
+
+    process = stream.overwrite_output().run_async(quiet=True)
+    try:
+        out, err = process.communicate(timeout=timeout_s)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise
+    if process.returncode:
+        raise ffmpeg.Error("ffmpeg", out, err)
+
+
+def render_previews(video_path: str, output_dir: str) -> Dict[str, str]:
+    """
+    Render the poster frame and the sprite sheet of a video; returns the image
+    file for each kind. Runs in a worker process.
+    """
+    import ffmpeg
+
+    deadline = time.monotonic() + THUMBNAIL_TIMEOUT_S
+    try:
+        duration = float(ffmpeg.probe(video_path)["format"]["duration"])
+    except (ffmpeg.Error, KeyError, ValueError):
+        duration = 0
+    outputs = {kind: os.path.join(output_dir, f"{kind}.jpg") for kind in PREVIEW_KINDS}
+
+    poster_offset = min(duration * 0.1, POSTER_MAX_OFFSET_S)
+    run_ffmpeg(
+        ffmpeg.input(video_path, ss=poster_offset)
+        .filter("scale", POSTER_WIDTH, -2)
+        .output(outputs["poster"], vframes=1, **{"q:v": 3}),
+        deadline - time.monotonic(),
+    )
+
+    # Sample frames evenly across the video so the tiles fill the grid once
+    tiles = SPRITE_COLUMNS * SPRITE_ROWS
+    run_ffmpeg(
+        ffmpeg.input(video_path)
+        .filter("fps", fps=tiles / duration if duration else 1)
+        .filter("scale", SPRITE_TILE_WIDTH, -2)
+        .filter("tile", f"{SPRITE_COLUMNS}x{SPRITE_ROWS}")
+        .output(outputs["sprite"], vframes=1, **{"q:v": 5}),
+        deadline - time.monotonic(),
+    )
+    return outputs
+
+
+class ThumbnailWorker:
+    """
+    Generates preview images for uploaded videos in the background.
+
+    Jobs are queued in-process and handled by a few tasks that hand the ffmpeg
+    work to a process pool, so rendering never competes with requests for the
+    event loop or the GIL. The poster is written last and marks a video as done;
+    content shared by several files is only rendered once.
+    """
+
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=THUMBNAIL_QUEUE_SIZE)
+        self.blob_store: Optional[BlobStore] = None
+        self.executor = None
+        self.tasks = []
+        self.queued = set()  # Blob paths queued or being rendered
+        self.failed: "OrderedDict[str, float]" = OrderedDict()
+        self.stats = {"enqueued": 0, "rendered": 0, "skipped": 0, "failed": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.executor is not None
+
+    def start(self, blob_store: BlobStore):
+        """Start the worker processes, unless ffmpeg is not installed"""
+        if self.enabled:
+            return
+        if importlib.util.find_spec("ffmpeg") is None or not (
+            shutil.which("ffmpeg") and shutil.which("ffprobe")
+        ):
+            logger.warning("ffmpeg is not installed; thumbnails are disabled")
+            return
+        self.blob_store = blob_store
+        # Spawned workers do not inherit the parent's sockets and threads
+        self.executor = ProcessPoolExecutor(
+            max_workers=THUMBNAIL_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        self.tasks = [asyncio.create_task(self.run()) for _ in range(THUMBNAIL_WORKERS)]
+
+    async def stop(self):
+        """Stop taking jobs; queued jobs are dropped and rerun when next requested"""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        self.queued.clear()
+
+    def enqueue(self, blob_path: str) -> bool:
+        """Queue previews for a video without blocking; False if it was not queued"""
+        if not self.enabled or blob_path in self.queued:
+            return False
+        failed_at = self.failed.get(blob_path)
+        if failed_at is not None:
+            if time.monotonic() - failed_at < THUMBNAIL_RETRY_AFTER_S:
+                return False
+            del self.failed[blob_path]
+        try:
+            self.queue.put_nowait(blob_path)
+        except asyncio.QueueFull:
+            # Previews are requested again by the thumbnail endpoint
+            self.stats["skipped"] += 1
+            return False
+        self.queued.add(blob_path)
+        self.stats["enqueued"] += 1
+        return True
+
+    async def run(self):
+        while True:
+            blob_path = await self.queue.get()
+            try:
+                await self.process(blob_path)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error rendering previews for {blob_path}: {str(e)}")
+                self.stats["failed"] += 1
+                self.failed[blob_path] = time.monotonic()
+                if len(self.failed) > MAX_FAILED_JOBS:
+                    self.failed.popitem(last=False)
+            finally:
+                self.queued.discard(blob_path)
+                self.queue.task_done()
+
+    async def process(self, blob_path: str):
+        store = self.blob_store
+        if await run_in_threadpool(store.stat, preview_path(blob_path, "poster")):
+            self.stats["skipped"] += 1
+            return
+        info = await run_in_threadpool(store.stat, blob_path)
+        if info is None:
+            return
+        with tempfile.TemporaryDirectory(prefix="thumbnails-") as workdir:
+            video_path = os.path.join(workdir, "video")
+            await run_in_threadpool(self.download, info, video_path)
+            outputs = await asyncio.get_running_loop().run_in_executor(
+                self.executor, render_previews, video_path, workdir
+            )
+            for kind in reversed(PREVIEW_KINDS):
+                await run_in_threadpool(
+                    self.upload, outputs[kind], preview_path(blob_path, kind)
+                )
+        if await run_in_threadpool(store.stat, blob_path) is None:
+            # The video was deleted while rendering; do not leave previews behind
+            await run_in_threadpool(delete_previews, store, blob_path)
+            return
+        self.stats["rendered"] += 1
+
+    def download(self, info, video_path: str):
+        with open(video_path, "wb") as f:
+            for chunk in self.blob_store.iter_range(info, 0, info.size - 1):
+                f.write(chunk)
+
+    def upload(self, image_path: str, blob_path: str):
+        writer = self.blob_store.open_writer(blob_path, PREVIEW_CONTENT_TYPE)
+        try:
+            with open(image_path, "rb") as f:
+                while chunk := f.read(STREAM_CHUNK_SIZE):
+                    writer.write(chunk)
+            writer.close()
+        except Exception:
+            writer.terminate()
+            raise
+
+
+def delete_previews(blob_store: BlobStore, blob_path: str):
+    """Delete the preview images of a video"""
+    for kind in PREVIEW_KINDS:
+        blob_store.delete(preview_path(blob_path, kind))
+
+
+thumbnail_worker = ThumbnailWorker()
@@ -0,0 +1,251 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from jose import jwt as jose_jwt
+from jose.exceptions import JOSEError
+import hashlib
+import importlib
+import importlib.util
+import json
+import logging
+import os
+import time
+import httpx
+import dotenv
+
+# Load environment variables from .env file
+dotenv.load_dotenv()
+
+# Tokens without a `kid` header are verified with the shared secret
+SECRET_KEY = os.getenv("SECRET_KEY")
+ALGORITHM = os.getenv("ALGORITHM")
+# "pyjwt" decodes with PyJWT when it is installed; "jose" uses python-jose
+JWT_BACKEND = os.getenv("JWT_BACKEND", "jose").lower()
+# Key set ({"keys": [...]}) for tokens carrying a `kid`, from a file or a URL such
+# as UserAccMgmtServ's /.well-known/jwks.json
+JWT_JWKS_FILE = os.getenv("JWT_JWKS_FILE")
+JWT_JWKS_URL = os.getenv("JWT_JWKS_URL")
+JWT_JWKS_REFRESH_S = float(os.getenv("JWT_JWKS_REFRESH_S", "300"))
+# An unknown `kid` reloads the key set, but no more often than this
+JWT_JWKS_MIN_REFRESH_S = float(os.getenv("JWT_JWKS_MIN_REFRESH_S", "30"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+# Decoded claims are reused until the token expires or for this long, if sooner
+TOKEN_CACHE_TTL_S = float(os.getenv("TOKEN_CACHE_TTL_S", "300"))
+# Sessions ended before their access tokens expire ({"revoked": [{"sid",
+# "expires_at"}]}), e.g. UserAccMgmtServ's /sessions/revoked. A revoked session's
+# tokens are refused once the list is next reloaded, so up to this much later
+JWT_REVOCATIONS_URL = os.getenv("JWT_REVOCATIONS_URL")
+JWT_REVOCATIONS_REFRESH_S = float(os.getenv("JWT_REVOCATIONS_REFRESH_S", "30"))
+DEFAULT_KEY_ALGORITHMS = {"RSA": "RS256", "EC": "ES256", "OKP": "EdDSA"}
+# JWK members that must never leave the service that holds the key
+PRIVATE_KEY_FIELDS = {"d", "p", "q", "dp", "dq", "qi", "oth", "k"}
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class InvalidTokenError(Exception):
+    """The token is malformed, expired, or not signed by a trusted key"""
+
+
+def load_pyjwt():
+    if JWT_BACKEND != "pyjwt":
+        return None
+    if importlib.util.find_spec("jwt") is None:
+        logger.warning("JWT_BACKEND=pyjwt needs the PyJWT package; using python-jose")
+        return None
+    return importlib.import_module("jwt")
+
+
+def public_jwk(key: dict) -> Optional[dict]:
+    """A key's public half for publishing, or None for shared-secret keys"""
+    if key.get("kty") == "oct":
+        return None
+    return {
+        name: value for name, value in key.items() if name not in PRIVATE_KEY_FIELDS
+    }
+
+
+class TokenVerifier:
+    """
+    Verifies access tokens and caches their claims.
+
+    The cache is keyed by a SHA-256 of the token, so raw tokens are never held,
+    and an entry never outlives the token's `exp`. Tokens with a `kid` header are
+    checked against the JWKS key set; keys can be rotated by publishing the new
+    key alongside the old one and removing the old one once its tokens expire.
+    A change to the key set empties the cache.
+
+    Tokens carrying the `sid` of a revoked session are refused. Revocations are
+    loaded from JWT_REVOCATIONS_URL, or from `revocation_source` in the service
+    that holds the sessions, every JWT_REVOCATIONS_REFRESH_S.
+    """
+
+    def __init__(self):
+        self.cache: "OrderedDict[bytes, Tuple[dict, float]]" = OrderedDict()
+        self.keys: Dict[str, dict] = {}  # kid -> JWK from the key set
+        self.local_keys: Dict[str, dict] = {}  # kid -> JWK added by this service
+        self.key_objects: Dict[str, object] = {}  # kid -> key prepared for decoding
+        self.keys_loaded_at = None
+        self.revoked: Dict[str, float] = {}  # sid -> when its last token expires
+        self.revocations_loaded_at = None
+        # Async callable returning (sid, expires_at) pairs; used instead of the URL
+        self.revocation_source = None
+        self.pyjwt = load_pyjwt()
+        self.errors = (JOSEError,) + ((self.pyjwt.PyJWTError,) if self.pyjwt else ())
+
+    async def verify(self, token: str) -> dict:
+        """Return the token's claims; raises InvalidTokenError"""
+        claims = await self.decode(token)
+        await self.refresh_revocations()
+        if self.is_revoked(claims.get("sid")):
+            raise InvalidTokenError("Session has been revoked")
+        return claims
+
+    async def decode(self, token: str) -> dict:
+        digest = hashlib.sha256(token.encode()).digest()
+        now = time.time()
+        cached = self.cache.get(digest)
+        if cached is not None:
+            claims, expires_at = cached
+            if expires_at > now:
+                self.cache.move_to_end(digest)
+                return claims
+            del self.cache[digest]
+
+        key, algorithms = await self.key_for(self.header(token))
+        try:
+            if self.pyjwt:
+                claims = self.pyjwt.decode(token, key, algorithms=algorithms)
+            else:
+                claims = jose_jwt.decode(token, key, algorithms=algorithms)
+        except self.errors as e:
+            raise InvalidTokenError(str(e))
+
+        expires_at = now + TOKEN_CACHE_TTL_S
+        if isinstance(claims.get("exp"), (int, float)):
+            expires_at = min(expires_at, claims["exp"])
+        self.cache[digest] = (claims, expires_at)
+        if len(self.cache) > TOKEN_CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return claims
+
+    def header(self, token: str) -> dict:
+        try:
+            if self.pyjwt:
+                return self.pyjwt.get_unverified_header(token)
+            return jose_jwt.get_unverified_header(token)
+        except self.errors as e:
+            raise InvalidTokenError(str(e))
+
+    async def key_for(self, header: dict) -> Tuple[object, List[str]]:
+        """The verification key and the only algorithm accepted with it"""
+        kid = header.get("kid")
+        if kid is None:
+            if not SECRET_KEY:
+                raise InvalidTokenError("Token has no key ID")
+            return SECRET_KEY, [ALGORITHM]
+        await self.refresh_keys()
+        key = self.get_key(kid)
+        if key is None:
+            # The key may have been rotated in since the last load
+            await self.refresh_keys(JWT_JWKS_MIN_REFRESH_S)
+            key = self.get_key(kid)
+        if key is None:
+            raise InvalidTokenError(f"Unknown key ID {kid}")
+        # The algorithm comes from the key, never the token, so a public key
+        # cannot be passed off as an HMAC secret
+        algorithm = key.get("alg") or DEFAULT_KEY_ALGORITHMS.get(key.get("kty"))
+        if algorithm is None:
+            raise InvalidTokenError(f"Key {kid} has no algorithm")
+        if kid not in self.key_objects:
+            try:
+                self.key_objects[kid] = (
+                    self.pyjwt.PyJWK(key, algorithm).key if self.pyjwt else key
+                )
+            except self.errors as e:
+                raise InvalidTokenError(f"Unusable key {kid}: {str(e)}")
+        return self.key_objects[kid], [algorithm]
+
+    def get_key(self, kid: str) -> Optional[dict]:
+        return self.keys.get(kid) or self.local_keys.get(kid)
+
+    def add_key(self, key: dict):
+        """Trust a key held by this service, e.g. the one it signs tokens with"""
+        self.local_keys[key["kid"]] = key
+        self.key_objects.pop(key["kid"], None)
+
+    def public_keys(self) -> List[dict]:
+        """Every trusted key without its private members, for a JWKS endpoint"""
+        keys = {**self.keys, **self.local_keys}.values()
+        return [jwk for jwk in map(public_jwk, keys) if jwk is not None]
+
+    async def refresh_keys(self, max_age_s: float = JWT_JWKS_REFRESH_S):
+        """Reload the key set if it is older than max_age_s"""
+        if not (JWT_JWKS_FILE or JWT_JWKS_URL):
+            return
+        now = time.monotonic()
+        if self.keys_loaded_at is not None and now - self.keys_loaded_at < max_age_s:
+            return
+        self.keys_loaded_at = now
+        try:
+            key_set = await self.fetch_key_set()
+        except (OSError, ValueError, httpx.HTTPError) as e:
+            # Keep verifying with the last loaded keys until the next attempt
+            logger.error(f"Error loading JWKS: {str(e)}")
+            return
+        keys = {key["kid"]: key for key in key_set.get("keys", []) if "kid" in key}
+        if keys != self.keys:
+            self.keys = keys
+            self.key_objects = {}
+            # Tokens signed with a key that was removed must stop verifying
+            self.cache.clear()
+
+    def revoke(self, session_id: str, expires_at: float):
+        """Refuse a session's tokens until expires_at, a Unix timestamp"""
+        self.revoked[session_id] = expires_at
+
+    def is_revoked(self, session_id: Optional[str]) -> bool:
+        expires_at = self.revoked.get(session_id) if session_id else None
+        return expires_at is not None and expires_at > time.time()
+
+    async def refresh_revocations(self):
+        """Reload revoked sessions if the list is older than JWT_REVOCATIONS_REFRESH_S"""
+        if self.revocation_source is None and not JWT_REVOCATIONS_URL:
+            return
+        now = time.monotonic()
+        if (
+            self.revocations_loaded_at is not None
+            and now - self.revocations_loaded_at < JWT_REVOCATIONS_REFRESH_S
+        ):
+            return
+        self.revocations_loaded_at = now
+        try:
+            revoked = await (self.revocation_source or self.fetch_revocations)()
+        except Exception as e:
+            # Keep refusing the sessions already known until the next attempt
+            logger.error(f"Error loading revoked sessions: {str(e)}")
+            return
+        now = time.time()
+        self.revoked = {sid: expires for sid, expires in revoked if expires > now}
+
+    async def fetch_revocations(self) -> List[Tuple[str, float]]:
+        async with httpx.AsyncClient(timeout=5) as client:
+            response = await client.get(JWT_REVOCATIONS_URL)
+            response.raise_for_status()
+            return [
+                (item["sid"], item["expires_at"]) for item in response.json()["revoked"]
+            ]
+
+    async def fetch_key_set(self) -> dict:
+        if JWT_JWKS_FILE:
+            with open(JWT_JWKS_FILE) as f:
+                return json.load(f)
+        # Fetched every few minutes at most, so a pooled client would not help
+        async with httpx.AsyncClient(timeout=5) as client:
+            response = await client.get(JWT_JWKS_URL)
+            response.raise_for_status()
+            return response.json()
+
+
+token_verifier = TokenVerifier()
@@ -0,0 +1,428 @@
+from concurrent.futures import ProcessPoolExecutor
+from starlette.concurrency import run_in_threadpool
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.asynchronous.database import AsyncDatabase
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+import asyncio
+import hashlib
+import importlib.util
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import uuid
+import dotenv
+from blob_store import STREAM_CHUNK_SIZE, BlobStore
+from thumbnails import run_ffmpeg
+
+# Load environment variables from .env file
+dotenv.load_dotenv()
+
+# Renditions as height:video kbps; only those no taller than the source are made
+ABR_RENDITIONS = os.getenv("ABR_RENDITIONS", "1080:5000,720:2800,480:1400,360:800")
+ABR_AUDIO_BITRATE = os.getenv("ABR_AUDIO_BITRATE", "128k")
+SEGMENT_DURATION_S = int(os.getenv("SEGMENT_DURATION_S", "4"))
+# Transcodes running at once per instance; each one is a separate worker process
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", "1"))
+TRANSCODE_TIMEOUT_S = float(os.getenv("TRANSCODE_TIMEOUT_S", "3600"))
+# A job whose worker stops renewing its lease for this long is picked up again
+TRANSCODE_LEASE_S = float(os.getenv("TRANSCODE_LEASE_S", "300"))
+TRANSCODE_MAX_ATTEMPTS = int(os.getenv("TRANSCODE_MAX_ATTEMPTS", "3"))
+# A failed video is not packaged again until this long after it failed
+TRANSCODE_RETRY_AFTER_S = float(os.getenv("TRANSCODE_RETRY_AFTER_S", "86400"))
+TRANSCODE_POLL_S = float(os.getenv("TRANSCODE_POLL_S", "10"))
+HLS_MANIFEST = "master.m3u8"
+DASH_MANIFEST = "manifest.mpd"
+ASSET_CONTENT_TYPES = {
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".mpd": "application/dash+xml",
+    ".m4s": "video/iso.segment",
+}
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def parse_renditions(spec: str) -> List[Tuple[int, int]]:
+    """Parse "height:kbps,..." into (height, kbps) pairs, tallest first"""
+    renditions = []
+    for item in filter(None, spec.split(",")):
+        height, kbps = item.split(":")
+        renditions.append((int(height), int(kbps)))
+    return sorted(renditions, reverse=True)
+
+
+RENDITIONS = parse_renditions(ABR_RENDITIONS)
+
+
+def package_prefix(blob_path: str) -> str:
+    """Blob prefix of a video's manifests and segments, stored next to the video"""
+    return f"{blob_path}.abr"
+
+
+def package_version(blob_path: str) -> str:
+    """
+    Short ID of a package, used in its URLs so they change whenever a filename
+    is reused for different content and can be cached indefinitely.
+    """
+    return hashlib.sha256(blob_path.encode()).hexdigest()[:16]
+
+
+def asset_content_type(asset: str) -> str:
+    return ASSET_CONTENT_TYPES.get(
+        os.path.splitext(asset)[1], "application/octet-stream"
+    )
+
+
+def render_package(video_path: str, output_dir: str) -> List[str]:
+    """
+    Transcode a video into the configured renditions as CMAF segments with both
+    a DASH and an HLS manifest; returns the files written. Runs in a worker
+    process.
+    """
+    import ffmpeg
+
+    deadline = time.monotonic() + TRANSCODE_TIMEOUT_S
+    streams = ffmpeg.probe(video_path)["streams"]
+    video_info = next((s for s in streams if s.get("codec_type") == "video"), None)
+    if video_info is None:
+        # StopIteration cannot cross back from the process pool; it would leave
+        # the job's future pending forever
+        raise ValueError("No video stream")
+    has_audio = any(s.get("codec_type") == "audio" for s in streams)
+    renditions = [r for r in RENDITIONS if r[0] <= int(video_info["height"])]
+    renditions = renditions or RENDITIONS[-1:]
+
+    source = ffmpeg.input(video_path)
+    scaled = source.video.filter_multi_output("split", len(renditions))
+    outputs = []
+    options = {}
+    for i, (height, kbps) in enumerate(renditions):
+        outputs.append(scaled[i].filter("scale", -2, height))
+        options[f"b:v:{i}"] = f"{kbps}k"
+        options[f"maxrate:v:{i}"] = f"{int(kbps * 1.07)}k"
+        options[f"bufsize:v:{i}"] = f"{int(kbps * 1.5)}k"
+    adaptation_sets = "id=0,streams=v"
+    if has_audio:
+        outputs.append(source.audio)
+        adaptation_sets += " id=1,streams=a"
+        options.update({"c:a": "aac", "b:a": ABR_AUDIO_BITRATE, "ac": 2})
+
+    # Keyframes on every segment boundary keep renditions switchable mid-stream;
+    # the DASH muxer also writes HLS playlists over the same segments
+    run_ffmpeg(
+        ffmpeg.output(
+            *outputs,
+            os.path.join(output_dir, DASH_MANIFEST),
+            format="dash",
+            vcodec="libx264",
+            preset="veryfast",
+            pix_fmt="yuv420p",
+            sc_threshold=0,
+            force_key_frames=f"expr:gte(t,n_forced*{SEGMENT_DURATION_S})",
+            seg_duration=SEGMENT_DURATION_S,
+            use_template=1,
+            use_timeline=0,
+            hls_playlist=1,
+            hls_master_name=HLS_MANIFEST,
+            adaptation_sets=adaptation_sets,
+            init_seg_name="init-$RepresentationID$.m4s",
+            media_seg_name="chunk-$RepresentationID$-$Number%05d$.m4s",
+            **options,
+        ),
+        deadline - time.monotonic(),
+    )
+    return sorted(os.listdir(output_dir))
+
+
+async def ensure_package_indexes(db: AsyncDatabase):
+    """Support claiming the oldest pending job"""
+    await db.transcode_jobs.create_index(
+        [("status", ASCENDING), ("created_at", ASCENDING)]
+    )
+
+
+async def get_package(db: AsyncDatabase, blob_path: str) -> Optional[dict]:
+    """The finished package of a video, without its file list; None if not ready"""
+    return await db.transcode_jobs.find_one(
+        {"_id": blob_path, "status": "ready"}, {"files": 0}
+    )
+
+
+async def has_asset(db: AsyncDatabase, blob_path: str, asset: str) -> bool:
+    """Whether a file belongs to a video's finished package"""
+    job = await db.transcode_jobs.find_one(
+        {"_id": blob_path, "status": "ready", "files": asset}, {"_id": 1}
+    )
+    return job is not None
+
+
+async def delete_package(db: AsyncDatabase, blob_store: BlobStore, blob_path: str):
+    """Delete a video's manifests and segments along with its job"""
+    job = await db.transcode_jobs.find_one_and_delete({"_id": blob_path})
+    if job and job.get("files"):
+        await run_in_threadpool(delete_assets, blob_store, blob_path, job["files"])
+
+
+def delete_assets(blob_store: BlobStore, blob_path: str, files: List[str]):
+    prefix = package_prefix(blob_path)
+    for name in files:
+        blob_store.delete(f"{prefix}/{name}")
+
+
+class PackagingWorker:
+    """
+    Transcodes uploaded videos into adaptive-bitrate packages in the background.
+
+    Jobs live in the `transcode_jobs` collection, so they survive restarts and
+    are shared by every instance. A worker claims the oldest pending job with a
+    lease that it renews while ffmpeg runs in a process pool; a job whose worker
+    died is claimed again once its lease runs out, up to TRANSCODE_MAX_ATTEMPTS
+    times. A failed job gets a fresh set of attempts when the video is requested
+    again after TRANSCODE_RETRY_AFTER_S. Videos are keyed by blob path, so
+    identical uploads are packaged once.
+    """
+
+    def __init__(self):
+        self.db: Optional[AsyncDatabase] = None
+        self.blob_store: Optional[BlobStore] = None
+        self.executor = None
+        self.tasks = []
+        self.wakeup = asyncio.Event()
+        self.stats = {"packaged": 0, "failed": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.executor is not None
+
+    def start(self, db: AsyncDatabase, blob_store: BlobStore):
+        """Start the worker processes, unless ffmpeg is not installed"""
+        if self.enabled:
+            return
+        if importlib.util.find_spec("ffmpeg") is None or not (
+            shutil.which("ffmpeg") and shutil.which("ffprobe")
+        ):
+            logger.warning("ffmpeg is not installed; stream packaging is disabled")
+            return
+        self.db = db
+        self.blob_store = blob_store
+        # Spawned workers do not inherit the parent's sockets and threads
+        self.executor = ProcessPoolExecutor(
+            max_workers=TRANSCODE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        self.tasks = [asyncio.create_task(self.run()) for _ in range(TRANSCODE_WORKERS)]
+
+    async def stop(self):
+        """Stop working; unfinished jobs are claimed again once their leases expire"""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def enqueue(self, db: AsyncDatabase, blob_path: str) -> Optional[dict]:
+        """
+        Queue a video for packaging unless it already has a job; returns the job,
+        without its file list, or None if packaging is disabled.
+        """
+        if not self.enabled:
+            return None
+        now = datetime.utcnow()
+        job = await db.transcode_jobs.find_one_and_update(
+            {"_id": blob_path},
+            {
+                "$setOnInsert": {
+                    "status": "pending",
+                    "attempts": 0,
+                    "created_at": now,
+                    "updated_at": now,
+                }
+            },
+            projection={"files": 0},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        if job["status"] == "failed" and job["updated_at"] <= now - timedelta(
+            seconds=TRANSCODE_RETRY_AFTER_S
+        ):
+            # Conditional on updated_at so concurrent requests reset it only once
+            reset = await db.transcode_jobs.find_one_and_update(
+                {"_id": blob_path, "status": "failed", "updated_at": job["updated_at"]},
+                {
+                    "$set": {
+                        "status": "pending",
+                        "attempts": 0,
+                        "created_at": now,
+                        "updated_at": now,
+                    },
+                    "$unset": {"error": ""},
+                },
+                projection={"files": 0},
+                return_document=ReturnDocument.AFTER,
+            )
+            job = reset or await db.transcode_jobs.find_one(
+                {"_id": blob_path}, {"files": 0}
+            )
+        if job is not None and job["status"] == "pending":
+            self.wakeup.set()
+        return job
+
+    async def run(self):
+        while True:
+            try:
+                job = await self.claim()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error claiming transcode job: {str(e)}")
+                job = None
+            if job is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), TRANSCODE_POLL_S)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.process(job)
+
+    async def claim(self) -> Optional[dict]:
+        """Lease the oldest pending job, or one whose worker stopped renewing it"""
+        while True:
+            now = datetime.utcnow()
+            job = await self.db.transcode_jobs.find_one_and_update(
+                {
+                    "$or": [
+                        {"status": "pending"},
+                        {"status": "running", "lease_until": {"$lt": now}},
+                    ]
+                },
+                {
+                    "$set": {
+                        "status": "running",
+                        "lease_id": uuid.uuid4().hex,
+                        "lease_until": now + timedelta(seconds=TRANSCODE_LEASE_S),
+                        "updated_at": now,
+                    },
+                    "$inc": {"attempts": 1},
+                },
+                sort=[("created_at", ASCENDING)],
+                return_document=ReturnDocument.AFTER,
+            )
+            if job is None or job["attempts"] <= TRANSCODE_MAX_ATTEMPTS:
+                return job
+            # Every earlier attempt died without reporting back
+            await self.finish(job, {"status": "failed", "error": "Too many attempts"})
+
+    async def renew_lease(self, job: dict):
+        while True:
+            await asyncio.sleep(TRANSCODE_LEASE_S / 3)
+            await self.db.transcode_jobs.update_one(
+                {"_id": job["_id"], "lease_id": job["lease_id"]},
+                {
+                    "$set": {
+                        "lease_until": datetime.utcnow()
+                        + timedelta(seconds=TRANSCODE_LEASE_S)
+                    }
+                },
+            )
+
+    async def finish(self, job: dict, update: dict) -> bool:
+        """Record a job's outcome; False if it is no longer this worker's"""
+        result = await self.db.transcode_jobs.update_one(
+            {"_id": job["_id"], "lease_id": job["lease_id"]},
+            {
+                "$set": {**update, "updated_at": datetime.utcnow()},
+                "$unset": {"lease_id": "", "lease_until": ""},
+            },
+        )
+        return bool(result.modified_count)
+
+    async def process(self, job: dict):
+        blob_path = job["_id"]
+        heartbeat = asyncio.create_task(self.renew_lease(job))
+        files = []
+        try:
+            files = await self.package(blob_path)
+            if files is None:
+                # The video was deleted before it could be packaged
+                await self.db.transcode_jobs.delete_one(
+                    {"_id": blob_path, "lease_id": job["lease_id"]}
+                )
+                return
+            if not await self.finish(job, {"status": "ready", "files": files}):
+                if await self.db.transcode_jobs.find_one({"_id": blob_path}) is None:
+                    # Deleted while packaging; nothing else will clean these up
+                    await run_in_threadpool(
+                        delete_assets, self.blob_store, blob_path, files
+                    )
+                return
+            self.stats["packaged"] += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error packaging {blob_path}: {str(e)}")
+            self.stats["failed"] += 1
+            retry = job["attempts"] < TRANSCODE_MAX_ATTEMPTS
+            await self.finish(
+                job, {"status": "pending" if retry else "failed", "error": str(e)}
+            )
+        finally:
+            heartbeat.cancel()
+
+    async def package(self, blob_path: str) -> Optional[List[str]]:
+        """Transcode a video and upload its package; None if the video is gone"""
+        store = self.blob_store
+        info = await run_in_threadpool(store.stat, blob_path)
+        if info is None:
+            return None
+        with tempfile.TemporaryDirectory(prefix="packaging-") as workdir:
+            video_path = os.path.join(workdir, "video")
+            output_dir = os.path.join(workdir, "package")
+            os.mkdir(output_dir)
+            await run_in_threadpool(self.download, info, video_path)
+            files = await asyncio.get_running_loop().run_in_executor(
+                self.executor, render_package, video_path, output_dir
+            )
+            # Manifests go last so a player never finds one with missing segments
+            files.sort(key=lambda name: name in (HLS_MANIFEST, DASH_MANIFEST))
+            for i, name in enumerate(files):
+                try:
+                    await run_in_threadpool(
+                        self.upload,
+                        os.path.join(output_dir, name),
+                        f"{package_prefix(blob_path)}/{name}",
+                    )
+                except Exception:
+                    await run_in_threadpool(
+                        delete_assets, store, blob_path, files[: i + 1]
+                    )
+                    raise
+        return files
+
+    def download(self, info, video_path: str):
+        with open(video_path, "wb") as f:
+            for chunk in self.blob_store.iter_range(info, 0, info.size - 1):
+                f.write(chunk)
+
+    def upload(self, file_path: str, blob_path: str):
+        writer = self.blob_store.open_writer(
+            blob_path, asset_content_type(os.path.basename(file_path))
+        )
+        try:
+            with open(file_path, "rb") as f:
+                while chunk := f.read(STREAM_CHUNK_SIZE):
+                    writer.write(chunk)
+            writer.close()
+        except Exception:
+            writer.terminate()
+            raise
+
+
+packaging_worker = PackagingWorker()
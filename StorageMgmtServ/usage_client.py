@@ -0,0 +1,122 @@
+from fastapi import HTTPException
+from typing import Optional
+from service_client import service_client
+import logging
+import os
+import httpx
+import dotenv
+
+# Load environment variables from .env file
+dotenv.load_dotenv()
+
+url = os.getenv("USAGE_MGMT_URL")
+USAGE_CLIENT_TIMEOUT_S = float(os.getenv("USAGE_CLIENT_TIMEOUT_S", "5"))
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class UsageClient:
+    """
+    Calls to UsageMntrServ through the shared inter-service client.
+
+    Uploads reserve bandwidth before any bytes are sent and then commit the
+    actual volume or release the reservation, so a failed upload is not charged.
+    Downloads record the bytes served directly.
+    """
+
+    def __init__(self):
+        self.target = service_client.target(
+            "usage", url, timeout_s=USAGE_CLIENT_TIMEOUT_S
+        )
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        token: str,
+        params: dict = None,
+        idempotent: bool = False,
+    ) -> httpx.Response:
+        try:
+            return await self.target.request(
+                method,
+                path,
+                idempotent=idempotent,
+                params=params,
+                headers={"Authorization": f"{token}"},
+            )
+        except httpx.HTTPError as e:
+            logger.error(f"Error calling usage service: {str(e)}")
+            raise HTTPException(status_code=503, detail="Usage service unavailable")
+
+    def check(self, response: httpx.Response):
+        # 400 is the usage service refusing the volume; anything else is a fault
+        if response.status_code == 400:
+            raise HTTPException(
+                status_code=400, detail="Daily bandwidth limit exceeded"
+            )
+        if response.status_code != 200:
+            logger.error(
+                f"Usage service returned {response.status_code}: {response.text}"
+            )
+            raise HTTPException(status_code=503, detail="Usage service unavailable")
+
+    async def record(self, token: str, volume_mb: float, operation_type: str):
+        """Charge usage that is about to be served; raises if over the limit"""
+        response = await self.request(
+            "POST",
+            "/usage/record/",
+            token,
+            {"volume_mb": volume_mb, "operation_type": operation_type},
+        )
+        self.check(response)
+
+    async def reserve(self, token: str, volume_mb: float, operation_type: str) -> str:
+        """Reserve usage ahead of a transfer; returns the reservation ID"""
+        response = await self.request(
+            "POST",
+            "/usage/reservations/",
+            token,
+            {"volume_mb": volume_mb, "operation_type": operation_type},
+        )
+        self.check(response)
+        return response.json()["reservation_id"]
+
+    async def commit(self, token: str, reservation_id: str, volume_mb: float) -> bool:
+        """Settle a reservation at the actual volume; False if that failed"""
+        return await self.settle(
+            "POST",
+            f"/usage/reservations/{reservation_id}/commit",
+            token,
+            {"volume_mb": volume_mb},
+        )
+
+    async def release(self, token: str, reservation_id: Optional[str]) -> bool:
+        """Refund a reservation; False if that failed"""
+        if reservation_id is None:
+            return True
+        return await self.settle(
+            "DELETE", f"/usage/reservations/{reservation_id}", token
+        )
+
+    async def settle(
+        self, method: str, path: str, token: str, params: dict = None
+    ) -> bool:
+        # The transfer has already succeeded or failed, so a settlement error is
+        # only logged; an unsettled reservation stays charged at the reserved volume.
+        # Settling twice is harmless (the second gets a 404), so it may be retried
+        try:
+            response = await self.request(method, path, token, params, True)
+        except HTTPException:
+            return False
+        if response.status_code != 200:
+            logger.error(
+                f"Usage service returned {response.status_code}: {response.text}"
+            )
+            return False
+        return True
+
+
+usage_client = UsageClient()
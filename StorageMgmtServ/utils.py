@@ -1,88 +1,225 @@
 from fastapi import HTTPException, UploadFile
-from pymongo.collection import Collection
-from google.cloud import storage
-from google.oauth2 import service_account
+from starlette.concurrency import run_in_threadpool
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.asynchronous.database import AsyncDatabase
+from pymongo.errors import DuplicateKeyError
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+import asyncio
+import hashlib
 import os
 import mimetypes
 import logging
-from models import UserStorage
-import httpx
+from models import BlobInfo, FileMetadata, QuotaPolicy, UserStorage
+from blob_store import create_blob_store
+from thumbnails import delete_previews
+from transcoding import delete_package, ensure_package_indexes
+from quotas import TokenBuckets
+import uuid
 import dotenv
 
 # Load environment variables from .env file
 dotenv.load_dotenv()
 
-url = os.getenv("USAGE_MGMT_URL")
-
 # Constants
-STORAGE_LIMIT_MB = 50
-ALERT_THRESHOLD = 0.8  # 80%
 BYTES_PER_MB = 1024 * 1024
-MAX_FILE_SIZE_MB = 25  # Maximum size for a single file
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Read uploads 1MB at a time
+FILES_PAGE_SIZE = 50  # Default number of files returned per listing page
+MAX_FILES_PAGE_SIZE = 200
+# Storage held for an upload that never finishes is given back after this long
+STORAGE_RESERVATION_TTL_S = int(os.getenv("STORAGE_RESERVATION_TTL_S", "900"))
+# Uploads are stored once per distinct content under this prefix
+CONTENT_PREFIX = "blobs/sha256"
+BLOB_CLAIM_ATTEMPTS = 5
+# A blob delete that has not finished in this long is assumed to have died
+BLOB_DELETE_STALE_S = 60
 ALLOWED_FILE_TYPES = {
     "video": [".mp4", ".mov", ".avi", ".mkv"],
 }
 
 
-class StorageConfig:
+class StorageManager:
     def __init__(self):
-        self.credentials_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
-        self.project_id = os.getenv("GCP_PROJECT_ID")
-        self.bucket_name = os.getenv("GCP_BUCKET_NAME")
+        # Backend is chosen by STORAGE_BACKEND; GCS connects lazily on first use
+        self.blob_store = create_blob_store()
+        self.logger = logging.getLogger(__name__)
 
-    def initialize_storage_client(self):
-        """Initialize Google Cloud Storage client with credentials"""
-        try:
-            # If credentials path is provided, use it
-            if self.credentials_path:
-                credentials = service_account.Credentials.from_service_account_file(
-                    self.credentials_path,
-                    scopes=["https://www.googleapis.com/auth/cloud-platform"],
-                )
-                storage_client = storage.Client(
-                    credentials=credentials, project=self.project_id
+    async def get_user_storage(
+        self, collection: AsyncCollection, username: str
+    ) -> UserStorage:
+        """Get or create user storage record"""
+        # Single round trip: insert the default record only if none exists yet
+        user_storage = await collection.find_one_and_update(
+            {"username": username},
+            {
+                "$setOnInsert": UserStorage(username=username).dict(
+                    by_alias=True, exclude={"username"}
                 )
-            else:
-                # Fall back to application default credentials
-                storage_client = storage.Client()
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return UserStorage(**user_storage)
 
-            # Verify bucket access
-            bucket = storage_client.bucket(self.bucket_name)
-            bucket.exists()  # This will verify credentials and bucket access
+    async def ensure_indexes(self, db: AsyncDatabase):
+        """Create the indexes that file lookups and listings rely on"""
+        await db.files.create_index(
+            [("username", ASCENDING), ("filename", ASCENDING)], unique=True
+        )
+        await db.userstorage.create_index([("username", ASCENDING)])
+        await ensure_package_indexes(db)
 
-            return storage_client
+    async def get_file(
+        self, collection: AsyncCollection, username: str, filename: str
+    ) -> Optional[FileMetadata]:
+        """Look up a single file's metadata with an indexed point query"""
+        file = await collection.find_one({"username": username, "filename": filename})
+        return FileMetadata(**file) if file else None
 
-        except Exception as e:
-            raise Exception(f"Failed to initialize storage client: {str(e)}")
+    async def list_files(
+        self,
+        collection: AsyncCollection,
+        username: str,
+        limit: int = FILES_PAGE_SIZE,
+        cursor: Optional[str] = None,
+    ) -> Tuple[List[FileMetadata], Optional[str]]:
+        """List a page of files ordered by filename, resuming after `cursor`"""
+        query = {"username": username}
+        if cursor:
+            query["filename"] = {"$gt": cursor}
+        # Fetch one extra document to know whether another page exists
+        docs = await (
+            collection.find(query, {"_id": 0, "username": 0})
+            .sort("filename", ASCENDING)
+            .limit(limit + 1)
+            .to_list()
+        )
+        files = [FileMetadata(**doc) for doc in docs[:limit]]
+        next_cursor = files[-1].filename if len(docs) > limit else None
+        return files, next_cursor
 
+    async def reserve_storage(
+        self,
+        collection: AsyncCollection,
+        username: str,
+        size_mb: float,
+        policy: QuotaPolicy,
+    ) -> Optional[str]:
+        """
+        Hold size_mb of the user's storage for an upload; returns the reservation ID,
+        or None if usage plus open reservations would exceed the limit.
 
-class StorageManager:
-    def __init__(self):
-        storage_config = StorageConfig()
-        self.storage_client = storage_config.initialize_storage_client()
-        self.bucket = self.storage_client.bucket(storage_config.bucket_name)
-        self.logger = logging.getLogger(__name__)
+        The check and the hold are one conditional update, so concurrent uploads
+        cannot together overshoot the limit. Expired reservations are dropped on
+        the way.
+        """
+        now = datetime.utcnow()
+        reservation = {
+            "id": uuid.uuid4().hex,
+            "mb": size_mb,
+            "expires_at": now + timedelta(seconds=STORAGE_RESERVATION_TTL_S),
+        }
+        active = {
+            "$filter": {
+                "input": {"$ifNull": ["$reservations", []]},
+                "cond": {"$gt": ["$$this.expires_at", now]},
+            }
+        }
+        reserved_mb = {"$sum": {"$map": {"input": active, "in": "$$this.mb"}}}
+        query = {
+            "username": username,
+            "$expr": {
+                "$lte": [
+                    {"$add": ["$current_usage_mb", reserved_mb]},
+                    policy.storage_limit_mb - size_mb,
+                ]
+            },
+        }
+        update = [
+            {
+                "$set": {
+                    "reservations": {"$concatArrays": [active, [reservation]]},
+                    "last_updated": now,
+                }
+            }
+        ]
+        for attempt in range(2):
+            if await collection.find_one_and_update(
+                query, update, projection={"_id": 1}
+            ):
+                return reservation["id"]
+            if attempt == 0:
+                # No match is either no record yet or no room; create and retry once
+                await self.get_user_storage(collection, username)
+        return None
 
-    async def get_user_storage(
-        self, collection: Collection, username: str
-    ) -> UserStorage:
-        """Get or create user storage record"""
+    async def release_storage(
+        self, collection: AsyncCollection, username: str, reservation_id: str
+    ):
+        """Give back storage held for an upload that did not complete"""
+        await collection.update_one(
+            {"username": username},
+            {"$pull": {"reservations": {"id": reservation_id}}},
+        )
+
+    async def add_file(
+        self,
+        db: AsyncDatabase,
+        username: str,
+        file_metadata: FileMetadata,
+        reservation_id: Optional[str] = None,
+    ) -> Optional[UserStorage]:
+        """
+        Record a new file and charge it to the user's storage, settling its
+        reservation in the same update; None if the name is taken.
+        """
         try:
-            user_storage = collection.find_one({"username": username})
-        except Exception as e:
-            pass
-        if user_storage is None:
-            user_storage = UserStorage(username=username)
-            collection.insert_one(user_storage.dict(by_alias=True))
+            await db.files.insert_one({"username": username, **file_metadata.dict()})
+        except DuplicateKeyError:
+            return None
+        update = {
+            "$inc": {"current_usage_mb": file_metadata.size_mb},
+            "$set": {"last_updated": datetime.utcnow()},
+        }
+        if reservation_id:
+            update["$pull"] = {"reservations": {"id": reservation_id}}
+        user_storage = await db.userstorage.find_one_and_update(
+            {"username": username},
+            update,
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
         return UserStorage(**user_storage)
 
-    def validate_file(self, file: UploadFile, file_size_mb: float):
+    async def remove_file(
+        self, db: AsyncDatabase, username: str, filename: str
+    ) -> Optional[FileMetadata]:
+        """Remove a file's metadata and release its storage; None if it does not exist"""
+        file = await db.files.find_one_and_delete(
+            {"username": username, "filename": filename}
+        )
+        if file is None:
+            return None
+        file_metadata = FileMetadata(**file)
+        await db.userstorage.update_one(
+            {"username": username},
+            {
+                "$inc": {"current_usage_mb": -file_metadata.size_mb},
+                "$set": {"last_updated": datetime.utcnow()},
+            },
+        )
+        return file_metadata
+
+    def validate_file(
+        self, file: UploadFile, file_size_mb: float, max_file_size_mb: float
+    ):
         """Validate file type and size"""
         # Check file size
-        if file_size_mb > MAX_FILE_SIZE_MB:
+        if file_size_mb > max_file_size_mb:
             raise HTTPException(
                 status_code=400,
-                detail=f"File size exceeds maximum limit of {MAX_FILE_SIZE_MB}MB",
+                detail=f"File size exceeds maximum limit of {max_file_size_mb:g}MB",
             )
 
         # Check file extension
@@ -103,36 +240,161 @@ class StorageManager:
 
         return mime_type
 
-    async def can_upload(
-        self, collection: Collection, username: str, file_size_mb: float
-    ) -> bool:
-        """Check if user can upload a file of given size"""
-        user_storage = await self.get_user_storage(collection, username)
-        return (user_storage.current_usage_mb + file_size_mb) <= STORAGE_LIMIT_MB
+    async def hash_upload(
+        self, file: UploadFile, reserved_mb: float, max_file_size_mb: float
+    ) -> Tuple[str, float]:
+        """
+        Read the spooled upload once to get its SHA-256 and size, enforcing size
+        limits as bytes arrive; the file is rewound for upload_stream.
+
+        Storage was reserved for the declared size, so a body larger than that
+        is refused rather than charged beyond the reservation.
+        """
+        max_bytes = min(max_file_size_mb, reserved_mb) * BYTES_PER_MB
+        digest = hashlib.sha256()
+        total_bytes = 0
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            total_bytes += len(chunk)
+            if total_bytes > max_bytes:
+                if total_bytes > max_file_size_mb * BYTES_PER_MB:
+                    detail = (
+                        f"File size exceeds maximum limit of {max_file_size_mb:g}MB"
+                    )
+                else:
+                    detail = "File is larger than its declared size"
+                raise HTTPException(status_code=400, detail=detail)
+            # hashlib releases the GIL on large buffers
+            await run_in_threadpool(digest.update, chunk)
+        await file.seek(0)
+        return digest.hexdigest(), total_bytes / BYTES_PER_MB
 
-    async def should_alert(self, collection: Collection, username: str) -> bool:
+    async def upload_stream(self, file: UploadFile, blob_name: str, mime_type: str):
+        """Stream an upload to the blob store chunk by chunk"""
+        writer = await run_in_threadpool(
+            self.blob_store.open_writer, blob_name, mime_type
+        )
+        try:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await run_in_threadpool(writer.write, chunk)
+            await run_in_threadpool(writer.close)
+        except Exception:
+            # Cancel the write so no partial object is left behind
+            await run_in_threadpool(writer.terminate)
+            raise
+
+    async def claim_blob(self, db: AsyncDatabase, digest: str) -> bool:
+        """
+        Take a reference to the content-addressed blob for digest, creating its
+        record if needed; True if the caller must write the blob.
+
+        Content that is already stored costs no upload. A record that a delete
+        is tearing down is waited for, or taken over once the delete is stale.
+        """
+        for attempt in range(BLOB_CLAIM_ATTEMPTS):
+            now = datetime.utcnow()
+            stale = now - timedelta(seconds=BLOB_DELETE_STALE_S)
+            try:
+                before = await db.blobs.find_one_and_update(
+                    {
+                        "_id": digest,
+                        "$or": [
+                            {"deleting_at": {"$exists": False}},
+                            {"deleting_at": {"$lt": stale}},
+                        ],
+                    },
+                    {
+                        "$inc": {"refcount": 1},
+                        "$unset": {"deleting_at": ""},
+                        "$setOnInsert": {
+                            "path": content_path(digest),
+                            "ready": False,
+                            "created_at": now,
+                        },
+                    },
+                    upsert=True,
+                    return_document=ReturnDocument.BEFORE,
+                )
+            except DuplicateKeyError:
+                # The record exists but is being deleted; the delete is quick
+                await asyncio.sleep(0.1 * (attempt + 1))
+                continue
+            # Written again if new, not yet finished by its first writer, or deleted
+            return before is None or not before["ready"] or "deleting_at" in before
+        raise HTTPException(
+            status_code=503, detail="Storage is busy. Please try again shortly."
+        )
+
+    async def mark_blob_ready(self, db: AsyncDatabase, digest: str):
+        await db.blobs.update_one({"_id": digest}, {"$set": {"ready": True}})
+
+    async def release_blob(self, db: AsyncDatabase, digest: str):
+        """Drop a reference; the last one deletes the blob"""
+        blob = await db.blobs.find_one_and_update(
+            {"_id": digest},
+            {"$inc": {"refcount": -1}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if blob is None or blob["refcount"] > 0:
+            return
+        # Claims are refused while deleting_at is set, so nothing can start
+        # referencing the blob between here and the delete
+        stamp = datetime.utcnow()
+        blob = await db.blobs.find_one_and_update(
+            {"_id": digest, "refcount": {"$lte": 0}, "deleting_at": {"$exists": False}},
+            {"$set": {"deleting_at": stamp}},
+        )
+        if blob is None:
+            return
+        await run_in_threadpool(self.delete_blob, blob["path"])
+        await delete_package(db, self.blob_store, blob["path"])
+        await db.blobs.delete_one({"_id": digest, "deleting_at": stamp})
+
+    async def release_file_blob(self, db: AsyncDatabase, file_metadata: FileMetadata):
+        """Release a removed file's content; files from before deduplication own their blob"""
+        if file_metadata.sha256:
+            await self.release_blob(db, file_metadata.sha256)
+        else:
+            await run_in_threadpool(self.delete_blob, file_metadata.file_path)
+            await delete_package(db, self.blob_store, file_metadata.file_path)
+
+    def delete_blob(self, blob_name: str):
+        """Delete a blob along with the preview images generated from it"""
+        self.blob_store.delete(blob_name)
+        delete_previews(self.blob_store, blob_name)
+
+    def get_blob(self, blob_name: str) -> Optional[BlobInfo]:
+        """Fetch blob metadata (size, etag, updated) or None if it does not exist"""
+        return self.blob_store.stat(blob_name)
+
+    def iter_blob_range(self, info: BlobInfo, start: int, end: int):
+        """Yield an inclusive byte span of a blob"""
+        return self.blob_store.iter_range(info, start, end)
+
+    def blob_file_path(self, info: BlobInfo) -> Optional[str]:
+        """Local file of a blob for zero-copy sends; None unless stored on local disk"""
+        return self.blob_store.local_path(info)
+
+    def should_alert(self, user_storage: UserStorage, policy: QuotaPolicy) -> bool:
         """Check if user should be alerted about storage usage"""
-        user_storage = await self.get_user_storage(collection, username)
-        return (user_storage.current_usage_mb / STORAGE_LIMIT_MB) >= ALERT_THRESHOLD
+        return storage_percentage(user_storage, policy) >= (
+            policy.storage_alert_threshold * 100
+        )
+
+
+def content_path(digest: str) -> str:
+    """Blob path for content with the given SHA-256, fanned out over prefixes"""
+    return f"{CONTENT_PREFIX}/{digest[:2]}/{digest[2:4]}/{digest}"
+
+
+def storage_percentage(user_storage: UserStorage, policy: QuotaPolicy) -> float:
+    """Share of the storage limit in use, as a percentage"""
+    if not policy.storage_limit_mb:
+        return 100.0
+    return (user_storage.current_usage_mb / policy.storage_limit_mb) * 100
 
 
 # Create storage manager instance
 storage_manager = StorageManager()
 
-
-# In StorageMgmtServ
-async def check_bandwidth(
-    username: str, file_size_mb: float, operation_type: str, token: str
-):
-    usage_url = f"{url}/usage/record/"
-    headers = {"Authorization": f"{token}"}
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            usage_url,
-            params={"volume_mb": file_size_mb, "operation_type": operation_type},
-            headers=headers,
-        )
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=400, detail="Daily bandwidth limit exceeded"
-            )
+# Upload rate limits for policies that set upload_rate_per_minute
+upload_rate_limits = TokenBuckets()
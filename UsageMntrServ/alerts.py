@@ -0,0 +1,93 @@
+from datetime import datetime
+from typing import AsyncIterator, Dict, Set
+import asyncio
+import json
+import logging
+import httpx
+import dotenv
+import os
+
+# Load environment variables from .env file
+dotenv.load_dotenv()
+
+# Optional endpoint that receives every new alert as a JSON POST
+ALERT_WEBHOOK_URL = os.getenv("ALERT_WEBHOOK_URL")
+ALERT_WEBHOOK_TIMEOUT_S = float(os.getenv("ALERT_WEBHOOK_TIMEOUT_S", "5"))
+ALERT_STREAM_KEEPALIVE_S = 15  # Idle SSE connections get a comment this often
+ALERT_STREAM_QUEUE_SIZE = 100  # Alerts buffered per slow SSE subscriber
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class AlertNotifier:
+    """
+    Pushes new alerts to subscribers so clients do not have to poll /usage/alerts/.
+
+    SSE subscribers only see alerts raised by this process; with several replicas,
+    use the webhook, which is called by whichever replica raised the alert.
+    """
+
+    def __init__(self):
+        self.subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self.client = None
+        self.tasks = set()
+
+    def start(self):
+        if ALERT_WEBHOOK_URL and self.client is None:
+            self.client = httpx.AsyncClient(timeout=ALERT_WEBHOOK_TIMEOUT_S)
+
+    async def stop(self):
+        if self.tasks:
+            await asyncio.wait(self.tasks, timeout=ALERT_WEBHOOK_TIMEOUT_S)
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def publish(self, alert: dict):
+        """Deliver a new alert to its user's SSE streams and the webhook"""
+        for queue in self.subscribers.get(alert["username"], ()):
+            try:
+                queue.put_nowait(alert)
+            except asyncio.QueueFull:
+                logger.warning(f"Dropped alert for slow subscriber {alert['username']}")
+        if self.client is not None:
+            # Sent in the background so recording usage never waits on the webhook
+            task = asyncio.create_task(self.post_webhook(alert))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def post_webhook(self, alert: dict):
+        try:
+            response = await self.client.post(
+                ALERT_WEBHOOK_URL,
+                content=json.dumps(alert, default=datetime.isoformat),
+                headers={"Content-Type": "application/json"},
+            )
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logger.error(f"Error sending alert webhook: {str(e)}")
+
+    async def stream(self, username: str) -> AsyncIterator[str]:
+        """Yield a user's new alerts as server-sent events until the client leaves"""
+        queue = asyncio.Queue(maxsize=ALERT_STREAM_QUEUE_SIZE)
+        self.subscribers.setdefault(username, set()).add(queue)
+        try:
+            while True:
+                try:
+                    alert = await asyncio.wait_for(
+                        queue.get(), ALERT_STREAM_KEEPALIVE_S
+                    )
+                except asyncio.TimeoutError:
+                    yield f": keepalive {datetime.utcnow().isoformat()}\n\n"
+                    continue
+                yield f"event: alert\ndata: {json.dumps(alert, default=datetime.isoformat)}\n\n"
+        finally:
+            subscribers = self.subscribers.get(username)
+            subscribers.discard(queue)
+            if not subscribers:
+                del self.subscribers[username]
+
+
+alert_notifier = AlertNotifier()
@@ -1,15 +1,14 @@
-from jose import JWTError, jwt
 from dotenv import load_dotenv
 import os
 from fastapi import HTTPException, Security, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from tokens import InvalidTokenError, token_verifier
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Security Configuration
-SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = os.getenv("ALGORITHM")
+# Users allowed to query usage beyond their own (comma-separated usernames)
+ADMIN_USERNAMES = set(filter(None, os.getenv("ADMIN_USERNAMES", "").split(",")))
 
 # Security scheme for HTTP Bearer authentication
 security = HTTPBearer()
@@ -32,14 +31,15 @@ async def get_current_user(
     """
     token = credentials.credentials
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        # Claims are cached per token, so repeat requests skip the signature check
+        payload = await token_verifier.verify(token)
         username = payload.get("sub")
         if username is None:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid token",
             )
-    except JWTError:
+    except InvalidTokenError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid token",
@@ -0,0 +1,26 @@
+"""
+One-shot rebuild of the `monthly_usage` rollups from `daily_usage`.
+
+Run from the UsageMntrServ directory with the usual MongoDB environment variables:
+
+    python backfill_monthly_usage.py
+
+Every month's rollup is replaced by the sum of its daily records, so the script
+can be re-run to repair rollups. The service itself only keeps the last two
+months up to date, so this is needed once for older history.
+"""
+
+import asyncio
+from connection import get_database
+from history import rebuild_monthly_rollups
+from utils import UsageMonitor
+
+
+async def backfill(db):
+    await UsageMonitor.ensure_indexes(db)
+    await rebuild_monthly_rollups(db)
+    print(f"Rebuilt {await db.monthly_usage.count_documents({})} monthly rollups")
+
+
+if __name__ == "__main__":
+    asyncio.run(backfill(get_database()))
@@ -0,0 +1,267 @@
+from pymongo import UpdateOne
+from pymongo.asynchronous.database import AsyncDatabase
+from pymongo.errors import BulkWriteError
+from datetime import date, datetime
+from typing import Dict, List, Optional, Tuple
+from models import QuotaPolicy, UsageRecord
+from utils import UsageMonitor
+from quotas import quota_policies
+import asyncio
+import logging
+import os
+import time
+import zlib
+import dotenv
+
+# Load environment variables from .env file
+dotenv.load_dotenv()
+
+# "memory" serves /usage/record/ from in-process counters; "db" writes every call
+USAGE_COUNTER_MODE = os.getenv("USAGE_COUNTER_MODE", "db").lower()
+USAGE_COUNTER_SHARDS = int(os.getenv("USAGE_COUNTER_SHARDS", "16"))
+USAGE_COUNTER_FLUSH_MS = int(os.getenv("USAGE_COUNTER_FLUSH_MS", "500"))
+# Counters not refreshed from daily_usage for this long are re-read before a check
+USAGE_COUNTER_REFRESH_MS = int(os.getenv("USAGE_COUNTER_REFRESH_MS", "5000"))
+# Number of replicas sharing the limit; each may spend 1/N of the remaining headroom
+# between refreshes, so together they cannot overshoot it
+USAGE_COUNTER_REPLICAS = int(os.getenv("USAGE_COUNTER_REPLICAS", "1"))
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CounterKey = Tuple[str, str]  # (username, ISO date)
+
+
+class Counter:
+    """One user's usage for one day: the last stored totals plus unflushed deltas"""
+
+    __slots__ = (
+        "upload_mb",
+        "download_mb",
+        "pending_upload_mb",
+        "pending_download_mb",
+        "allowance_mb",
+        "refreshed_at",
+    )
+
+    def __init__(self):
+        self.upload_mb = self.download_mb = 0.0
+        self.pending_upload_mb = self.pending_download_mb = 0.0
+        self.allowance_mb = 0.0
+        self.refreshed_at = 0.0
+
+    @property
+    def total_mb(self) -> float:
+        return self.upload_mb + self.download_mb
+
+    @property
+    def pending_mb(self) -> float:
+        return self.pending_upload_mb + self.pending_download_mb
+
+    def refresh(self, stored: Optional[dict], limit_mb: float):
+        """Rebase on the stored totals, keeping deltas not yet flushed"""
+        stored = stored or {}
+        stored_total = stored.get("upload_volume_mb", 0) + stored.get(
+            "download_volume_mb", 0
+        )
+        self.upload_mb = stored.get("upload_volume_mb", 0) + self.pending_upload_mb
+        self.download_mb = (
+            stored.get("download_volume_mb", 0) + self.pending_download_mb
+        )
+        headroom = max(limit_mb - stored_total, 0)
+        self.allowance_mb = headroom / USAGE_COUNTER_REPLICAS
+        self.refreshed_at = time.monotonic()
+
+
+class UsageCounters:
+    """
+    Per-user daily usage counters held in memory and flushed to daily_usage.
+
+    Limit checks and increments touch only the in-process counter, so a hot user
+    costs no database round trip. Every USAGE_COUNTER_FLUSH_MS the accumulated
+    deltas are written with one unordered bulk_write of $inc upserts per shard.
+    Because $inc is commutative, replicas merge by simply adding their deltas;
+    after each flush the counters are re-read, which picks up what the other
+    replicas have spent. Deltas not yet flushed when a process dies are lost,
+    which bounds under-counting to one flush interval.
+    """
+
+    def __init__(self, shard_count: int):
+        self.shards: List[Dict[CounterKey, Counter]] = [{} for _ in range(shard_count)]
+        self.flushing = False
+        self.task = None
+
+    def shard(self, username: str) -> Dict[CounterKey, Counter]:
+        return self.shards[zlib.crc32(username.encode()) % len(self.shards)]
+
+    async def get_counter(self, db: AsyncDatabase, username: str) -> Counter:
+        """Return today's counter, loading it from daily_usage when missing or stale"""
+        key = (username, date.today().isoformat())
+        shard = self.shard(username)
+        counter = shard.get(key)
+        stale_after = USAGE_COUNTER_REFRESH_MS / 1000
+        if counter is not None and (
+            self.flushing or time.monotonic() - counter.refreshed_at < stale_after
+        ):
+            return counter
+        stored = await db.daily_usage.find_one(
+            {"username": username, "date": key[1]}, {"_id": 0}
+        )
+        # Another request may have created the counter while we were waiting
+        counter = shard.setdefault(key, Counter())
+        counter.refresh(stored, quota_policies.get(username).bandwidth_limit_mb)
+        return counter
+
+    async def record(
+        self,
+        db: AsyncDatabase,
+        username: str,
+        volume_mb: float,
+        operation_type: str,
+        policy: QuotaPolicy,
+        enforce_limit: bool = True,
+    ) -> Optional[float]:
+        """
+        Record usage in memory; returns the day's total, or None if an upload would
+        exceed the limit. Rolling-window policies need the stored hourly buckets, so
+        those users are recorded through UsageMonitor.record_usage instead.
+        Corrections such as reservation refunds pass enforce_limit=False.
+        """
+        if policy.bandwidth_window != "calendar_day":
+            return await UsageMonitor.record_usage(
+                db.daily_usage, db.alerts, username, volume_mb, operation_type, policy
+            )
+        counter = await self.get_counter(db, username)
+        previous_mb = counter.total_mb
+        if operation_type == "upload":
+            spent = counter.pending_mb + volume_mb
+            if enforce_limit and (
+                spent > counter.allowance_mb
+                or counter.total_mb + volume_mb > policy.bandwidth_limit_mb
+            ):
+                return None
+            counter.upload_mb += volume_mb
+            counter.pending_upload_mb += volume_mb
+        else:
+            counter.download_mb += volume_mb
+            counter.pending_download_mb += volume_mb
+
+        await UsageMonitor.check_alerts(
+            db.alerts,
+            username,
+            previous_mb,
+            counter.total_mb,
+            policy.bandwidth_limit_mb,
+        )
+        return counter.total_mb
+
+    async def get_usage(self, db: AsyncDatabase, username: str) -> UsageRecord:
+        return self.usage_record(username, await self.get_counter(db, username))
+
+    def usage_record(self, username: str, counter: Counter) -> UsageRecord:
+        return UsageRecord(
+            username=username,
+            date=date.today().isoformat(),
+            upload_volume_mb=counter.upload_mb,
+            download_volume_mb=counter.download_mb,
+        )
+
+    async def flush(self, db: AsyncDatabase):
+        """Write every shard's pending deltas, then re-read the flushed counters"""
+        self.flushing = True
+        try:
+            for shard in self.shards:
+                await self.flush_shard(db, shard)
+        finally:
+            self.flushing = False
+
+    async def flush_shard(self, db: AsyncDatabase, shard: Dict[CounterKey, Counter]):
+        today = date.today().isoformat()
+        now = datetime.utcnow()
+        operations = []
+        flushed = []
+        # No await until the deltas are taken, so nothing recorded meanwhile is lost
+        for key, counter in list(shard.items()):
+            if not counter.pending_mb:
+                if key[1] != today:
+                    del shard[key]  # Yesterday's counters are no longer needed
+                continue
+            upload, download = counter.pending_upload_mb, counter.pending_download_mb
+            counter.pending_upload_mb = counter.pending_download_mb = 0.0
+            # Flushed deltas still count against this replica's allowance
+            counter.allowance_mb -= upload + download
+            operations.append(
+                UpdateOne(
+                    {"username": key[0], "date": key[1]},
+                    {
+                        "$inc": {
+                            "upload_volume_mb": upload,
+                            "download_volume_mb": download,
+                            "total_volume_mb": upload + download,
+                        },
+                        "$set": {"last_updated": now},
+                    },
+                    upsert=True,
+                )
+            )
+            flushed.append((key, counter, upload, download))
+        if not operations:
+            return
+
+        failed = set()
+        try:
+            await db.daily_usage.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            failed = {error["index"] for error in e.details.get("writeErrors", [])}
+        except Exception as e:
+            logger.error(f"Error flushing usage counters: {str(e)}")
+            failed = set(range(len(operations)))
+        for index, (key, counter, upload, download) in enumerate(flushed):
+            if index in failed:
+                # Put the deltas back so the next flush retries them
+                counter.pending_upload_mb += upload
+                counter.pending_download_mb += download
+                counter.allowance_mb += upload + download
+
+        # Merge in what other replicas have written since the last refresh
+        by_date = {}
+        for (username, day), counter, _, _ in flushed:
+            by_date.setdefault(day, {})[username] = counter
+        for day, counters in by_date.items():
+            async for stored in db.daily_usage.find(
+                {"date": day, "username": {"$in": list(counters)}}, {"_id": 0}
+            ):
+                username = stored["username"]
+                counters[username].refresh(
+                    stored, quota_policies.get(username).bandwidth_limit_mb
+                )
+
+    def start(self, db: AsyncDatabase):
+        """Start the periodic flush task"""
+        if self.task is None:
+            self.task = asyncio.create_task(self.run(db))
+
+    async def stop(self, db: AsyncDatabase):
+        """Stop the flush task and write out the remaining deltas"""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush(db)
+
+    async def run(self, db: AsyncDatabase):
+        while True:
+            await asyncio.sleep(USAGE_COUNTER_FLUSH_MS / 1000)
+            try:
+                await self.flush(db)
+            except Exception as e:
+                logger.error(f"Error flushing usage counters: {str(e)}")
+
+
+usage_counters = (
+    UsageCounters(USAGE_COUNTER_SHARDS) if USAGE_COUNTER_MODE == "memory" else None
+)
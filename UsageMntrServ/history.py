@@ -0,0 +1,287 @@
+from pymongo import ASCENDING, DESCENDING
+from pymongo.asynchronous.database import AsyncDatabase
+from datetime import date, datetime, timedelta
+from typing import List, Optional
+import asyncio
+import logging
+import os
+import dotenv
+
+# Load environment variables from .env file
+dotenv.load_dotenv()
+
+# Constants
+HISTORY_GRANULARITIES = ("daily", "weekly", "monthly")
+HISTORY_DEFAULT_DAYS = 30  # Range returned when no start date is given
+MAX_HISTORY_DAYS = 5 * 366
+TOP_USERS_LIMIT = 10
+MAX_TOP_USERS_LIMIT = 100
+USAGE_FIELDS = {"upload_volume_mb": 1, "download_volume_mb": 1, "total_volume_mb": 1}
+# Monthly rollups are re-derived from daily_usage this often, off the request path
+MONTHLY_ROLLUP_INTERVAL_S = float(os.getenv("MONTHLY_ROLLUP_INTERVAL_S", "300"))
+ROLLUP_USER_BATCH_SIZE = 1000
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def ensure_history_indexes(db: AsyncDatabase):
+    """Create the indexes that history and top-user queries rely on"""
+    await db.monthly_usage.create_index(
+        [("username", ASCENDING), ("month", ASCENDING)], unique=True
+    )
+    # Top-N for one day or one month is an index walk that stops after N entries
+    await db.daily_usage.create_index(
+        [("date", ASCENDING), ("total_volume_mb", DESCENDING)]
+    )
+    await db.monthly_usage.create_index(
+        [("month", ASCENDING), ("total_volume_mb", DESCENDING)]
+    )
+
+
+async def rebuild_monthly_rollups(
+    db: AsyncDatabase,
+    first_month: Optional[str] = None,
+    usernames: Optional[List[str]] = None,
+):
+    """
+    Replace monthly rollups with the sums of their daily records, from first_month
+    ("YYYY-MM") on and for the given users; everything when both are None.
+    """
+    match = {}
+    if first_month is not None:
+        match["date"] = {"$gte": f"{first_month}-01"}
+    if usernames is not None:
+        match["username"] = {"$in": usernames}
+    cursor = await db.daily_usage.aggregate(
+        [
+            {"$match": match},
+            {
+                "$group": {
+                    "_id": {
+                        "username": "$username",
+                        "month": {"$substr": ["$date", 0, 7]},
+                    },
+                    "upload_volume_mb": {"$sum": "$upload_volume_mb"},
+                    "download_volume_mb": {"$sum": "$download_volume_mb"},
+                    "total_volume_mb": {"$sum": "$total_volume_mb"},
+                    "last_updated": {"$max": "$last_updated"},
+                }
+            },
+            {
+                "$project": {
+                    "_id": 0,
+                    "username": "$_id.username",
+                    "month": "$_id.month",
+                    "upload_volume_mb": 1,
+                    "download_volume_mb": 1,
+                    "total_volume_mb": 1,
+                    "last_updated": 1,
+                }
+            },
+            {
+                "$merge": {
+                    "into": "monthly_usage",
+                    "on": ["username", "month"],
+                    "whenMatched": "replace",
+                    "whenNotMatched": "insert",
+                }
+            },
+        ],
+        allowDiskUse=True,
+    )
+    await cursor.to_list()
+
+
+class MonthlyRollups:
+    """
+    Keeps monthly_usage in step with daily_usage in the background.
+
+    Recording usage only writes the day's record. Every MONTHLY_ROLLUP_INTERVAL_S
+    the rollups of users whose daily records changed since the previous pass are
+    recomputed from those records for this month and last, so monthly history
+    and top-user queries lag by at most one interval. Recomputing replaces rather
+    than increments, so overlapping passes from several replicas are harmless.
+    """
+
+    def __init__(self):
+        self.task = None
+        self.last_pass = None
+
+    def start(self, db: AsyncDatabase):
+        """Start the periodic rollup task"""
+        if self.task is None:
+            self.task = asyncio.create_task(self.run(db))
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self, db: AsyncDatabase):
+        while True:
+            try:
+                await self.refresh(db)
+            except Exception as e:
+                logger.error(f"Error updating monthly usage rollups: {str(e)}")
+            await asyncio.sleep(MONTHLY_ROLLUP_INTERVAL_S)
+
+    async def refresh(self, db: AsyncDatabase):
+        started = datetime.utcnow()
+        # Last month is included so corrections made just after it ended land
+        first_month = (date.today().replace(day=1) - timedelta(days=1)).isoformat()[:7]
+        match = {"date": {"$gte": f"{first_month}-01"}}
+        if self.last_pass is not None:
+            # Overlap the previous pass so writes it raced with are not missed
+            match["last_updated"] = {
+                "$gte": self.last_pass - timedelta(seconds=MONTHLY_ROLLUP_INTERVAL_S)
+            }
+        cursor = await db.daily_usage.aggregate(
+            [{"$match": match}, {"$group": {"_id": "$username"}}]
+        )
+        batch = []
+        async for user in cursor:
+            batch.append(user["_id"])
+            if len(batch) >= ROLLUP_USER_BATCH_SIZE:
+                await rebuild_monthly_rollups(db, first_month, batch)
+                batch = []
+        if batch:
+            await rebuild_monthly_rollups(db, first_month, batch)
+        self.last_pass = started
+
+
+monthly_rollups = MonthlyRollups()
+
+
+async def usage_history(
+    db: AsyncDatabase, username: str, start: date, end: date, granularity: str
+) -> List[dict]:
+    """
+    Upload and download totals per day, ISO week or calendar month.
+
+    Monthly periods come from the monthly rollups and cover every calendar month
+    the range touches, so a year of history reads 12 documents. The current
+    month can trail daily usage by up to MONTHLY_ROLLUP_INTERVAL_S.
+    """
+    if granularity == "monthly":
+        return await (
+            db.monthly_usage.find(
+                {
+                    "username": username,
+                    "month": {
+                        "$gte": start.isoformat()[:7],
+                        "$lte": end.isoformat()[:7],
+                    },
+                },
+                {"_id": 0, "period": "$month", **USAGE_FIELDS},
+            )
+            .sort("month", ASCENDING)
+            .to_list()
+        )
+
+    match = {
+        "username": username,
+        "date": {"$gte": start.isoformat(), "$lte": end.isoformat()},
+    }
+    if granularity == "daily":
+        return await (
+            db.daily_usage.find(match, {"_id": 0, "period": "$date", **USAGE_FIELDS})
+            .sort("date", ASCENDING)
+            .to_list()
+        )
+
+    cursor = await db.daily_usage.aggregate(
+        [
+            {"$match": match},
+            {
+                "$group": {
+                    "_id": {
+                        "$dateTrunc": {
+                            "date": {"$dateFromString": {"dateString": "$date"}},
+                            "unit": "week",
+                            "startOfWeek": "monday",
+                        }
+                    },
+                    "upload_volume_mb": {"$sum": "$upload_volume_mb"},
+                    "download_volume_mb": {"$sum": "$download_volume_mb"},
+                    "total_volume_mb": {"$sum": "$total_volume_mb"},
+                }
+            },
+            {"$sort": {"_id": 1}},
+            {
+                "$project": {
+                    "_id": 0,
+                    "period": {"$dateToString": {"date": "$_id", "format": "%Y-%m-%d"}},
+                    **USAGE_FIELDS,
+                }
+            },
+        ]
+    )
+    return await cursor.to_list()
+
+
+def covers_whole_months(start: date, end: date) -> bool:
+    """True if the range starts on the 1st and ends on a month end (or today)"""
+    return start.day == 1 and (
+        (end + timedelta(days=1)).day == 1 or end >= date.today()
+    )
+
+
+async def top_users(
+    db: AsyncDatabase, start: date, end: date, limit: int
+) -> List[dict]:
+    """
+    The heaviest users by total volume over a date range.
+
+    A single day or month is read straight off a (period, total) index. Longer
+    ranges aggregate the monthly rollups when they align to whole months, so only
+    the daily documents of partial-month ranges are ever grouped.
+    """
+    projection = {"_id": 0, "username": 1, **USAGE_FIELDS}
+    if start == end:
+        return await (
+            db.daily_usage.find({"date": start.isoformat()}, projection)
+            .sort("total_volume_mb", DESCENDING)
+            .limit(limit)
+            .to_list()
+        )
+
+    if covers_whole_months(start, end):
+        collection = db.monthly_usage
+        first, last = start.isoformat()[:7], end.isoformat()[:7]
+        if first == last:
+            return await (
+                collection.find({"month": first}, projection)
+                .sort("total_volume_mb", DESCENDING)
+                .limit(limit)
+                .to_list()
+            )
+        match = {"month": {"$gte": first, "$lte": last}}
+    else:
+        collection = db.daily_usage
+        match = {"date": {"$gte": start.isoformat(), "$lte": end.isoformat()}}
+
+    cursor = await collection.aggregate(
+        [
+            {"$match": match},
+            {
+                "$group": {
+                    "_id": "$username",
+                    "upload_volume_mb": {"$sum": "$upload_volume_mb"},
+                    "download_volume_mb": {"$sum": "$download_volume_mb"},
+                    "total_volume_mb": {"$sum": "$total_volume_mb"},
+                }
+            },
+            # $sort followed by $limit keeps only the top N in memory
+            {"$sort": {"total_volume_mb": -1}},
+            {"$limit": limit},
+            {"$project": {"_id": 0, "username": "$_id", **USAGE_FIELDS}},
+        ],
+        allowDiskUse=True,
+    )
+    return await cursor.to_list()
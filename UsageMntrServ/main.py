@@ -1,16 +1,64 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
-from datetime import date
+from fastapi.responses import StreamingResponse
+from contextlib import asynccontextmanager
+from datetime import date, timedelta
 from typing import Optional
-from connection import get_db
-from auth import get_current_user
-from log import send_log
-from pymongo.collection import Collection
+from connection import close_database, get_database, get_db
+from auth import ADMIN_USERNAMES, get_current_user
+from log import log_shipper, send_log
+from service_client import service_client
+from pymongo.asynchronous.database import AsyncDatabase
+from bson import ObjectId
+from bson.errors import InvalidId
 import logging
-from utils import UsageMonitor, DAILY_BANDWIDTH_LIMIT_MB
+from utils import UsageMonitor
+from counters import usage_counters
+from quotas import quota_policies
+from models import QuotaOverride, QuotaPolicy
+from alerts import alert_notifier
+from history import (
+    HISTORY_DEFAULT_DAYS,
+    HISTORY_GRANULARITIES,
+    MAX_HISTORY_DAYS,
+    MAX_TOP_USERS_LIMIT,
+    TOP_USERS_LIMIT,
+    monthly_rollups,
+    top_users,
+    usage_history,
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create indexes once at startup rather than on the request path
+    db = get_database()
+    await UsageMonitor.ensure_indexes(db)
+    # Policies are cached so quota checks never wait on the database
+    await quota_policies.load(db)
+    quota_policies.start(db)
+    if usage_counters:
+        usage_counters.start(db)
+    monthly_rollups.start(db)
+    service_client.start()
+    alert_notifier.start()
+    log_shipper.start()
+    yield
+    await alert_notifier.stop()
+    await quota_policies.stop()
+    await monthly_rollups.stop()
+    if usage_counters:
+        # Write out usage still held in memory
+        await usage_counters.stop(db)
+    # Drain queued log entries before shutting down
+    await log_shipper.stop()
+    # Closed last since everything above may still call other services
+    await service_client.stop()
+    await close_database()
+
 
 # Initialize FastAPI app
-app = FastAPI(title="Usage Monitor Service")
+app = FastAPI(title="Usage Monitor Service", lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -26,12 +74,77 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+async def record_usage(
+    db: AsyncDatabase,
+    username: str,
+    volume_mb: float,
+    operation_type: str,
+    policy: QuotaPolicy,
+) -> Optional[float]:
+    """Check the limit and record usage; None if the limit would be exceeded"""
+    if usage_counters:
+        return await usage_counters.record(
+            db, username, volume_mb, operation_type, policy
+        )
+    # Check the limit and record usage in one atomic update
+    return await UsageMonitor.record_usage(
+        db.daily_usage, db.alerts, username, volume_mb, operation_type, policy
+    )
+
+
+async def adjust_reserved_usage(
+    db: AsyncDatabase, reservation: dict, volume_mb: float, policy: QuotaPolicy
+):
+    """Correct usage charged by a reservation; corrections are never refused"""
+    if not volume_mb:
+        return
+    if (
+        usage_counters
+        and policy.bandwidth_window == "calendar_day"
+        and reservation["date"] == date.today().isoformat()
+    ):
+        await usage_counters.record(
+            db,
+            reservation["username"],
+            volume_mb,
+            reservation["operation_type"],
+            policy,
+            enforce_limit=False,
+        )
+    else:
+        await UsageMonitor.adjust_usage(
+            db,
+            reservation["username"],
+            reservation["date"],
+            volume_mb,
+            reservation["operation_type"],
+            policy,
+        )
+
+
+async def take_reservation(
+    db: AsyncDatabase, reservation_id: str, username: str
+) -> dict:
+    """Remove and return one of the user's open reservations"""
+    try:
+        object_id = ObjectId(reservation_id)
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Invalid reservation ID")
+    # Deleting it is what makes commit and release happen at most once
+    reservation = await db.bandwidth_reservations.find_one_and_delete(
+        {"_id": object_id, "username": username}
+    )
+    if reservation is None:
+        raise HTTPException(status_code=404, detail="Reservation not found")
+    return reservation
+
+
 # API Endpoints
 @app.post("/usage/record/")
 async def record_bandwidth_usage(
     volume_mb: float,
     operation_type: str,
-    db: Collection = Depends(get_db),
+    db: AsyncDatabase = Depends(get_db),
     user: dict = Depends(get_current_user),
 ):
     username = user.get("username")
@@ -45,47 +158,160 @@ async def record_bandwidth_usage(
                 detail="Invalid operation type. Must be 'upload' or 'download'",
             )
 
-        # Check if can use bandwidth (for uploads)
-        if operation_type == "upload":
-            if not await UsageMonitor.can_use_bandwidth(
-                db.daily_usage, username, volume_mb
-            ):
-                send_log(
-                    username, "UsageMntrServ", "ERROR", "Daily bandwidth limit exceeded"
-                )
-                raise HTTPException(
-                    status_code=400, detail="Daily bandwidth limit exceeded"
-                )
-
-        # Record usage
-        await UsageMonitor.record_usage(
-            db.daily_usage, db.alerts, username, volume_mb, operation_type
-        )
-
-        # Get updated usage
-        usage = await UsageMonitor.get_daily_usage(db.daily_usage, username)
+        policy = quota_policies.get(username)
+        usage_mb = await record_usage(db, username, volume_mb, operation_type, policy)
+        if usage_mb is None:
+            send_log(
+                username, "UsageMntrServ", "ERROR", "Daily bandwidth limit exceeded"
+            )
+            raise HTTPException(
+                status_code=400, detail="Daily bandwidth limit exceeded"
+            )
 
         send_log(username, "UsageMntrServ", "INFO", "Usage recorded successfully")
         return {
             "message": "Usage recorded successfully",
-            "current_usage_mb": usage.total_volume_mb,
-            "remaining_mb": DAILY_BANDWIDTH_LIMIT_MB - usage.total_volume_mb,
+            "current_usage_mb": usage_mb,
+            "remaining_mb": policy.bandwidth_limit_mb - usage_mb,
         }
 
+    except HTTPException as e:
+        raise e
     except Exception as e:
         send_log(username, "UsageMntrServ", "ERROR", f"Error recording usage: {str(e)}")
         logger.error(f"Error recording usage for user {username}: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/usage/reservations/")
+async def reserve_bandwidth(
+    volume_mb: float = Query(..., ge=0),
+    operation_type: str = "upload",
+    db: AsyncDatabase = Depends(get_db),
+    user: dict = Depends(get_current_user),
+):
+    """
+    Charge bandwidth up front for a transfer that has not happened yet.
+
+    The charge is final unless the reservation is committed with the actual volume
+    or released within RESERVATION_TTL_S, so an abandoned transfer can never be
+    used to get around the limit.
+    """
+    username = user.get("username")
+    try:
+        if operation_type not in ["upload", "download"]:
+            raise HTTPException(
+                status_code=400,
+                detail="Invalid operation type. Must be 'upload' or 'download'",
+            )
+
+        policy = quota_policies.get(username)
+        usage_mb = await record_usage(db, username, volume_mb, operation_type, policy)
+        if usage_mb is None:
+            send_log(
+                username, "UsageMntrServ", "ERROR", "Daily bandwidth limit exceeded"
+            )
+            raise HTTPException(
+                status_code=400, detail="Daily bandwidth limit exceeded"
+            )
+        reservation_id, reservation = await UsageMonitor.create_reservation(
+            db.bandwidth_reservations, username, volume_mb, operation_type
+        )
+
+        send_log(username, "UsageMntrServ", "INFO", "Bandwidth reserved")
+        return {
+            "reservation_id": reservation_id,
+            "expires_at": reservation.expires_at,
+            "current_usage_mb": usage_mb,
+            "remaining_mb": policy.bandwidth_limit_mb - usage_mb,
+        }
+
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        send_log(
+            username, "UsageMntrServ", "ERROR", f"Error reserving bandwidth: {str(e)}"
+        )
+        logger.error(f"Error reserving bandwidth for user {username}: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/usage/reservations/{reservation_id}/commit")
+async def commit_bandwidth_reservation(
+    reservation_id: str,
+    volume_mb: float = Query(..., ge=0),
+    db: AsyncDatabase = Depends(get_db),
+    user: dict = Depends(get_current_user),
+):
+    """Settle a reservation at the volume actually transferred"""
+    username = user.get("username")
+    try:
+        reservation = await take_reservation(db, reservation_id, username)
+        await adjust_reserved_usage(
+            db,
+            reservation,
+            volume_mb - reservation["volume_mb"],
+            quota_policies.get(username),
+        )
+        send_log(username, "UsageMntrServ", "INFO", "Bandwidth reservation committed")
+        return {"message": "Reservation committed", "volume_mb": volume_mb}
+
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        send_log(
+            username,
+            "UsageMntrServ",
+            "ERROR",
+            f"Error committing reservation: {str(e)}",
+        )
+        logger.error(f"Error committing reservation for user {username}: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.delete("/usage/reservations/{reservation_id}")
+async def release_bandwidth_reservation(
+    reservation_id: str,
+    db: AsyncDatabase = Depends(get_db),
+    user: dict = Depends(get_current_user),
+):
+    """Refund a reservation whose transfer did not happen"""
+    username = user.get("username")
+    try:
+        reservation = await take_reservation(db, reservation_id, username)
+        await adjust_reserved_usage(
+            db, reservation, -reservation["volume_mb"], quota_policies.get(username)
+        )
+        send_log(username, "UsageMntrServ", "INFO", "Bandwidth reservation released")
+        return {"message": "Reservation released"}
+
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        send_log(
+            username, "UsageMntrServ", "ERROR", f"Error releasing reservation: {str(e)}"
+        )
+        logger.error(f"Error releasing reservation for user {username}: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.get("/usage/status/")
 async def get_usage_status(
-    db: Collection = Depends(get_db), user: dict = Depends(get_current_user)
+    db: AsyncDatabase = Depends(get_db), user: dict = Depends(get_current_user)
 ):
     username = user.get("username")
     """Get current day's usage status for a user"""
     try:
-        usage = await UsageMonitor.get_daily_usage(db.daily_usage, username)
+        policy = quota_policies.get(username)
+        if usage_counters:
+            usage = await usage_counters.get_usage(db, username)
+        else:
+            usage = await UsageMonitor.get_daily_usage(db.daily_usage, username)
+        window_usage_mb = usage.total_volume_mb
+        if policy.bandwidth_window == "rolling_24h":
+            window_usage_mb = await UsageMonitor.get_rolling_usage(
+                db.rolling_usage, username
+            )
         try:
             usage.date = usage.date.isoformat()
         except Exception as e:
@@ -99,10 +325,15 @@ async def get_usage_status(
             "upload_volume_mb": usage.upload_volume_mb,
             "download_volume_mb": usage.download_volume_mb,
             "total_volume_mb": usage.total_volume_mb,
-            "daily_limit_mb": DAILY_BANDWIDTH_LIMIT_MB,
-            "remaining_mb": DAILY_BANDWIDTH_LIMIT_MB - usage.total_volume_mb,
-            "usage_percentage": (usage.total_volume_mb / DAILY_BANDWIDTH_LIMIT_MB)
-            * 100,
+            "plan": policy.plan,
+            "bandwidth_window": policy.bandwidth_window,
+            "daily_limit_mb": policy.bandwidth_limit_mb,
+            "remaining_mb": policy.bandwidth_limit_mb - window_usage_mb,
+            "usage_percentage": (
+                (window_usage_mb / policy.bandwidth_limit_mb) * 100
+                if policy.bandwidth_limit_mb
+                else 100.0
+            ),
         }
 
     except Exception as e:
@@ -113,9 +344,148 @@ async def get_usage_status(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/usage/quota", response_model=QuotaPolicy)
+async def get_quota_policy(user: dict = Depends(get_current_user)):
+    """Get the quota policy that applies to the current user"""
+    return quota_policies.get(user.get("username"))
+
+
+def require_admin(user: dict = Depends(get_current_user)) -> dict:
+    if user.get("username") not in ADMIN_USERNAMES:
+        raise HTTPException(status_code=403, detail="Administrator access required")
+    return user
+
+
+@app.put("/quotas/plans/{plan}", response_model=QuotaPolicy)
+async def put_quota_plan(
+    plan: str,
+    policy: QuotaPolicy,
+    db: AsyncDatabase = Depends(get_db),
+    user: dict = Depends(require_admin),
+):
+    """Create or replace a quota plan (admins only)"""
+    fields = policy.dict(exclude={"plan"})
+    await db.quota_plans.replace_one({"_id": plan}, fields, upsert=True)
+    # Other replicas pick the change up within QUOTA_CACHE_TTL_S
+    await quota_policies.load(db)
+    send_log(user.get("username"), "UsageMntrServ", "INFO", f"Quota plan {plan} set")
+    return QuotaPolicy(plan=plan, **fields)
+
+
+@app.put("/quotas/users/{username}", response_model=QuotaPolicy)
+async def put_quota_override(
+    username: str,
+    override: QuotaOverride,
+    db: AsyncDatabase = Depends(get_db),
+    user: dict = Depends(require_admin),
+):
+    """Set a user's plan and per-user limits (admins only)"""
+    fields = override.dict(exclude_none=True)
+    await db.quota_overrides.replace_one(
+        {"username": username}, {"username": username, **fields}, upsert=True
+    )
+    await quota_policies.load(db)
+    send_log(
+        user.get("username"),
+        "UsageMntrServ",
+        "INFO",
+        f"Quota override set for {username}",
+    )
+    return quota_policies.get(username)
+
+
+@app.delete("/quotas/users/{username}", response_model=QuotaPolicy)
+async def delete_quota_override(
+    username: str,
+    db: AsyncDatabase = Depends(get_db),
+    user: dict = Depends(require_admin),
+):
+    """Return a user to the default plan (admins only)"""
+    await db.quota_overrides.delete_one({"username": username})
+    await quota_policies.load(db)
+    send_log(
+        user.get("username"),
+        "UsageMntrServ",
+        "INFO",
+        f"Quota override removed for {username}",
+    )
+    return quota_policies.get(username)
+
+
+def history_range(start_date: Optional[date], end_date: Optional[date]):
+    """Resolve and validate an inclusive date range for the analytics endpoints"""
+    end_date = end_date or date.today()
+    start_date = start_date or end_date - timedelta(days=HISTORY_DEFAULT_DAYS - 1)
+    if start_date > end_date:
+        raise HTTPException(status_code=400, detail="start_date is after end_date")
+    if (end_date - start_date).days >= MAX_HISTORY_DAYS:
+        raise HTTPException(
+            status_code=400, detail=f"Range is limited to {MAX_HISTORY_DAYS} days"
+        )
+    return start_date, end_date
+
+
+@app.get("/usage/history")
+async def get_usage_history(
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    granularity: str = Query("daily", pattern=f"^({'|'.join(HISTORY_GRANULARITIES)})$"),
+    db: AsyncDatabase = Depends(get_db),
+    user: dict = Depends(get_current_user),
+):
+    """Get a user's upload and download totals per day, week or month"""
+    username = user.get("username")
+    start_date, end_date = history_range(start_date, end_date)
+    try:
+        periods = await usage_history(db, username, start_date, end_date, granularity)
+        send_log(username, "UsageMntrServ", "INFO", "Usage history retrieved")
+        return {
+            "username": username,
+            "granularity": granularity,
+            "start_date": start_date.isoformat(),
+            "end_date": end_date.isoformat(),
+            "periods": periods,
+        }
+
+    except Exception as e:
+        send_log(
+            username, "UsageMntrServ", "ERROR", f"Error getting usage history: {str(e)}"
+        )
+        logger.error(f"Error getting usage history for user {username}: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/usage/top")
+async def get_top_users(
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    limit: int = Query(TOP_USERS_LIMIT, ge=1, le=MAX_TOP_USERS_LIMIT),
+    db: AsyncDatabase = Depends(get_db),
+    user: dict = Depends(get_current_user),
+):
+    """Get the heaviest users by total volume over a date range (admins only)"""
+    username = user.get("username")
+    if username not in ADMIN_USERNAMES:
+        raise HTTPException(status_code=403, detail="Administrator access required")
+    # Defaults to a single day, which is served straight from an index
+    end_date = end_date or date.today()
+    start_date, end_date = history_range(start_date or end_date, end_date)
+    try:
+        users = await top_users(db, start_date, end_date, limit)
+        return {
+            "start_date": start_date.isoformat(),
+            "end_date": end_date.isoformat(),
+            "users": users,
+        }
+
+    except Exception as e:
+        logger.error(f"Error getting top users: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.get("/usage/alerts/")
 async def get_user_alerts(
-    db: Collection = Depends(get_db),
+    db: AsyncDatabase = Depends(get_db),
     user: dict = Depends(get_current_user),
     date: Optional[date] = None,
 ):
@@ -130,7 +500,7 @@ async def get_user_alerts(
                 query["date"] = date
         alerts_collection = db.alerts
         alerts = (
-            await alerts_collection.find(query)
+            await alerts_collection.find(query, {"_id": 0})
             .sort("timestamp", -1)
             .to_list(length=100)
         )
@@ -141,3 +511,14 @@ async def get_user_alerts(
         send_log(username, "UsageMntrServ", "ERROR", f"Error getting alerts: {str(e)}")
         logger.error(f"Error getting alerts for user {username}: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/usage/alerts/stream")
+async def stream_user_alerts(user: dict = Depends(get_current_user)):
+    """Push a user's new bandwidth alerts as server-sent events"""
+    username = user.get("username")
+    return StreamingResponse(
+        alert_notifier.stream(username),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
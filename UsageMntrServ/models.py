@@ -1,5 +1,5 @@
 from datetime import date, datetime
-from typing import Optional
+from typing import Literal, Optional
 from pydantic import BaseModel, Field, validator
 
 
@@ -56,3 +56,40 @@ class BandwidthAlert(BaseModel):
 
     class Config:
         json_encoders = {datetime: lambda v: v.isoformat()}
+
+
+class BandwidthReservation(BaseModel):
+    username: str
+    date: str  # Day the reserved usage was recorded against
+    volume_mb: float = Field(ge=0)
+    operation_type: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    expires_at: datetime
+
+
+class QuotaPolicy(BaseModel):
+    """A user's limits, resolved from their plan and any per-user override"""
+
+    plan: str = "free"
+    storage_limit_mb: float = Field(default=50, ge=0)
+    max_file_size_mb: float = Field(default=25, ge=0)  # Maximum size for a single file
+    storage_alert_threshold: float = Field(default=0.8, ge=0, le=1)  # 80%
+    bandwidth_limit_mb: float = Field(default=100, ge=0)
+    # "calendar_day" resets at midnight; "rolling_24h" counts the last 24 hours
+    bandwidth_window: Literal["calendar_day", "rolling_24h"] = "calendar_day"
+    # Token bucket for uploads; None means no rate limit
+    upload_rate_per_minute: Optional[float] = Field(default=None, gt=0)
+    upload_burst: Optional[int] = Field(default=None, ge=1)
+
+
+class QuotaOverride(BaseModel):
+    """Per-user changes on top of a plan; unset fields fall back to the plan"""
+
+    plan: Optional[str] = None
+    storage_limit_mb: Optional[float] = Field(default=None, ge=0)
+    max_file_size_mb: Optional[float] = Field(default=None, ge=0)
+    storage_alert_threshold: Optional[float] = Field(default=None, ge=0, le=1)
+    bandwidth_limit_mb: Optional[float] = Field(default=None, ge=0)
+    bandwidth_window: Optional[Literal["calendar_day", "rolling_24h"]] = None
+    upload_rate_per_minute: Optional[float] = Field(default=None, gt=0)
+    upload_burst: Optional[int] = Field(default=None, ge=1)
@@ -0,0 +1,197 @@
+from typing import Dict, Optional
+import asyncio
+import importlib.util
+import logging
+import os
+import random
+import time
+import httpx
+import dotenv
+
+# Load environment variables from .env file
+dotenv.load_dotenv()
+
+# One connection pool is shared by every call this service makes to the others
+SERVICE_MAX_CONNECTIONS = int(os.getenv("SERVICE_MAX_CONNECTIONS", "100"))
+SERVICE_KEEPALIVE_EXPIRY_S = float(os.getenv("SERVICE_KEEPALIVE_EXPIRY_S", "30"))
+SERVICE_TIMEOUT_S = float(os.getenv("SERVICE_TIMEOUT_S", "5"))
+SERVICE_MAX_RETRIES = int(os.getenv("SERVICE_MAX_RETRIES", "2"))
+SERVICE_RETRY_BACKOFF_MS = int(os.getenv("SERVICE_RETRY_BACKOFF_MS", "100"))
+# HTTP/2 multiplexes requests over one connection per target; needs the h2 package
+SERVICE_HTTP2 = os.getenv("SERVICE_HTTP2", "false").lower() == "true"
+# Consecutive failures that open a target's circuit, and how long it stays open
+SERVICE_BREAKER_FAILURES = int(os.getenv("SERVICE_BREAKER_FAILURES", "5"))
+SERVICE_BREAKER_RESET_S = float(os.getenv("SERVICE_BREAKER_RESET_S", "30"))
+
+# Failures where the request never reached the server, so any method can be resent
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(httpx.TransportError):
+    """Raised without sending anything while a target's circuit is open"""
+
+
+class ServiceTarget:
+    """
+    Calls to one service: its base URL, timeout and retry budget, a circuit
+    breaker and request metrics.
+
+    Connect failures are retried for every request. Timeouts, dropped
+    connections and 5xx responses are only retried when the caller marks the
+    request idempotent, since the server may already have acted on it.
+    """
+
+    def __init__(
+        self,
+        services: "ServiceClient",
+        name: str,
+        base_url: Optional[str],
+        timeout_s: float,
+        max_retries: int,
+        retry_backoff_ms: int,
+    ):
+        self.services = services
+        self.name = name
+        self.base_url = (base_url or "").rstrip("/")
+        self.timeout_s = timeout_s
+        self.max_retries = max_retries
+        self.retry_backoff_ms = retry_backoff_ms
+        self.failures = 0
+        self.opened_at = None
+        self.stats = {
+            "requests": 0,
+            "errors": 0,
+            "retries": 0,
+            "short_circuited": 0,
+            "latency_ms_total": 0.0,
+        }
+
+    def allow(self) -> bool:
+        """False while the circuit is open; lets a single trial through after the reset"""
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < SERVICE_BREAKER_RESET_S:
+            return False
+        # Restarting the timer holds other requests back until the trial is done
+        self.opened_at = now
+        return True
+
+    def succeeded(self):
+        if self.opened_at is not None:
+            logger.info(f"Circuit to {self.name} closed")
+        self.failures = 0
+        self.opened_at = None
+
+    def failed(self):
+        self.stats["errors"] += 1
+        self.failures += 1
+        if self.failures >= SERVICE_BREAKER_FAILURES:
+            if self.opened_at is None:
+                logger.warning(
+                    f"Circuit to {self.name} opened after {self.failures} failures"
+                )
+            self.opened_at = time.monotonic()
+
+    async def request(
+        self, method: str, path: str, idempotent: bool = False, **kwargs
+    ) -> httpx.Response:
+        """Send a request, retrying with jittered exponential backoff where safe"""
+        client = self.services.get_client()
+        for attempt in range(self.max_retries + 1):
+            if not self.allow():
+                self.stats["short_circuited"] += 1
+                raise CircuitOpenError(f"Circuit to {self.name} is open")
+            self.stats["requests"] += 1
+            started = time.monotonic()
+            try:
+                response = await client.request(
+                    method,
+                    f"{self.base_url}{path}",
+                    timeout=self.timeout_s,
+                    **kwargs,
+                )
+            except httpx.TransportError as e:
+                self.failed()
+                retryable = idempotent or isinstance(e, CONNECT_ERRORS)
+                if not retryable or attempt == self.max_retries:
+                    raise
+            else:
+                if response.status_code < 500:
+                    self.succeeded()
+                    return response
+                self.failed()
+                retryable = idempotent
+                if not retryable or attempt == self.max_retries:
+                    return response
+            finally:
+                elapsed_ms = (time.monotonic() - started) * 1000
+                self.stats["latency_ms_total"] += elapsed_ms
+            self.stats["retries"] += 1
+            backoff = self.retry_backoff_ms / 1000 * 2**attempt
+            await asyncio.sleep(backoff * random.uniform(0.5, 1.5))
+
+
+class ServiceClient:
+    """Lifespan-managed HTTP client shared by all outgoing inter-service calls"""
+
+    def __init__(self):
+        self.client = None
+        self.targets: Dict[str, ServiceTarget] = {}
+
+    def start(self):
+        if self.client is not None:
+            return
+        http2 = SERVICE_HTTP2
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("SERVICE_HTTP2 needs the h2 package; using HTTP/1.1")
+            http2 = False
+        self.client = httpx.AsyncClient(
+            http2=http2,
+            timeout=SERVICE_TIMEOUT_S,
+            limits=httpx.Limits(
+                max_connections=SERVICE_MAX_CONNECTIONS,
+                max_keepalive_connections=SERVICE_MAX_CONNECTIONS,
+                keepalive_expiry=SERVICE_KEEPALIVE_EXPIRY_S,
+            ),
+        )
+
+    async def stop(self):
+        """Close pooled connections; call after everything that sends requests"""
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def get_client(self) -> httpx.AsyncClient:
+        if self.client is None:
+            # Started lazily when used outside of an app lifespan
+            self.start()
+        return self.client
+
+    def target(
+        self,
+        name: str,
+        base_url: Optional[str],
+        timeout_s: float = SERVICE_TIMEOUT_S,
+        max_retries: int = SERVICE_MAX_RETRIES,
+        retry_backoff_ms: int = SERVICE_RETRY_BACKOFF_MS,
+    ) -> ServiceTarget:
+        """Register the service at base_url under name, with its own timeout and retries"""
+        target = self.targets[name] = ServiceTarget(
+            self, name, base_url, timeout_s, max_retries, retry_backoff_ms
+        )
+        return target
+
+    def metrics(self) -> Dict[str, dict]:
+        """Per-target request counts, errors, retries and circuit state"""
+        return {
+            name: {**target.stats, "circuit_open": target.opened_at is not None}
+            for name, target in self.targets.items()
+        }
+
+
+service_client = ServiceClient()
@@ -1,11 +1,29 @@
-from pymongo.collection import Collection
-from datetime import datetime, date
-from models import UsageRecord, BandwidthAlert
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.asynchronous.database import AsyncDatabase
+from datetime import datetime, date, timedelta
+from typing import List, Optional, Tuple
+from models import BandwidthAlert, BandwidthReservation, QuotaPolicy, UsageRecord
+from alerts import alert_notifier
+from history import ensure_history_indexes
 import logging
+import os
+import dotenv
+
+# Load environment variables from .env file
+dotenv.load_dotenv()
 
 # Constants
-DAILY_BANDWIDTH_LIMIT_MB = 100
+ROLLING_WINDOW_HOURS = 24  # Hourly buckets kept for rolling_24h policies
+# Reservations not committed or released within this time stay charged as reserved
+RESERVATION_TTL_S = int(os.getenv("RESERVATION_TTL_S", "900"))
 BYTES_PER_MB = 1024 * 1024
+# Server error codes for an index that already exists with different options
+INDEX_OPTIONS_CONFLICT = 85
+INDEX_KEY_SPECS_CONFLICT = 86
+# Fractions of the bandwidth limit that raise an alert when usage first reaches them
+ALERT_THRESHOLDS = [(0.8, "APPROACHING_LIMIT"), (1.0, "LIMIT_EXCEEDED")]
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -13,90 +31,425 @@ logger = logging.getLogger(__name__)
 
 
 class UsageMonitor:
+    @staticmethod
+    async def ensure_indexes(db: AsyncDatabase):
+        """Create the indexes that usage and alert queries rely on"""
+        # Unique so the conditional upsert in record_usage can never create a
+        # second record for the same day
+        try:
+            await db.daily_usage.create_index(
+                [("username", ASCENDING), ("date", ASCENDING)], unique=True
+            )
+        except OperationFailure as e:
+            if e.code in (INDEX_OPTIONS_CONFLICT, INDEX_KEY_SPECS_CONFLICT):
+                # Replace the earlier non-unique index on the same keys
+                await db.daily_usage.drop_index("username_1_date_1")
+            elif not isinstance(e, DuplicateKeyError):
+                raise
+            await UsageMonitor.merge_duplicate_usage(db.daily_usage)
+            await db.daily_usage.create_index(
+                [("username", ASCENDING), ("date", ASCENDING)], unique=True
+            )
+        await ensure_history_indexes(db)
+        await db.rolling_usage.create_index("username", unique=True)
+        await db.quota_overrides.create_index("username", unique=True)
+        await db.bandwidth_reservations.create_index("expires_at", expireAfterSeconds=0)
+        await db.alerts.create_index(
+            [("username", ASCENDING), ("timestamp", DESCENDING)]
+        )
+        await db.alerts.create_index(
+            [("username", ASCENDING), ("date", ASCENDING), ("timestamp", DESCENDING)]
+        )
+        # One alert per threshold per day; older deployments stored one per request
+        try:
+            await db.alerts.create_index(
+                [
+                    ("username", ASCENDING),
+                    ("date", ASCENDING),
+                    ("alert_type", ASCENDING),
+                ],
+                unique=True,
+            )
+        except DuplicateKeyError:
+            await UsageMonitor.dedupe_alerts(db.alerts)
+            await db.alerts.create_index(
+                [
+                    ("username", ASCENDING),
+                    ("date", ASCENDING),
+                    ("alert_type", ASCENDING),
+                ],
+                unique=True,
+            )
+
+    @staticmethod
+    async def merge_duplicate_usage(usage_collection: AsyncCollection):
+        """Fold duplicate (username, date) records left by the old get-or-insert"""
+        cursor = await usage_collection.aggregate(
+            [
+                {
+                    "$group": {
+                        "_id": {"username": "$username", "date": "$date"},
+                        "ids": {"$push": "$_id"},
+                        "upload_volume_mb": {"$sum": "$upload_volume_mb"},
+                        "download_volume_mb": {"$sum": "$download_volume_mb"},
+                        "last_updated": {"$max": "$last_updated"},
+                    }
+                },
+                {"$match": {"ids.1": {"$exists": True}}},
+            ]
+        )
+        async for duplicate in cursor:
+            keep, *extra = duplicate["ids"]
+            await usage_collection.update_one(
+                {"_id": keep},
+                {
+                    "$set": {
+                        "upload_volume_mb": duplicate["upload_volume_mb"],
+                        "download_volume_mb": duplicate["download_volume_mb"],
+                        "total_volume_mb": duplicate["upload_volume_mb"]
+                        + duplicate["download_volume_mb"],
+                        "last_updated": duplicate["last_updated"],
+                    }
+                },
+            )
+            await usage_collection.delete_many({"_id": {"$in": extra}})
+
+    @staticmethod
+    async def dedupe_alerts(alert_collection: AsyncCollection):
+        """Keep only the first alert of each type per user and day"""
+        cursor = await alert_collection.aggregate(
+            [
+                {"$sort": {"timestamp": 1}},
+                {
+                    "$group": {
+                        "_id": {
+                            "username": "$username",
+                            "date": "$date",
+                            "alert_type": "$alert_type",
+                        },
+                        "ids": {"$push": "$_id"},
+                    }
+                },
+                {"$match": {"ids.1": {"$exists": True}}},
+            ],
+            allowDiskUse=True,
+        )
+        async for duplicate in cursor:
+            await alert_collection.delete_many({"_id": {"$in": duplicate["ids"][1:]}})
+
     @staticmethod
     async def get_daily_usage(
-        usage_collection: Collection, username: str, current_date: date = None
+        usage_collection: AsyncCollection, username: str, current_date: date = None
     ) -> UsageRecord:
         """Get or create daily usage record for user"""
         if current_date is None:
             current_date = date.today()
 
-        usage = usage_collection.find_one(
-            {"username": username, "date": current_date.isoformat()}
+        usage = await usage_collection.find_one_and_update(
+            {"username": username, "date": current_date.isoformat()},
+            {
+                "$setOnInsert": {
+                    "upload_volume_mb": 0,
+                    "download_volume_mb": 0,
+                    "total_volume_mb": 0,
+                    "last_updated": datetime.utcnow(),
+                }
+            },
+            projection={"_id": 0},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
         )
 
-        if not usage:
-            usage = UsageRecord(
-                username=username,
-                date=current_date.isoformat(),
-                last_updated=datetime.utcnow(),
-            ).dict()
-            usage_collection.insert_one(usage)
-
         return UsageRecord(**usage)
 
     @staticmethod
-    async def can_use_bandwidth(
-        usage_collection: Collection, username: str, required_mb: float
-    ) -> bool:
-        """Check if user has enough bandwidth remaining for the day"""
-        usage = await UsageMonitor.get_daily_usage(usage_collection, username)
-        return (usage.total_volume_mb + required_mb) <= DAILY_BANDWIDTH_LIMIT_MB
+    async def record_usage(
+        usage_collection: AsyncCollection,
+        alert_collection: AsyncCollection,
+        username: str,
+        volume_mb: float,
+        operation_type: str,
+        policy: QuotaPolicy,
+    ) -> Optional[float]:
+        """
+        Record bandwidth usage for upload/download operations.
+
+        Uploads are only recorded if they fit within the policy's bandwidth limit;
+        the check and the increment are a single conditional update, so concurrent
+        uploads cannot overshoot it.
+
+        Returns:
+            float: The user's usage within the policy's window after recording, or
+            None if the upload was refused.
+        """
+        day = date.today().isoformat()
+        limit_mb = policy.bandwidth_limit_mb if operation_type == "upload" else None
+
+        if policy.bandwidth_window == "rolling_24h":
+            window = await UsageMonitor.reserve_rolling(
+                usage_collection.database.rolling_usage, username, volume_mb, limit_mb
+            )
+            if window is None:
+                return None
+            # The daily record still feeds /usage/status/ and /usage/history
+            await UsageMonitor.increment_daily(
+                usage_collection, username, day, volume_mb, operation_type
+            )
+            previous_mb, total_mb = window
+        else:
+            usage = await UsageMonitor.increment_daily(
+                usage_collection, username, day, volume_mb, operation_type, limit_mb
+            )
+            if usage is None:
+                return None
+            previous_mb, total_mb = (
+                usage.total_volume_mb - volume_mb,
+                usage.total_volume_mb,
+            )
+
+        # Monthly rollups are derived from the daily record in the background
+        # Only the request that crosses a threshold raises its alert
+        await UsageMonitor.check_alerts(
+            alert_collection, username, previous_mb, total_mb, policy.bandwidth_limit_mb
+        )
+        return total_mb
 
     @staticmethod
-    async def record_usage(
-        usage_collection: Collection,
-        alert_collection: Collection,
+    async def adjust_usage(
+        db: AsyncDatabase,
         username: str,
+        day: str,
         volume_mb: float,
         operation_type: str,
+        policy: QuotaPolicy,
     ):
-        """Record bandwidth usage for upload/download operations"""
-        current_date = date.today()
-
-        # Update fields based on operation type
+        """Add a correction (negative for a refund) to usage already recorded on day"""
         update_field = (
             "upload_volume_mb" if operation_type == "upload" else "download_volume_mb"
         )
-
-        # Update usage record
-        result = usage_collection.update_one(
-            {"username": username, "date": current_date.isoformat()},
+        await db.daily_usage.update_one(
+            {"username": username, "date": day},
             {
                 "$inc": {update_field: volume_mb, "total_volume_mb": volume_mb},
                 "$set": {"last_updated": datetime.utcnow()},
             },
-            upsert=True,
         )
+        if policy.bandwidth_window == "rolling_24h":
+            await UsageMonitor.reserve_rolling(
+                db.rolling_usage, username, volume_mb, None
+            )
 
-        # Check if need to create alert
-        usage = await UsageMonitor.get_daily_usage(usage_collection, username)
-        if usage.total_volume_mb >= DAILY_BANDWIDTH_LIMIT_MB:
-            await UsageMonitor.create_alert(
-                alert_collection,
-                username,
-                "LIMIT_EXCEEDED",
-                DAILY_BANDWIDTH_LIMIT_MB,
-                usage.total_volume_mb,
+    @staticmethod
+    async def create_reservation(
+        reservation_collection: AsyncCollection,
+        username: str,
+        volume_mb: float,
+        operation_type: str,
+    ) -> Tuple[str, BandwidthReservation]:
+        """
+        Record a reservation for usage that has just been charged.
+
+        A reservation that is neither committed nor released is removed by its TTL
+        index and the reserved usage stays charged.
+        """
+        reservation = BandwidthReservation(
+            username=username,
+            date=date.today().isoformat(),
+            volume_mb=volume_mb,
+            operation_type=operation_type,
+            expires_at=datetime.utcnow() + timedelta(seconds=RESERVATION_TTL_S),
+        )
+        result = await reservation_collection.insert_one(reservation.dict())
+        reservation_id = str(result.inserted_id)
+        return reservation_id, reservation
+
+    @staticmethod
+    async def increment_daily(
+        usage_collection: AsyncCollection,
+        username: str,
+        day: str,
+        volume_mb: float,
+        operation_type: str,
+        limit_mb: Optional[float] = None,
+    ) -> Optional[UsageRecord]:
+        """Add usage to a day's record, only if it stays within limit_mb when given"""
+        # Update fields based on operation type
+        update_field = (
+            "upload_volume_mb" if operation_type == "upload" else "download_volume_mb"
+        )
+
+        query = {"username": username, "date": day}
+        if limit_mb is not None:
+            if volume_mb > limit_mb:
+                return None
+            query["total_volume_mb"] = {"$lte": limit_mb - volume_mb}
+
+        update = {
+            "$inc": {update_field: volume_mb, "total_volume_mb": volume_mb},
+            "$set": {"last_updated": datetime.utcnow()},
+        }
+        try:
+            usage = await usage_collection.find_one_and_update(
+                query,
+                update,
+                projection={"_id": 0},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # Either the day's record has no room left, or a concurrent request
+            # inserted it first. The server does not retry upserts whose query
+            # has a range predicate, so retry once against the existing record
+            usage = await usage_collection.find_one_and_update(
+                query,
+                update,
+                projection={"_id": 0},
+                return_document=ReturnDocument.AFTER,
             )
-        elif usage.total_volume_mb >= (DAILY_BANDWIDTH_LIMIT_MB * 0.8):  # 80% threshold
+            if usage is None:
+                return None
+        return UsageRecord(**usage)
+
+    @staticmethod
+    async def reserve_rolling(
+        rolling_collection: AsyncCollection,
+        username: str,
+        volume_mb: float,
+        limit_mb: Optional[float],
+    ) -> Optional[Tuple[float, float]]:
+        """
+        Add usage to a user's rolling 24h window in one atomic pipeline update.
+
+        The window is kept as hourly buckets on one document per user; the update
+        drops buckets that have left the window, sums the rest, and adds the new
+        usage only if the sum stays within limit_mb.
+
+        Returns:
+            tuple: Window usage before and after, or None if the limit was reached.
+        """
+        now = datetime.utcnow()
+        hour = now.replace(minute=0, second=0, microsecond=0)
+        window_start = hour - timedelta(hours=ROLLING_WINDOW_HOURS - 1)
+        accepted = (
+            {"$lte": [{"$add": ["$previous_mb", volume_mb]}, limit_mb]}
+            if limit_mb is not None
+            else {"$literal": True}
+        )
+        add_to_buckets = {
+            "$cond": [
+                {"$in": [hour, "$buckets.hour"]},
+                {
+                    "$map": {
+                        "input": "$buckets",
+                        "in": {
+                            "$cond": [
+                                {"$eq": ["$$this.hour", hour]},
+                                {
+                                    "hour": "$$this.hour",
+                                    "mb": {"$add": ["$$this.mb", volume_mb]},
+                                },
+                                "$$this",
+                            ]
+                        },
+                    }
+                },
+                {"$concatArrays": ["$buckets", [{"hour": hour, "mb": volume_mb}]]},
+            ]
+        }
+        window = await rolling_collection.find_one_and_update(
+            {"username": username},
+            [
+                {
+                    "$set": {
+                        "buckets": {
+                            "$filter": {
+                                "input": {"$ifNull": ["$buckets", []]},
+                                "cond": {"$gte": ["$$this.hour", window_start]},
+                            }
+                        }
+                    }
+                },
+                {"$set": {"previous_mb": {"$sum": "$buckets.mb"}}},
+                {"$set": {"accepted": accepted}},
+                {
+                    "$set": {
+                        "buckets": {"$cond": ["$accepted", add_to_buckets, "$buckets"]},
+                        "total_mb": {
+                            "$cond": [
+                                "$accepted",
+                                {"$add": ["$previous_mb", volume_mb]},
+                                "$previous_mb",
+                            ]
+                        },
+                        "last_updated": now,
+                    }
+                },
+            ],
+            projection={"_id": 0, "accepted": 1, "previous_mb": 1, "total_mb": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        if not window["accepted"]:
+            return None
+        return window["previous_mb"], window["total_mb"]
+
+    @staticmethod
+    async def get_rolling_usage(
+        rolling_collection: AsyncCollection, username: str
+    ) -> float:
+        """A user's usage over the last ROLLING_WINDOW_HOURS, from the hourly buckets"""
+        window = await rolling_collection.find_one({"username": username})
+        hour = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        window_start = hour - timedelta(hours=ROLLING_WINDOW_HOURS - 1)
+        return sum(
+            bucket["mb"]
+            for bucket in (window or {}).get("buckets", [])
+            if bucket["hour"] >= window_start
+        )
+
+    @staticmethod
+    def crossed_alerts(
+        previous_mb: float, total_mb: float, limit_mb: float
+    ) -> List[str]:
+        """The alert thresholds a change in usage from previous_mb crossed"""
+        return [
+            alert_type
+            for fraction, alert_type in ALERT_THRESHOLDS
+            if previous_mb < limit_mb * fraction <= total_mb
+        ]
+
+    @staticmethod
+    async def check_alerts(
+        alert_collection: AsyncCollection,
+        username: str,
+        previous_mb: float,
+        total_mb: float,
+        limit_mb: float,
+    ):
+        """Raise an alert for each threshold crossed; staying above one raises nothing"""
+        for alert_type in UsageMonitor.crossed_alerts(previous_mb, total_mb, limit_mb):
             await UsageMonitor.create_alert(
                 alert_collection,
                 username,
-                "APPROACHING_LIMIT",
-                DAILY_BANDWIDTH_LIMIT_MB,
-                usage.total_volume_mb,
+                alert_type,
+                limit_mb,
+                total_mb,
             )
 
     @staticmethod
     async def create_alert(
-        alert_collection: Collection,
+        alert_collection: AsyncCollection,
         username: str,
         alert_type: str,
         threshold_mb: float,
         current_usage_mb: float,
-    ):
-        """Create bandwidth usage alert"""
+    ) -> bool:
+        """
+        Record a bandwidth alert at most once per user, day and alert type.
+
+        Returns:
+            bool: True if the alert is new, False if it had already been raised today.
+        """
         alert = BandwidthAlert(
             username=username,
             date=date.today().isoformat(),  # Convert date to datetime
@@ -104,7 +457,19 @@ class UsageMonitor:
             threshold_mb=threshold_mb,
             current_usage_mb=current_usage_mb,
             timestamp=datetime.utcnow(),
-        )
+        ).dict()
 
-        alert_collection.insert_one(alert.dict())
+        try:
+            result = await alert_collection.update_one(
+                {"username": username, "date": alert["date"], "alert_type": alert_type},
+                {"$setOnInsert": alert},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # A concurrent request raised the same alert first
+            return False
+        if result.upserted_id is None:
+            return False
+        alert_notifier.publish(alert)
         logger.info(f"Created {alert_type} alert for user {username}")
+        return True
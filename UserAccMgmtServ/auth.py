@@ -1,7 +1,13 @@
 from passlib.context import CryptContext
-from jose import jwt
+from jose import jwk, jwt
+from fastapi import HTTPException, Security, status
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
 from dotenv import load_dotenv
+from tokens import InvalidTokenError, token_verifier
+import asyncio
 
 # import uvicorn
 import os
@@ -13,8 +19,49 @@ load_dotenv()
 # Security Configuration
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
-ACCESS_TOKEN_EXPIRE_MINUTES = os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES")
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+ACCESS_TOKEN_EXPIRE_MINUTES = float(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "15"))
+# With a private key, tokens are signed asymmetrically and carry its key ID, so
+# other services only need the public key set instead of SECRET_KEY
+JWT_PRIVATE_KEY_FILE = os.getenv("JWT_PRIVATE_KEY_FILE")
+JWT_KEY_ID = os.getenv("JWT_KEY_ID")
+JWT_SIGNING_ALGORITHM = os.getenv("JWT_SIGNING_ALGORITHM", "RS256")
+# bcrypt cost factor; hashes made with any other cost are replaced on next login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(
+    os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1))
+)
+# Hashes queued or running before new ones are refused with a 503
+PASSWORD_HASH_MAX_PENDING = int(
+    os.getenv("PASSWORD_HASH_MAX_PENDING", str(PASSWORD_HASH_WORKERS * 4))
+)
+# Users allowed to provision accounts in bulk (comma-separated usernames)
+ADMIN_USERNAMES = set(filter(None, os.getenv("ADMIN_USERNAMES", "").split(",")))
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+
+def load_signing_key():
+    """Read the private signing key and trust its public half; None without one"""
+    if not JWT_PRIVATE_KEY_FILE:
+        return None
+    if not JWT_KEY_ID:
+        raise ValueError("JWT_KEY_ID must be set along with JWT_PRIVATE_KEY_FILE")
+    with open(JWT_PRIVATE_KEY_FILE) as f:
+        private_key = f.read()
+    public_key = jwk.construct(private_key, JWT_SIGNING_ALGORITHM).public_key()
+    token_verifier.add_key({**public_key.to_dict(), "kid": JWT_KEY_ID, "use": "sig"})
+    return private_key
+
+
+SIGNING_KEY = load_signing_key()
+
+# Security scheme for HTTP Bearer authentication
+security = HTTPBearer()
 
 
 # Utility Functions
@@ -26,11 +73,118 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 
+class PasswordHasher:
+    """
+    Runs bcrypt on a dedicated thread pool so it never blocks the event loop.
+
+    bcrypt releases the GIL while it works, so hashes on separate threads run on
+    separate cores. Once PASSWORD_HASH_MAX_PENDING hashes are queued or running,
+    further requests fail fast with a 503 instead of waiting in line.
+    """
+
+    def __init__(self):
+        self.executor = None
+        self.pending = 0
+
+    def start(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt"
+            )
+
+    def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    async def run(self, func, *args):
+        if self.pending >= PASSWORD_HASH_MAX_PENDING:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy. Please try again shortly.",
+                headers={"Retry-After": "1"},
+            )
+        if self.executor is None:
+            # Started lazily when used outside of an app lifespan
+            self.start()
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, func, *args
+            )
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self.run(get_password_hash, password)
+
+    async def hash_many(self, passwords: List[str]) -> List[str]:
+        """
+        Hash a batch one pool's worth at a time; used by bulk provisioning.
+
+        Each slice counts towards the pending limit but is never refused, so an
+        import waits its turn instead of failing, and logins queue behind at most
+        one slice of it.
+        """
+        if self.executor is None:
+            self.start()
+        loop = asyncio.get_running_loop()
+        hashes = []
+        for i in range(0, len(passwords), PASSWORD_HASH_WORKERS):
+            batch = passwords[i : i + PASSWORD_HASH_WORKERS]
+            self.pending += len(batch)
+            try:
+                hashes += await asyncio.gather(
+                    *(
+                        loop.run_in_executor(self.executor, get_password_hash, password)
+                        for password in batch
+                    )
+                )
+            finally:
+                self.pending -= len(batch)
+        return hashes
+
+    async def verify(
+        self, plain_password: str, hashed_password: str
+    ) -> Tuple[bool, Optional[str]]:
+        """Check a password; also returns a new hash if the stored one uses an old cost"""
+        return await self.run(
+            pwd_context.verify_and_update, plain_password, hashed_password
+        )
+
+
+password_hasher = PasswordHasher()
+
+
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
+        expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
+    if SIGNING_KEY:
+        return jwt.encode(
+            to_encode,
+            SIGNING_KEY,
+            algorithm=JWT_SIGNING_ALGORITHM,
+            headers={"kid": JWT_KEY_ID},
+        )
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+
+
+async def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Security(security),
+):
+    """Retrieve the current user from the bearer token in the Authorization header"""
+    try:
+        payload = await token_verifier.verify(credentials.credentials)
+    except InvalidTokenError:
+        payload = {}
+    username = payload.get("sub")
+    if username is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid token",
+        )
+    return {"message": "Token is valid", "username": username}
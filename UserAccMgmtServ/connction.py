@@ -1,15 +1,26 @@
 import os
-from pymongo import MongoClient
+from pymongo import AsyncMongoClient
+from pymongo.asynchronous.database import AsyncDatabase
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Connection pool and timeout tuning (all timeouts in milliseconds)
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "60000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "10000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(
+    os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")
+)
+
 # Global variable to hold the MongoDB client
 mongo_client = None
 
 
-def get_database():
+def get_database() -> AsyncDatabase:
     global mongo_client
     if mongo_client is None:
         connection_string = os.getenv("MONGODB_CONNECTION_STRING")
@@ -20,10 +31,16 @@ def get_database():
                 "Environment variables for MongoDB connection are not set."
             )
 
-        mongo_client = MongoClient(
-            connection_string
-        )  # Create the MongoDB client only once
-        # print("Connected to MongoDB")
+        # Create the async MongoDB client only once; it connects lazily
+        mongo_client = AsyncMongoClient(
+            connection_string,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+            connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+            socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+            serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        )
 
     # Return the specific database
     return mongo_client[
@@ -31,13 +48,21 @@ def get_database():
     ]  # Use DATABASE_NAME from environment
 
 
+async def close_database():
+    """Close the MongoDB client; called when the app's lifespan ends"""
+    global mongo_client
+    if mongo_client is not None:
+        await mongo_client.close()
+        mongo_client = None
+
+
 # Dependency function to be used with FastAPI's dependency injection
-def get_db():
+async def get_db():
     db = get_database()
     try:
         yield db
     finally:
-        pass  # No need to close the connection; it's managed by the MongoClient pool
+        pass  # No need to close the connection; it's managed by the client pool
 
 
 if __name__ == "__main__":
@@ -1,36 +1,92 @@
-from pymongo.collection import Collection
+from pymongo import ASCENDING
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.asynchronous.database import AsyncDatabase
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from fastapi import HTTPException
+from typing import List, Tuple
 from models import UserCreate
+from sessions import ensure_session_indexes
+import logging
 
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
-def create_user(collection: Collection, user_data: dict):
+# Server error code for a unique index violation
+DUPLICATE_KEY = 11000
+
+
+async def ensure_indexes(db: AsyncDatabase):
+    """Create the unique username index and the session indexes"""
+    await ensure_session_indexes(db)
+    try:
+        await db.users.create_index([("username", ASCENDING)], unique=True)
+    except DuplicateKeyError as e:
+        # Registration relies on this index to reject taken usernames, so the
+        # service must not start without it. Accounts sharing a name need a
+        # person to decide which one to keep
+        logger.error(f"Duplicate usernames prevent the unique index: {str(e)}")
+        raise RuntimeError(
+            "Cannot create the unique username index; remove duplicate accounts "
+            "before starting the service"
+        ) from e
+
+
+async def create_user(collection: AsyncCollection, user_data: dict):
     """
     Create a new user in the database.
 
     Args:
-        collection (Collection): The MongoDB collection to insert the user into.
+        collection (AsyncCollection): The MongoDB collection to insert the user into.
         user_data (dict): The data for the new user.
 
     Returns:
-        str: The username of the newly created user.
+        bool: True if the user was created, False if the username is taken.
 
     Raises:
         HTTPException: If an error occurs during user creation.
     """
     try:
         user = UserCreate(**user_data)
-        result = collection.insert_one(user.dict(by_alias=True))
+        # The unique index makes the insert itself the existence check
+        await collection.insert_one(user.dict(by_alias=True))
         return True
+    except DuplicateKeyError:
+        return False
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
-def get_user(collection: Collection, username: str):
+async def create_users(
+    collection: AsyncCollection, users: List[dict]
+) -> Tuple[int, List[int]]:
+    """
+    Insert a batch of users in one unordered insert_many.
+
+    Args:
+        collection (AsyncCollection): The MongoDB collection to insert the users into.
+        users (List[dict]): Username and hashed password of each new user.
+
+    Returns:
+        Tuple[int, List[int]]: How many were created, and the positions in `users`
+        of those whose username was already taken.
+    """
+    try:
+        result = await collection.insert_many(users, ordered=False)
+        return len(result.inserted_ids), []
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error["code"] != DUPLICATE_KEY for error in errors):
+            raise
+        return e.details["nInserted"], [error["index"] for error in errors]
+
+
+async def get_user(collection: AsyncCollection, username: str):
     """
     Retrieve a user by their username.
 
     Args:
-        collection (Collection): The MongoDB collection to search in.
+        collection (AsyncCollection): The MongoDB collection to search in.
         username (str): The username of the user to retrieve.
 
     Returns:
@@ -40,7 +96,7 @@ def get_user(collection: Collection, username: str):
         HTTPException: If the user is not found or if an error occurs during retrieval.
     """
     try:
-        user = collection.find_one({"username": username})
+        user = await collection.find_one({"username": username})
         if user:
             user["username"] = str(user["username"])
             return user
@@ -50,12 +106,12 @@ def get_user(collection: Collection, username: str):
         return False
 
 
-def update_user(collection: Collection, username: str, user_data: dict):
+async def update_user(collection: AsyncCollection, username: str, user_data: dict):
     """
     Update an existing user in the database.
 
     Args:
-        collection (Collection): The MongoDB collection to update the user in.
+        collection (AsyncCollection): The MongoDB collection to update the user in.
         username (str): The username of the user to update.
         user_data (dict): The updated user data.
 
@@ -66,7 +122,9 @@ def update_user(collection: Collection, username: str, user_data: dict):
         HTTPException: If the user is not found or if an error occurs during the update.
     """
     try:
-        result = collection.update_one({"username": username}, {"$set": user_data})
+        result = await collection.update_one(
+            {"username": username}, {"$set": user_data}
+        )
         if result.modified_count:
             return True
         else:
@@ -75,12 +133,12 @@ def update_user(collection: Collection, username: str, user_data: dict):
         raise HTTPException(status_code=400, detail=str(e))
 
 
-def delete_user(collection: Collection, username: str):
+async def delete_user(collection: AsyncCollection, username: str):
     """
     Delete a user from the database by their username.
 
     Args:
-        collection (Collection): The MongoDB collection to delete the user from.
+        collection (AsyncCollection): The MongoDB collection to delete the user from.
         username (str): The username of the user to delete.
 
     Returns:
@@ -90,7 +148,7 @@ def delete_user(collection: Collection, username: str):
         HTTPException: If the user is not found or if an error occurs during deletion.
     """
     try:
-        result = collection.delete_one({"username": username})
+        result = await collection.delete_one({"username": username})
         if result.deleted_count:
             return True
         else:
@@ -1,24 +1,52 @@
 from fastapi import FastAPI, HTTPException, status, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pymongo.collection import Collection
-from jose import JWTError, jwt
-from connction import get_db
-from models import UserCreate, UserLogin, Token
-from crud import create_user, get_user, delete_user
-from dotenv import load_dotenv
-from auth import get_password_hash, verify_password, create_access_token
-from log import send_log
-import os
-
-# Load environment variables from .env file
-load_dotenv()
-
-# Security Configuration
-SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = os.getenv("ALGORITHM")
+from pymongo.asynchronous.database import AsyncDatabase
+from contextlib import asynccontextmanager
+from functools import partial
+from connction import close_database, get_database, get_db
+from models import BulkProvisionResult, RefreshRequest, UserCreate, UserLogin, Token
+from crud import create_user, get_user, delete_user, update_user, ensure_indexes
+from auth import (
+    ACCESS_TOKEN_EXPIRE_MINUTES,
+    ADMIN_USERNAMES,
+    create_access_token,
+    get_current_user,
+    password_hasher,
+)
+from provisioning import iter_user_batches, provision_users
+from sessions import (
+    InvalidRefreshToken,
+    create_session,
+    end_session,
+    load_revocations,
+    revoke_user_sessions,
+    rotate_session,
+)
+from tokens import InvalidTokenError, token_verifier
+from log import log_shipper, send_log
+from service_client import service_client
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create indexes once at startup rather than on the request path
+    await ensure_indexes(get_database())
+    # Revocations made by other replicas are read straight from the database
+    token_verifier.revocation_source = partial(load_revocations, get_database())
+    password_hasher.start()
+    service_client.start()
+    log_shipper.start()
+    yield
+    password_hasher.stop()
+    # Drain queued log entries before shutting down
+    await log_shipper.stop()
+    # Closed last since everything above may still call other services
+    await service_client.stop()
+    await close_database()
+
 
 # App Initialization
-app = FastAPI(title="Login Service")
+app = FastAPI(title="Login Service", lifespan=lifespan)
 
 # CORS Middleware
 app.add_middleware(
@@ -30,12 +58,37 @@ app.add_middleware(
 )
 
 
+async def upgrade_password_hash(db: AsyncDatabase, username: str, new_hash: str):
+    """Store a rehashed password; on failure the next login tries again"""
+    try:
+        await update_user(db.users, username, {"password": new_hash})
+    except HTTPException as e:
+        send_log(
+            username,
+            "UserAccMgmtServ",
+            "ERROR",
+            f"Error rehashing password: {e.detail}",
+        )
+
+
+def issue_tokens(username: str, session_id: str, refresh_token: str) -> dict:
+    """Sign an access token tied to the session, alongside its refresh token"""
+    return {
+        "access_token": create_access_token(data={"sub": username, "sid": session_id}),
+        "token_type": "bearer",
+        "refresh_token": refresh_token,
+        "expires_in": int(ACCESS_TOKEN_EXPIRE_MINUTES * 60),
+    }
+
+
 # Routes
 @app.post("/register/", response_model=dict)
-async def register_user(user: UserCreate, db: Collection = Depends(get_db)):
+async def register_user(user: UserCreate, db: AsyncDatabase = Depends(get_db)):
     try:
-        existing_user = get_user(db.users, user.username)
-        if existing_user:
+        hashed_password = await password_hasher.hash(user.password)
+        user_data = {"username": user.username, "password": hashed_password}
+        # One insert; the unique username index rejects names that are taken
+        if not await create_user(db.users, user_data):
             send_log(
                 user.username, "UserAccMgmtServ", "ERROR", "Username already exists"
             )
@@ -43,15 +96,6 @@ async def register_user(user: UserCreate, db: Collection = Depends(get_db)):
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Username already exists",
             )
-        hashed_password = get_password_hash(user.password)
-        user_data = {"username": user.username, "password": hashed_password}
-        result = create_user(db.users, user_data)
-        if not result:
-            send_log(user.username, "UserAccMgmtServ", "ERROR", "Error creating user")
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Error creating user",
-            )
         send_log(
             user.username, "UserAccMgmtServ", "INFO", "User registered successfully"
         )
@@ -74,23 +118,70 @@ async def register_user(user: UserCreate, db: Collection = Depends(get_db)):
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
 
+def require_admin(user: dict = Depends(get_current_user)) -> dict:
+    if user.get("username") not in ADMIN_USERNAMES:
+        raise HTTPException(status_code=403, detail="Administrator access required")
+    return user
+
+
+@app.post("/users/bulk", response_model=BulkProvisionResult)
+async def bulk_provision_users(
+    request: Request,
+    db: AsyncDatabase = Depends(get_db),
+    admin: dict = Depends(require_admin),
+):
+    """
+    Create users from an NDJSON body ({"username", "password"} per line) or a CSV
+    body with a username,password header. The body is read as it streams in;
+    invalid lines and taken usernames are counted and skipped.
+    """
+    username = admin.get("username")
+    try:
+        csv_body = "csv" in request.headers.get("content-type", "")
+        result = await provision_users(
+            db, iter_user_batches(request.stream(), csv_body)
+        )
+        send_log(
+            username,
+            "UserAccMgmtServ",
+            "INFO",
+            f"Provisioned {result.created} users "
+            f"({result.existing} existing, {result.invalid} invalid)",
+        )
+        return result
+    except Exception as e:
+        send_log(
+            username,
+            "UserAccMgmtServ",
+            "ERROR",
+            f"Unexpected error provisioning users: {str(e)}",
+        )
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+
+
 @app.post("/login/", response_model=Token)
-async def login_user(user: UserLogin, db: Collection = Depends(get_db)):
+async def login_user(user: UserLogin, db: AsyncDatabase = Depends(get_db)):
     try:
-        existing_user = get_user(db.users, user.username)
-        if not existing_user or not verify_password(
-            user.password, existing_user["password"]
-        ):
+        existing_user = await get_user(db.users, user.username)
+        valid, new_hash = False, None
+        if existing_user:
+            valid, new_hash = await password_hasher.verify(
+                user.password, existing_user["password"]
+            )
+        if not valid:
             send_log(user.username, "UserAccMgmtServ", "ERROR", "Invalid credentials")
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid credentials",
             )
-        access_token = create_access_token(data={"sub": user.username})
+        if new_hash:
+            # The stored hash predates the current cost settings
+            await upgrade_password_hash(db, user.username, new_hash)
+        session_id, refresh_token = await create_session(db, user.username)
         send_log(
             user.username, "UserAccMgmtServ", "INFO", "User logged in successfully"
         )
-        return {"access_token": access_token, "token_type": "bearer"}
+        return issue_tokens(user.username, session_id, refresh_token)
     except HTTPException as e:
         send_log(
             user.username,
@@ -109,11 +200,61 @@ async def login_user(user: UserLogin, db: Collection = Depends(get_db)):
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
 
+@app.post("/token/refresh", response_model=Token)
+async def refresh_access_token(
+    request: RefreshRequest, db: AsyncDatabase = Depends(get_db)
+):
+    """Trade a refresh token for new tokens without checking the password again"""
+    try:
+        username, session_id, refresh_token = await rotate_session(
+            db, request.refresh_token
+        )
+        return issue_tokens(username, session_id, refresh_token)
+    except InvalidRefreshToken as e:
+        send_log("Unknown", "UserAccMgmtServ", "ERROR", f"Refresh error: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid refresh token",
+        )
+    except Exception as e:
+        send_log(
+            "Unknown",
+            "UserAccMgmtServ",
+            "ERROR",
+            f"Unexpected error refreshing token: {str(e)}",
+        )
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+
+
+@app.post("/logout/", response_model=dict)
+async def logout_user(request: RefreshRequest, db: AsyncDatabase = Depends(get_db)):
+    """End the session the refresh token belongs to"""
+    try:
+        # Only the holder of the session's latest refresh token may end it
+        if not await end_session(db, request.refresh_token):
+            raise InvalidRefreshToken("Not the session's latest refresh token")
+        return {"message": "Logged out successfully"}
+    except InvalidRefreshToken:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid refresh token",
+        )
+    except Exception as e:
+        send_log(
+            "Unknown",
+            "UserAccMgmtServ",
+            "ERROR",
+            f"Unexpected error logging out: {str(e)}",
+        )
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+
+
 @app.get("/verify/", response_model=dict)
 async def verify_token(token: str):
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = await token_verifier.verify(token)
         username = payload.get("sub")
+        # Tokens of revoked sessions were already refused by the verifier
         if username is None:
             send_log("Unknown", "UserAccMgmtServ", "ERROR", "Invalid token")
             raise HTTPException(
@@ -122,7 +263,9 @@ async def verify_token(token: str):
             )
         send_log(username, "UserAccMgmtServ", "INFO", "Token verified successfully")
         return {"message": "Token is valid", "username": username}
-    except JWTError as e:
+    except HTTPException as e:
+        raise e
+    except InvalidTokenError as e:
         send_log("Unknown", "UserAccMgmtServ", "ERROR", f"JWT error: {str(e)}")
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -138,19 +281,41 @@ async def verify_token(token: str):
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
 
+@app.get("/.well-known/jwks.json", response_model=dict)
+async def get_jwks():
+    """Public keys that tokens may be signed with, for services verifying locally"""
+    await token_verifier.refresh_keys()
+    return {"keys": token_verifier.public_keys()}
+
+
+@app.get("/sessions/revoked", response_model=dict)
+async def get_revoked_sessions(db: AsyncDatabase = Depends(get_db)):
+    """Ended sessions whose access tokens are still unexpired, for JWT_REVOCATIONS_URL"""
+    revoked = await load_revocations(db)
+    return {
+        "revoked": [
+            {"sid": sid, "expires_at": expires_at} for sid, expires_at in revoked
+        ]
+    }
+
+
 @app.delete("/users/", response_model=dict)
-async def delete_user_endpoint(user: UserLogin, db: Collection = Depends(get_db)):
+async def delete_user_endpoint(user: UserLogin, db: AsyncDatabase = Depends(get_db)):
     try:
-        existing_user = get_user(db.users, user.username)
-        if not existing_user or not verify_password(
-            user.password, existing_user["password"]
-        ):
+        existing_user = await get_user(db.users, user.username)
+        valid = False
+        if existing_user:
+            valid, _ = await password_hasher.verify(
+                user.password, existing_user["password"]
+            )
+        if not valid:
             send_log(user.username, "UserAccMgmtServ", "ERROR", "Invalid credentials")
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid credentials",
             )
-        result = delete_user(db.users, existing_user["id"])
+        result = await delete_user(db.users, existing_user["username"])
+        await revoke_user_sessions(db, existing_user["username"])
         if not result:
             send_log(user.username, "UserAccMgmtServ", "ERROR", "User not found")
             raise HTTPException(
@@ -1,4 +1,5 @@
 from pydantic import BaseModel, Field, field_validator
+from typing import List, Optional
 import re
 
 
@@ -30,3 +31,22 @@ class Token(BaseModel):
 
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
+    expires_in: Optional[int] = None  # Seconds until the access token expires
+
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+
+class ProvisionError(BaseModel):
+    line: int
+    username: Optional[str] = None
+    error: str
+
+
+class BulkProvisionResult(BaseModel):
+    created: int = 0
+    existing: int = 0
+    invalid: int = 0
+    errors: List[ProvisionError] = []  # The first MAX_REPORTED_ERRORS problems
@@ -0,0 +1,113 @@
+from pymongo.asynchronous.database import AsyncDatabase
+from pydantic import ValidationError
+from typing import AsyncIterator, List, Optional, Tuple
+from models import BulkProvisionResult, ProvisionError, UserCreate
+from auth import password_hasher
+from crud import create_users
+import csv
+import json
+import os
+import dotenv
+
+# Load environment variables from .env file
+dotenv.load_dotenv()
+
+# Users hashed and inserted together; the import never holds more than this
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "500"))
+MAX_REPORTED_ERRORS = 100
+
+Record = Tuple[int, Optional[dict]]  # (line number, parsed user or None)
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Split a streamed body into lines without buffering all of it"""
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+
+def parse_json_line(line: str) -> Optional[dict]:
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+    return record if isinstance(record, dict) else None
+
+
+async def iter_user_batches(
+    chunks: AsyncIterator[bytes], csv_body: bool, batch_size: int = BULK_BATCH_SIZE
+) -> AsyncIterator[List[Record]]:
+    """
+    Parse an NDJSON body (one {"username", "password"} object per line) or a CSV
+    body with a header row into batches of records.
+    """
+    header = None
+    batch = []
+    line_number = 0
+    async for raw_line in iter_lines(chunks):
+        line_number += 1
+        line = raw_line.decode("utf-8", errors="replace").strip()
+        if not line:
+            continue
+        if not csv_body:
+            batch.append((line_number, parse_json_line(line)))
+        elif header is None:
+            header = [name.strip() for name in next(csv.reader([line]))]
+            continue
+        else:
+            row = next(csv.reader([line]))
+            batch.append((line_number, dict(zip(header, row))))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def provision_users(
+    db: AsyncDatabase, batches: AsyncIterator[List[Record]]
+) -> BulkProvisionResult:
+    """Validate, hash and insert users batch by batch"""
+    result = BulkProvisionResult()
+
+    def report(line: int, username: Optional[str], error: str):
+        if len(result.errors) < MAX_REPORTED_ERRORS:
+            result.errors.append(
+                ProvisionError(line=line, username=username, error=error)
+            )
+
+    async for batch in batches:
+        users = []
+        for line, record in batch:
+            if record is None:
+                result.invalid += 1
+                report(line, None, "Not a JSON object")
+                continue
+            try:
+                users.append((line, UserCreate(**record)))
+            except ValidationError as e:
+                result.invalid += 1
+                report(line, record.get("username"), e.errors()[0]["msg"])
+        if not users:
+            continue
+
+        # Hashed on the password pool alongside regular logins
+        hashes = await password_hasher.hash_many([user.password for _, user in users])
+        created, taken = await create_users(
+            db.users,
+            [
+                {"username": user.username, "password": hashed}
+                for (_, user), hashed in zip(users, hashes)
+            ],
+        )
+        result.created += created
+        result.existing += len(taken)
+        for index in taken:
+            line, user = users[index]
+            report(line, user.username, "Username already exists")
+    return result
@@ -0,0 +1,169 @@
+from pymongo import ASCENDING, UpdateOne
+from pymongo.asynchronous.database import AsyncDatabase
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, Tuple
+from auth import ACCESS_TOKEN_EXPIRE_MINUTES
+from tokens import token_verifier
+import hashlib
+import os
+import secrets
+import uuid
+import dotenv
+
+# Load environment variables from .env file
+dotenv.load_dotenv()
+
+# A session ends after this many days without a refresh
+REFRESH_TOKEN_EXPIRE_DAYS = float(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
+
+
+class InvalidRefreshToken(Exception):
+    """The refresh token is malformed, expired, revoked or already used"""
+
+
+def hash_secret(secret: str) -> str:
+    # Refresh secrets are random, so a plain SHA-256 is enough to store them safely
+    return hashlib.sha256(secret.encode()).hexdigest()
+
+
+def split_refresh_token(refresh_token: str) -> Tuple[str, str]:
+    session_id, _, secret = refresh_token.partition(".")
+    if not session_id or not secret:
+        raise InvalidRefreshToken("Malformed refresh token")
+    return session_id, secret
+
+
+async def ensure_session_indexes(db: AsyncDatabase):
+    """Expire idle sessions and revocations; support revoking a user's sessions"""
+    await db.sessions.create_index("expires_at", expireAfterSeconds=0)
+    await db.sessions.create_index([("username", ASCENDING)])
+    await db.revoked_sessions.create_index("expires_at", expireAfterSeconds=0)
+
+
+async def record_revocations(db: AsyncDatabase, session_ids: Iterable[str]):
+    """
+    Refuse the access tokens of ended sessions until they expire.
+
+    Revocations are stored so that every replica, and every service polling
+    /sessions/revoked, picks them up within JWT_REVOCATIONS_REFRESH_S; this
+    process refuses them at once.
+    """
+    expires_at = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    operations = []
+    for session_id in session_ids:
+        token_verifier.revoke(session_id, unix_time(expires_at))
+        operations.append(
+            UpdateOne(
+                {"_id": session_id}, {"$set": {"expires_at": expires_at}}, upsert=True
+            )
+        )
+    if operations:
+        await db.revoked_sessions.bulk_write(operations, ordered=False)
+
+
+async def load_revocations(db: AsyncDatabase) -> List[Tuple[str, float]]:
+    """Sessions whose access tokens may still be unexpired, with their expiry time"""
+    cursor = db.revoked_sessions.find({"expires_at": {"$gt": datetime.utcnow()}})
+    return [(item["_id"], unix_time(item["expires_at"])) async for item in cursor]
+
+
+def unix_time(moment: datetime) -> float:
+    # Stored datetimes are naive UTC
+    return moment.replace(tzinfo=timezone.utc).timestamp()
+
+
+async def create_session(db: AsyncDatabase, username: str) -> Tuple[str, str]:
+    """Start a session; returns its ID and the first refresh token"""
+    session_id = uuid.uuid4().hex
+    secret = secrets.token_urlsafe(32)
+    now = datetime.utcnow()
+    await db.sessions.insert_one(
+        {
+            "_id": session_id,
+            "username": username,
+            "token_hash": hash_secret(secret),
+            "created_at": now,
+            "last_used_at": now,
+            "expires_at": now + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+        }
+    )
+    return session_id, f"{session_id}.{secret}"
+
+
+async def rotate_session(db: AsyncDatabase, refresh_token: str) -> Tuple[str, str, str]:
+    """
+    Exchange a refresh token for a new one; returns the username, session ID and
+    new refresh token.
+
+    Only the latest token of a session is accepted, and it is swapped for the
+    next one in a single conditional update. Presenting an older token means it
+    was copied, so the whole session is revoked.
+    """
+    session_id, secret = split_refresh_token(refresh_token)
+    if token_verifier.is_revoked(session_id):
+        raise InvalidRefreshToken("Session has been revoked")
+    new_secret = secrets.token_urlsafe(32)
+    now = datetime.utcnow()
+    session = await db.sessions.find_one_and_update(
+        {
+            "_id": session_id,
+            "token_hash": hash_secret(secret),
+            "expires_at": {"$gt": now},
+        },
+        {
+            "$set": {
+                "token_hash": hash_secret(new_secret),
+                "last_used_at": now,
+                "expires_at": now + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+            }
+        },
+        projection={"username": 1},
+    )
+    if session is None:
+        # The TTL monitor removes expired sessions only about once a minute, so
+        # a session that is still stored may simply have run out
+        session = await db.sessions.find_one({"_id": session_id}, {"expires_at": 1})
+        if session is None:
+            raise InvalidRefreshToken("Unknown or expired session")
+        if session["expires_at"] <= now:
+            await db.sessions.delete_one(
+                {"_id": session_id, "expires_at": {"$lte": now}}
+            )
+            raise InvalidRefreshToken("Session expired")
+        await revoke_session(db, session_id)
+        raise InvalidRefreshToken("Refresh token reused; session revoked")
+    return session["username"], session_id, f"{session_id}.{new_secret}"
+
+
+async def end_session(db: AsyncDatabase, refresh_token: str) -> bool:
+    """
+    End the session a refresh token belongs to; False if the token is not the
+    session's latest one.
+
+    The session ID alone is not enough: it is the `sid` claim of every access
+    token, so holding one must not allow ending the session.
+    """
+    session_id, secret = split_refresh_token(refresh_token)
+    result = await db.sessions.delete_one(
+        {"_id": session_id, "token_hash": hash_secret(secret)}
+    )
+    if not result.deleted_count:
+        return False
+    await record_revocations(db, [session_id])
+    return True
+
+
+async def revoke_session(db: AsyncDatabase, session_id: str) -> bool:
+    """End a session; False if it did not exist"""
+    result = await db.sessions.delete_one({"_id": session_id})
+    if not result.deleted_count:
+        return False
+    await record_revocations(db, [session_id])
+    return True
+
+
+async def revoke_user_sessions(db: AsyncDatabase, username: str):
+    """End every session of a user"""
+    sessions = db.sessions.find({"username": username}, {"_id": 1})
+    await record_revocations(db, [session["_id"] async for session in sessions])
+    await db.sessions.delete_many({"username": username})
@@ -1,4 +1,4 @@
-import React, { useState } from "react";
+import React, { useEffect, useState } from "react";
 import ReactPlayer from "react-player";
 import {
   Box,
@@ -9,6 +9,7 @@ import {
   IconButton,
   Spinner,
   Divider,
+  Image,
 } from "@chakra-ui/react";
 import { DeleteIcon, DownloadIcon } from "@chakra-ui/icons";
 
@@ -16,6 +17,39 @@ function VideoCard(props) {
   const [streamUrl, setStreamUrl] = useState(null);
   const [loading, setLoading] = useState(false);
   const [playing, setPlaying] = useState(false); // Track if the video is playing
+  const [posterUrl, setPosterUrl] = useState(null);
+
+  // Show the poster frame instead of fetching the whole video up front
+  useEffect(() => {
+    const token = JSON.parse(localStorage.getItem("user")).access_token;
+    let objectUrl = null;
+    let cancelled = false;
+    const version = props.sha256 ? `?v=${props.sha256}` : "";
+
+    fetch(
+      `https://storage-service-v2-935294039360.us-central1.run.app/storage/thumbnail/${props.filename}${version}`,
+      {
+        headers: {
+          Authorization: `Bearer ${token}`,
+        },
+      }
+    )
+      .then((response) => (response.ok ? response.blob() : null))
+      .then((blob) => {
+        if (blob && !cancelled) {
+          objectUrl = URL.createObjectURL(blob);
+          setPosterUrl(objectUrl);
+        }
+      })
+      .catch(() => {}); // The card falls back to the plain placeholder
+
+    return () => {
+      cancelled = true;
+      if (objectUrl) {
+        URL.revokeObjectURL(objectUrl);
+      }
+    };
+  }, [props.filename, props.sha256]);
 
   const handleStream = async () => {
     const token = JSON.parse(localStorage.getItem("user")).access_token; // Get the token from localStorage
@@ -31,7 +65,10 @@ function VideoCard(props) {
         }
       );
 
-      if (response.ok) {
+      if (response.ok && response.redirected) {
+        // Redirected to the adaptive-bitrate manifest; segments load on demand
+        setStreamUrl(response.url);
+      } else if (response.ok) {
         const blob = await response.blob();
         const url = URL.createObjectURL(blob);
         setStreamUrl(url); // Set the blob URL for streaming
@@ -99,11 +136,31 @@ function VideoCard(props) {
             left="50%"
             transform="translate(-50%, -50%)"
           />
+        ) : !streamUrl && posterUrl ? (
+          <Image
+            src={posterUrl}
+            alt={props.filename}
+            w="100%"
+            h="100%"
+            objectFit="cover"
+          />
         ) : (
           <ReactPlayer
             url={streamUrl || props.filePath} // Use stream URL if available, otherwise fallback to file path
             playing={playing} // Control playback state
             controls={false}
+            config={{
+              file: {
+                hlsOptions: {
+                  // Manifests and segments need the same token as the video
+                  xhrSetup: (xhr) => {
+                    const token = JSON.parse(localStorage.getItem("user"))
+                      .access_token;
+                    xhr.setRequestHeader("Authorization", `Bearer ${token}`);
+                  },
+                },
+              },
+            }}
             width="100%"
             height="100%"
           />
@@ -40,7 +40,21 @@ const Dashboard = (props) => {
         );
         setUsedStorage(response.data);
         setStorageInfo(response.data);
-        setVideos(response.data.files);
+        // Status only embeds the first page of files; follow the cursor for the rest
+        let files = response.data.files;
+        let cursor = response.data.next_cursor;
+        while (cursor) {
+          const page = await axios.get(
+            "https://storage-service-v2-935294039360.us-central1.run.app/storage/files/",
+            {
+              headers: { Authorization: `Bearer ${token}` },
+              params: { cursor },
+            }
+          );
+          files = files.concat(page.data.files);
+          cursor = page.data.next_cursor;
+        }
+        setVideos(files);
       } catch (err) {
         setError("Failed to fetch storage status.");
       }
@@ -167,6 +181,7 @@ const Dashboard = (props) => {
         filePath={video.file_path}
         filename={video.filename}
         mimeType={video.mime_type}
+        sha256={video.sha256}
         sizeMb={video.size_mb}
         uploadedAt={video.uploaded_at}
         onDelete={handleDelete}